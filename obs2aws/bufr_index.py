@@ -0,0 +1,81 @@
+"""
+An index of the messages in a BUFR file.
+The file is memory mapped once and scanned for message boundaries, "BUFR" followed
+by the total length in section 0, checked against the "7777" which must end the
+message. After that any message can be reached directly, e.g. to decode a range of
+messages in another process or to reprocess only part of a file.
+"""
+import logging
+import mmap
+import os
+import struct
+
+import eccodes
+
+LOGGER = logging.getLogger()
+
+START = 'BUFR'
+END = '7777'
+SECTION0_LENGTH = 8
+
+
+def scan_messages(buf):
+    '''returns a list of (offset, length) for each BUFR message in buf'''
+    offsets = []
+    size = len(buf)
+    position = 0
+    while True:
+        start = buf.find(START, position)
+        if start < 0 or start + SECTION0_LENGTH > size:
+            break
+        #octets 5-7 of section 0 are the total length of the message
+        length = struct.unpack('>I', '\0' + buf[start+4:start+7])[0]
+        end = start + length
+        if length >= SECTION0_LENGTH + len(END) and end <= size and \
+           buf[end-len(END):end] == END:
+            offsets.append((start, length))
+            position = end
+        else:
+            LOGGER.debug('ignoring "%s" at offset %d, no "%s" where expected',
+                         START, start, END)
+            position = start + len(START)
+    return offsets
+
+class BufrIndex(object):
+    """Memory mapped BUFR file with the offsets of its messages.
+    offsets from an earlier index of the same file can be passed in to save
+    scanning it again."""
+    def __init__(self, filename, offsets=None):
+        self.filename = filename
+        with open(filename, 'rb') as bufr_file:
+            size = os.fstat(bufr_file.fileno()).st_size
+            if size:
+                self._map = mmap.mmap(bufr_file.fileno(), size, access=mmap.ACCESS_READ)
+            else:
+                self._map = ''
+        if offsets is None:
+            offsets = scan_messages(self._map)
+        self.offsets = offsets
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        """unmaps the file"""
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+    def message(self, number):
+        '''the bytes of message number as a read only view on the mapped file'''
+        start, length = self.offsets[number]
+        return buffer(self._map, start, length)
+
+    def new_handle(self, number):
+        '''an eccodes handle for message number, which must be released by the caller'''
+        return eccodes.codes_new_from_message(str(self.message(number)))
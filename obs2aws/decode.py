@@ -12,39 +12,168 @@ Created on Wed Jan 11 14:41:19 2017
 
 @author: wim
 """
+import calendar
+import collections
 import datetime
 import logging
+import multiprocessing
 import os
 
 import eccodes
 import numpy
 
+from . import bufr_index
+from . import shared_arrays
 from obs2aws import tools
 import station_details
 
 LOGGER = logging.getLogger()
 
+#the missing value sentinel eccodes uses for each native type
+MISSING_VALUES = {int: eccodes.CODES_MISSING_LONG,
+                  float: eccodes.CODES_MISSING_DOUBLE}
 
-def bufr_typical_timestamp(msgid):
-    '''gets the typical datetime from section1 of a BUFR message and returns as
-    a masked numpy array'''
+#templates are few, but don't let a strange feed grow the plan cache without bound
+MAX_EXTRACTION_PLANS = 256
+_EXTRACTION_PLANS = {}
+
+#how many message ranges each decoding process gets when decoding a file in parallel
+RANGES_PER_WORKER = 4
+
+
+def bufr_typical_datetime(msgid):
+    '''gets the typical datetime from section1 of a BUFR message, None if that fails.
+    This doesn't need the message to be unpacked'''
     try:
-        date = datetime.datetime(eccodes.codes_get(msgid, 'typicalYear'),
+        return datetime.datetime(eccodes.codes_get(msgid, 'typicalYear'),
                                  eccodes.codes_get(msgid, 'typicalMonth'),
                                  eccodes.codes_get(msgid, 'typicalDay'),
                                  eccodes.codes_get(msgid, 'typicalHour'),
                                  eccodes.codes_get(msgid, 'typicalMinute'),
                                  eccodes.codes_get(msgid, 'typicalSecond'))
-        result = [date.strftime('%Y%m%d%H%M%S')]
-        LOGGER.debug('bufr_typical_timestamp: %s -> %s', str(date), str(result))
-        return numpy.ma.asarray(result)
     except (ValueError, eccodes.CodesInternalError):
+        return None
+
+def bufr_typical_timestamp(msgid):
+    '''gets the typical datetime from section1 of a BUFR message and returns as
+    a masked numpy array'''
+    date = bufr_typical_datetime(msgid)
+    if date is None:
         LOGGER.warning('could not get typical date')
         return None
+    result = [date.strftime('%Y%m%d%H%M%S')]
+    LOGGER.debug('bufr_typical_timestamp: %s -> %s', str(date), str(result))
+    return numpy.ma.asarray(result)
+
+def bufr_typical_epoch(msgid):
+    '''gets the typical datetime from section1 of a BUFR message as a masked numpy
+    array of its seconds since 1970, see tools.EPOCH'''
+    date = bufr_typical_datetime(msgid)
+    if date is None:
+        LOGGER.warning('could not get typical date')
+        return None
+    return numpy.ma.asarray([calendar.timegm(date.utctimetuple())], dtype=numpy.int64)
+
+class HeaderFilter(object):
+    """Decides from section 1 alone, before the expensive unpack, whether a BUFR
+    message is wanted.
+    earliest and latest (datetimes) bound the typical date of the message.
+    categories, sub_categories and centres are collections of the allowed
+    dataCategory, data sub category and bufrHeaderCentre.
+    Criteria left as None are not checked, and a criterion that can't be read
+    from the message doesn't reject it."""
+    def __init__(self, earliest=None, latest=None,
+                 categories=None, sub_categories=None, centres=None):
+        self.earliest = earliest
+        self.latest = latest
+        self.categories = categories
+        self.sub_categories = sub_categories
+        self.centres = centres
+
+    @staticmethod
+    def _get(msgid, keys):
+        '''the value of the first of keys which the message has, else None'''
+        for key in keys:
+            try:
+                return eccodes.codes_get(msgid, key)
+            except eccodes.CodesInternalError:
+                pass
+        return None
 
-def decode_bufr_array(msgid, key):
+    def _allowed(self, msgid, allowed, keys):
+        if allowed is None:
+            return True
+        value = self._get(msgid, keys)
+        return value is None or value in allowed
+
+    def accepts(self, msgid):
+        '''True if the (still packed) message passes all of the criteria'''
+        if not self._allowed(msgid, self.categories, ['dataCategory']) or \
+           not self._allowed(msgid, self.sub_categories,
+                             ['internationalDataSubCategory', 'dataSubCategory']) or \
+           not self._allowed(msgid, self.centres, ['bufrHeaderCentre']):
+            return False
+        if self.earliest is not None or self.latest is not None:
+            date = bufr_typical_datetime(msgid)
+            if date is not None:
+                if self.earliest is not None and date < self.earliest:
+                    return False
+                if self.latest is not None and date > self.latest:
+                    return False
+        return True
+
+class ExtractionPlan(object):
+    """What we have learnt about decoding one BUFR template (same
+    unexpandedDescriptors) with one set of field_lists.
+    Native types are remembered for every key that has been found, so
+    codes_get_native_type is only called the first time a key is seen.
+    Keys that were not found are still tried on later messages since delayed
+    replication can make them appear."""
+    def __init__(self, field_lists):
+        self.required = list(field_lists['required'])
+        self.meteorology = list(field_lists['meteorology'])
+        self.report_count_field = field_lists.get('report_count_field')
+        #fieldname -> (field, required_title) for the accumulated fields
+        self.accumulated = {}
+        for fieldname in self.required + self.meteorology:
+            if field_is_accumulated(fieldname):
+                self.accumulated[fieldname] = tuple(fieldname.split('@'))
+        self.has_accumulated_fields = len(self.accumulated) > 0
+        self.native_types = {}
+
+    def native_type(self, msgid, key):
+        """the eccodes native type of key, only asking eccodes the first time"""
+        try:
+            return self.native_types[key]
+        except KeyError:
+            dtype = eccodes.codes_get_native_type(msgid, key)
+            self.native_types[key] = dtype
+            return dtype
+
+def get_extraction_plan(msgid, field_lists):
+    """returns the cached ExtractionPlan for the template of this message.
+    Messages without a readable template get a fresh, uncached plan"""
+    try:
+        template = tuple(eccodes.codes_get_array(msgid, 'unexpandedDescriptors'))
+    except eccodes.CodesInternalError:
+        return ExtractionPlan(field_lists)
+    cache_key = (template,
+                 tuple(field_lists['required']),
+                 tuple(field_lists['meteorology']),
+                 field_lists.get('report_count_field'))
+    plan = _EXTRACTION_PLANS.get(cache_key)
+    if plan is None:
+        if len(_EXTRACTION_PLANS) >= MAX_EXTRACTION_PLANS:
+            _EXTRACTION_PLANS.clear()
+        plan = ExtractionPlan(field_lists)
+        _EXTRACTION_PLANS[cache_key] = plan
+        LOGGER.debug('new extraction plan for template %s', template)
+    return plan
+
+def decode_bufr_array(msgid, key, plan=None):
     '''Returns a numpy maksed array of values corresponding to the fieldname.
     None if there is an error.
+    If an ExtractionPlan is given, the native type of the key comes from there.
     '''
     if key == 'datetime':
         return bufr_typical_timestamp(msgid)
@@ -52,28 +181,29 @@ def decode_bufr_array(msgid, key):
         arr = eccodes.codes_get_array(msgid, key)
         if len(arr) == 0:
             return None
-        dtype = eccodes.codes_get_native_type(msgid, key)
+        if plan is None:
+            dtype = eccodes.codes_get_native_type(msgid, key)
+        else:
+            dtype = plan.native_type(msgid, key)
         if dtype is str:
             arr = numpy.char.strip(arr)
         if not isinstance(arr, numpy.ndarray):
             values = numpy.asarray(arr, dtype=dtype)
         else:
             values = arr
-        if dtype is int:
-            result = numpy.ma.masked_values(values, eccodes.CODES_MISSING_LONG)
-        elif dtype is float:
-            result = numpy.ma.masked_values(values, eccodes.CODES_MISSING_DOUBLE)
+        if dtype in MISSING_VALUES:
+            result = numpy.ma.masked_values(values, MISSING_VALUES[dtype])
         else:
             result = numpy.ma.masked_array(data=values)
         return result
     except eccodes.CodesInternalError:
         return None
 
-def decode_bufr_array_attribute(msgid, key, attribute, required_length=None):
+def decode_bufr_array_attribute(msgid, key, attribute, required_length=None, plan=None):
     '''returns a numpy masked array corresponding to the key and attribute.
     If the length is not the required_length then returns None'''
     key_to_call = key+'->'+attribute
-    result = decode_bufr_array(msgid, key_to_call)
+    result = decode_bufr_array(msgid, key_to_call, plan)
     if result is not None and required_length is not None:
         if len(result) != required_length:
             LOGGER.warning('%s has length %d instead of %d',
@@ -81,25 +211,22 @@ def decode_bufr_array_attribute(msgid, key, attribute, required_length=None):
             result = None
     return result
 
-def get_time_periods(msgid, field_lists):
+def get_time_periods(msgid, field_lists, plan=None):
     """returns time periods of the current message as two lists of
     titles and indexs. Split out to make tools.get_time_periods_from_fields testable"""
     #working out time periods can be an expensive operation in big data sets so
     #  we only do that if we have to
-    has_accumulated_fields = False
-    for fieldname in field_lists['required']+field_lists['meteorology']:
-        if field_is_accumulated(fieldname):
-            has_accumulated_fields = True
-            break
-    if not has_accumulated_fields:
+    if plan is None:
+        plan = ExtractionPlan(field_lists)
+    if not plan.has_accumulated_fields:
         return [], numpy.ma.asarray([])
     else:
-        values = decode_bufr_array(msgid, 'timePeriod')
+        values = decode_bufr_array(msgid, 'timePeriod', plan)
         if values is None:
             LOGGER.debug('no timePeriods')
             return [], numpy.ma.asarray([])
-        units = decode_bufr_array_attribute(msgid, 'timePeriod', 'units', len(values))
-        indexs = decode_bufr_array_attribute(msgid, 'timePeriod', 'index', len(values))
+        units = decode_bufr_array_attribute(msgid, 'timePeriod', 'units', len(values), plan)
+        indexs = decode_bufr_array_attribute(msgid, 'timePeriod', 'index', len(values), plan)
         if units is None or indexs is None:
             return [], numpy.ma.asarray([])
         else:
@@ -109,7 +236,8 @@ def field_is_accumulated(fieldname):
     '''Decides if this field is accumulated over a time period'''
     return '@' in fieldname
 
-def process_message_get_field_array(msgid, fieldname, time_titles=None, time_indexs=None):
+def process_message_get_field_array(msgid, fieldname, time_titles=None, time_indexs=None,
+                                    plan=None):
     '''If this is not an accumulated field then the dictionary will just be {field:values}
     None is returned is there is any problem getting that field, most probably because it
     is missing in the message.
@@ -120,49 +248,52 @@ def process_message_get_field_array(msgid, fieldname, time_titles=None, time_ind
       ie. a multiple key dictionary {field@acc1: values1, field@acc2:values2 ...}
     An alternative specification for an accumulated field is something like
       "fieldname@3h". In that instance only the 3hourly accumulation
-      is put into the resulting dictionary'''
-    if field_is_accumulated(fieldname):
+      is put into the resulting dictionary
+    plan is an optional ExtractionPlan for the template of this message'''
+    if plan is not None:
+        accumulated = plan.accumulated.get(fieldname)
+    elif field_is_accumulated(fieldname):
+        accumulated = fieldname.split('@')
+    else:
+        accumulated = None
+    if accumulated is not None:
         #this is an accumulated field so we have a few more hoops to go through
         if time_titles is None or time_indexs is None:
             raise IndexError, 'accumulated but time arrays None'
-        field, required_title = fieldname.split('@')
-        values = decode_bufr_array(msgid, field)
+        field, required_title = accumulated
+        values = decode_bufr_array(msgid, field, plan)
         if values is None:
             return None
         len_values = len(values)
-        indexs = decode_bufr_array_attribute(msgid, field, 'index', len_values)
+        indexs = decode_bufr_array_attribute(msgid, field, 'index', len_values, plan)
         if indexs is None or len(indexs) != len_values:
             LOGGER.debug('accumulated field: %s indexs length suspect', fieldname)
+        #each value takes the index of its own descriptor, or the last one we know
+        value_indexs = indexs[numpy.minimum(numpy.arange(len_values), len(indexs)-1)]
+        value_valid = ~numpy.ma.getmaskarray(values)
+        titles = tools.resolve_time_period_titles(value_indexs, value_valid,
+                                                  time_titles, time_indexs)
+        wanted = titles != '?'
+        if required_title:
+            wanted &= titles == required_title
         result = {}
-        for each in range(len_values):
-            if isinstance(values.mask, numpy.ndarray) and values.mask[each]:
-                value = None  #continue #this particular value is missing
-            elif isinstance(values.mask, numpy.bool_) and values.mask:
-                value = None#  continue #all of these values are missing
+        for title in set(titles[wanted]):
+            selected = values[wanted & (titles == title)]
+            if selected.mask.any():
+                #missing values become None, and are masked
+                objects = selected.data.astype(object)
+                objects[selected.mask] = None
+                result[field + '@' + title] = numpy.ma.masked_equal(objects, None)
             else:
-                value = values[each]
-
-            #we want the precding time title = (value and unit)
-            # so we work out the index in the sorted time_index array
-            match_index = numpy.searchsorted(time_indexs,
-                                             indexs[min(each, len(indexs)-1)],
-                                             side='left') - 1
-            if 0 <= match_index < len(time_titles):
-                #If required, we step back to the most recent valid time_title
-                if value is not None:
-                    while match_index > 0 and time_titles[match_index] == '?':
-                        match_index -= 1
-                if time_titles[match_index] != '?' and \
-                   (not required_title or required_title == time_titles[match_index]):
-                    key = field + '@' + time_titles[match_index]
-                    if not key in result:
-                        result[key] = [value]
-                    else:
-                        result[key].append(value)
-        for key, values in result.items():
-            result[key] = numpy.ma.masked_equal(numpy.asarray(values), None)
+                result[field + '@' + title] = numpy.ma.masked_equal(selected.data, None)
+    elif fieldname == 'datetime':
+        #the typical date goes straight into the epoch column
+        values = bufr_typical_epoch(msgid)
+        if values is None:
+            return None
+        result = {tools.EPOCH:values}
     else:
-        values = decode_bufr_array(msgid, fieldname)
+        values = decode_bufr_array(msgid, fieldname, plan)
         if values is None:
             return None
         else:
@@ -173,10 +304,11 @@ def process_message(msgid, field_lists):
     '''process one message into an array of reports'''
     data = {}
     report_count = eccodes.codes_get(msgid, "numberOfSubsets")
-    time_titles, time_indexs = get_time_periods(msgid, field_lists)
-    for fieldname in field_lists['required']:
+    plan = get_extraction_plan(msgid, field_lists)
+    time_titles, time_indexs = get_time_periods(msgid, field_lists, plan)
+    for fieldname in plan.required:
         field_dict = process_message_get_field_array(msgid, fieldname,
-                                                     time_titles, time_indexs)
+                                                     time_titles, time_indexs, plan)
         if field_dict is None:
             LOGGER.warning('missing required field: "%s"', fieldname)
             return {}, 0
@@ -184,9 +316,9 @@ def process_message(msgid, field_lists):
             data.update(field_dict)
 
     missing_optional_fields = []
-    for fieldname in field_lists['meteorology']:
+    for fieldname in plan.meteorology:
         field_dict = process_message_get_field_array(msgid, fieldname,
-                                                     time_titles, time_indexs)
+                                                     time_titles, time_indexs, plan)
         if field_dict is None:
             missing_optional_fields.append(fieldname)
         else:
@@ -197,8 +329,8 @@ def process_message(msgid, field_lists):
 
     #for some report_types the report_count is NOT the number of subsets,
     #  so we have to deduce report_count from the length of a (required) field
-    if "report_count_field" in field_lists:
-        report_count_field = field_lists["report_count_field"]
+    if plan.report_count_field is not None:
+        report_count_field = plan.report_count_field
         if report_count_field in data:
             report_count = len(data[report_count_field])
 
@@ -207,6 +339,16 @@ def process_message(msgid, field_lists):
 
     return data, report_count
 
+def _float_column(values, length):
+    '''values as a float masked array, at least length long. Anything missing is masked'''
+    size = length if values is None else max(len(values), length)
+    result = numpy.ma.masked_all(size, dtype=float)
+    if values is not None and len(values) > 0:
+        if values.dtype.hasobject: #could have None instead of masked values
+            values = numpy.ma.masked_equal(values, None)
+        result[:len(values)] = values
+    return result
+
 def add_station_details(data):
     """see if we can "find" any unknown stations and thereby fill
     out missing lat, long, elevation. The lat/longs are needed for bounding_box
@@ -217,47 +359,46 @@ def add_station_details(data):
         #our station information can't help with these reports
         return data
 
-    #since it isn't efficient to append to numpy arrays, we'll use lists for this bit
-    lats, lons, elevations = [], [], []
-    if 'latitude' in data:
-        lats = data['latitude'].tolist()
-        lons = data['longitude'].tolist() #assume longitude is there as well as latitude
-    for heightkey in ['elevation', 'heightOfStation', 'heightOfStationGroundAboveMeanSeaLevel']:
-        if heightkey in data:
-            elevations = (data[heightkey]+0.0).tolist() #convert to floats
-            break
     if is_wmo_id:
         length = len(data['blockNumber'])
     else:
         length = len(data['CCCC'])
+    lats = _float_column(data.get('latitude'), length)
+    lons = _float_column(data.get('longitude'), length)
+    elevations = None
+    for heightkey in ['elevation', 'heightOfStation', 'heightOfStationGroundAboveMeanSeaLevel']:
+        if heightkey in data:
+            elevations = data[heightkey]
+            break
+    elevations = _float_column(elevations, length)
 
-    for _ in range(len(lats), length):
-        lats.append(None)
-        lons.append(None) #assume lons is the same length as lats
-    for _ in range(len(elevations), length):
-        elevations.append(None)
-
-    found_a_station = False
-    for each in range(length):
-        if lats[each] is None or elevations[each] is None:
-            if is_wmo_id:
-                obsid = '%2.2d%3.3d' %(data['blockNumber'][each],
-                                       data['stationNumber'][each])
-            else:
-                obsid = obsid = data['CCCC'][each]
-            details = station_details.get_station(obsid)
-            if details is not None:
-                if lats[each] is None:
-                    lats[each] = details[station_details.LATITUDE]
-                    lons[each] = details[station_details.LONGITUDE]
-                if elevations[each] is None and details[station_details.ELEVATION] is not None:
-                    elevations[each] = float(details[station_details.ELEVATION])
-                found_a_station = True
-
-    if found_a_station: #convert lists back to masked arrays
-        data['latitude'] = numpy.ma.masked_equal(lats, None)
-        data['longitude'] = numpy.ma.masked_equal(lons, None)
-        data['elevation'] = numpy.ma.masked_equal(elevations, None)
+    #only look up reports which are missing something and say which station they are
+    wanted = numpy.ma.getmaskarray(lats)[:length] | numpy.ma.getmaskarray(elevations)[:length]
+    if is_wmo_id:
+        wanted &= ~numpy.ma.getmaskarray(data['blockNumber']) & \
+                  ~numpy.ma.getmaskarray(data['stationNumber'])
+        wanted = numpy.flatnonzero(wanted)
+        found, found_lats, found_lons, found_elevations = station_details.locate_wmo_stations(
+            numpy.ma.getdata(data['blockNumber'])[wanted],
+            numpy.ma.getdata(data['stationNumber'])[wanted])
+    else:
+        wanted &= ~numpy.ma.getmaskarray(data['CCCC'])
+        wanted = numpy.flatnonzero(wanted)
+        found, found_lats, found_lons, found_elevations = station_details.locate_other_stations(
+            numpy.ma.getdata(data['CCCC'])[wanted])
+
+    if found.any(): #fill in what we found
+        rows = wanted[found]
+        found_lats, found_lons = found_lats[found], found_lons[found]
+        found_elevations = found_elevations[found]
+        no_location = numpy.ma.getmaskarray(lats)[rows]
+        lats[rows[no_location]] = numpy.ma.masked_invalid(found_lats[no_location])
+        lons[rows[no_location]] = numpy.ma.masked_invalid(found_lons[no_location])
+        fill_elevation = numpy.ma.getmaskarray(elevations)[rows] & ~numpy.isnan(found_elevations)
+        elevations[rows[fill_elevation]] = found_elevations[fill_elevation]
+        data['latitude'] = lats
+        data['longitude'] = lons
+        data['elevation'] = elevations
 
     return data
 
@@ -265,37 +406,34 @@ def translate_metar_data(data, timestamp):
     '''Produces a dictionary of numpy masked arrays which is compatible with the
     output of eccodes BUFR decoding. In the process it converts strings to
       floats or integers. Year and month are added from the timestamp.
-    Converts everything to SI'''
+    Converts everything to SI, a whole column at a time'''
     result = {}
     def _simple(key, values):
         return key, values.compressed().tolist()
     def _str_to_int(key, values):
-        return key, [int(val) for val in values.compressed().tolist()]
+        return key, values.compressed().astype(int)
     def _str_to_int_if_integer(key, values):
         return key, [int(val) if str(val).isdigit() else val \
                      for val in values.compressed().tolist()]
     def _temperature(key, values):
-        return 'airTemperature', [tools.change_to_si_units('degC', val) \
-                                 for val in values.compressed().tolist()]
+        return 'airTemperature', tools.change_array_to_si_units('degC', values.compressed())
     def _dewpoint(key, values):
-        return key, [tools.change_to_si_units('degC', val) \
-                     for val in values.compressed().tolist()]
+        return key, tools.change_array_to_si_units('degC', values.compressed())
     def _qnh_in_hpa(key, values):
         return 'pressureReducedToMeanSeaLevel', \
-             [tools.change_to_si_units('hPa', float(val.replace('Q', ''))) \
-              for val in values.compressed().tolist()]
+            tools.change_array_to_si_units(
+                'hPa', numpy.char.replace(values.compressed(), 'Q', '').astype(float))
     def _qnh_in_inhg00(key, values):
         return 'pressureReducedToMeanSeaLevel', \
-             [tools.change_to_si_units('inhg00', float(val.replace('A', ''))) \
-              for val in values.compressed().tolist()]
+            tools.change_array_to_si_units(
+                'inhg00', numpy.char.replace(values.compressed(), 'A', '').astype(float))
     def _windspeed(key, values):
         if 'windUnits' in data and \
                    len(data['windUnits'].compressed()) > 0:
             windunits = data['windUnits'].compressed()[0]
         else:
             windunits = 'knots'
-        return key, [tools.change_to_si_units(windunits, int(val)) \
-                     for val in values.compressed().tolist()]
+        return key, tools.change_array_to_si_units(windunits, values.compressed().astype(int))
     trans = {'latitude':_simple, 'longitude':_simple, 'CCCC':_simple,
              'name':_simple, 'elevation':_simple,
              'day':_str_to_int, 'hour':_str_to_int, 'minute':_str_to_int,
@@ -340,9 +478,9 @@ def process_metar_message(msgid, field_lists, timestamp):
     result = translate_metar_data(data, timestamp)
     return result, 1
 
-def decode_metar_file(filename, field_lists):
-    '''Decoded metar reports are made to look like decoded BUFR reports'''
-    result = []
+def iter_decode_metar_file(filename, field_lists):
+    '''Decoded metar reports are made to look like decoded BUFR reports.
+    Yields (message_data, report_count) for each message as it is decoded'''
     message_count = 0
     _, timestamp, _, _ = tools.parse_filename(filename)
     with open(filename) as metar_file:
@@ -350,14 +488,14 @@ def decode_metar_file(filename, field_lists):
         while True:
             msgid = eccodes.codes_metar_new_from_file(metar_file)
             if msgid is None:
-                return result # decoded all of the messages in the file
+                return # decoded all of the messages in the file
             try:
                 message_data, message_report_count = process_metar_message(msgid,
                                                                            field_lists,
                                                                            timestamp)
                 if message_report_count:
                     message_data = add_station_details(message_data)
-                    result.append((message_data, message_report_count))
+                    message_data = add_epoch_seconds(message_data, message_report_count)
                 if message_report_count == 1:
                     LOGGER.info('found 1 metar for %s in message[%d]',
                                 message_data['CCCC'][0], message_count)
@@ -371,8 +509,12 @@ def decode_metar_file(filename, field_lists):
             finally:
                 # release the handle for this message
                 eccodes.codes_release(msgid)
+            if message_report_count:
+                yield message_data, message_report_count
 
-    return result
+def decode_metar_file(filename, field_lists):
+    '''Decoded metar reports are made to look like decoded BUFR reports'''
+    return list(iter_decode_metar_file(filename, field_lists))
 
 def decode_temp_report(data, report_count):
     '''decode lat,lon,time displacements into geniune latitude and longitude and
@@ -381,82 +523,230 @@ def decode_temp_report(data, report_count):
     result = {}
     if 'latitudeDisplacement' in data and \
           len(data['latitudeDisplacement'].compressed()) >= report_count:
-        lats, lons, dates = [], [], []
         basetime = datetime.datetime(data['year'][0],
                                      data['month'][0],
                                      data['day'][0],
                                      data['hour'][0],
                                      data['minute'][0],
                                      data['second'][0])
-        lastdate = basetime
         baselat = data['latitude'].compressed()[0]
         baselon = data['longitude'].compressed()[0]
-        for each in range(report_count):
-            if not data['timePeriod'].mask[each]:
-                lastdate = basetime + datetime.timedelta(days=0, seconds=data['timePeriod'][each])
-            dates.append(lastdate.strftime('%Y%m%d%H%M%S'))
-            if data['latitudeDisplacement'].mask[each]:
-                lats.append(eccodes.CODES_MISSING_DOUBLE)
-            else:
-                lats.append(baselat + data['latitudeDisplacement'][each])
-            if data['longitudeDisplacement'].mask[each]:
-                lons.append(eccodes.CODES_MISSING_DOUBLE)
-            else:
-                lons.append(tools.lon_180_180(baselon + data['longitudeDisplacement'][each]))
+
+        #each level takes the time of the last level with a valid timePeriod
+        time_periods = data['timePeriod'][:report_count]
+        levels = numpy.arange(report_count)
+        levels[numpy.ma.getmaskarray(time_periods)] = -1
+        last_valid = numpy.maximum.accumulate(levels)
+        seconds = numpy.where(last_valid >= 0,
+                              numpy.ma.getdata(time_periods)[numpy.maximum(last_valid, 0)], 0)
+        dates = numpy.datetime64(basetime, 'us') + tools.seconds_to_timedelta64(seconds)
+
+        lat_displacements = data['latitudeDisplacement'][:report_count]
+        lon_displacements = data['longitudeDisplacement'][:report_count]
+        lats = numpy.where(numpy.ma.getmaskarray(lat_displacements), eccodes.CODES_MISSING_DOUBLE,
+                           baselat + numpy.ma.getdata(lat_displacements))
+        lons = numpy.where(numpy.ma.getmaskarray(lon_displacements), eccodes.CODES_MISSING_DOUBLE,
+                           tools.lons_180_180(baselon + numpy.ma.getdata(lon_displacements)))
 
         result['latitude'] = numpy.ma.masked_values(lats, eccodes.CODES_MISSING_DOUBLE)
         result['longitude'] = numpy.ma.masked_values(lons, eccodes.CODES_MISSING_DOUBLE)
-        result['datetime'] = numpy.ma.asarray(dates)
+        result[tools.EPOCH] = numpy.ma.asarray(dates.astype('M8[s]').astype(numpy.int64))
         for field in data:
             if field not in ['latitude', 'longitude',
                              'latitudeDisplacement', 'longitudeDisplacement',
-                             'datetime', 'year', 'month', 'day', 'hour', 'minute', 'second',
-                             'timePeriod']:
+                             'datetime', tools.EPOCH, 'timePeriod'] + tools.TIME_FIELDS:
                 result[field] = data[field]
         return result
     else:
         return data
 
-def decode_file(filename, report_type, field_lists):
-    '''Returns a list of tuples, where each tuple is (message_data, report_count).
-    message_data is dictionary of name: values
-    where the name is the field and the values is a masked numpy array for all reports.
-    Note the length of these arrays is not necessarily the same as the number of reports.
-    Accumulated fields will have names like rain@60min or maxtemp@6h'''
+def add_epoch_seconds(data, report_count):
+    '''replaces the time fields of a decoded message with one tools.EPOCH column of
+    seconds since 1970, which is what the rest of obs2aws works with.
+    The time fields are left alone when they can't be combined report by report,
+    i.e. they aren't integers of length 1 or report_count.
+    A missing or masked second counts as 0, as it always has for the rows'''
+    if tools.EPOCH not in data:
+        if 'datetime' in data:
+            return data
+        fields = [data.get(name) for name in tools.TIME_FIELDS]
+        if fields[-1] is None:
+            fields[-1] = numpy.ma.asarray([0])
+        for values in fields:
+            if values is None or values.dtype.kind not in 'iu' or \
+               len(values) not in (1, report_count):
+                return data
+        fields[-1] = numpy.ma.filled(fields[-1], 0)
+        data[tools.EPOCH] = tools.epoch_seconds(*fields)
+    for name in ['datetime'] + tools.TIME_FIELDS:
+        data.pop(name, None)
+    return data
+
+def _iter_bufr_messages(index, report_type, field_lists, start, stop,
+                        header_filter=None, incomplete=None):
+    '''decodes messages [start, stop) of a BufrIndex, yielding (message_data, report_count)
+    for each message with reports. If a message can't be unpacked we give up on the
+    rest of the file, and append its number to the incomplete list if there is one'''
+    filename = index.filename
+    rejected = 0
+    for each_message in range(start, min(stop, len(index))):
+        # get handle for message
+        msgid = index.new_handle(each_message)
+        if msgid is None:
+            break
+        try:
+            if header_filter is not None and not header_filter.accepts(msgid):
+                rejected += 1
+                continue
+
+            # we need to instruct ecCodes to expand all the BUFR descriptors
+            try:
+                eccodes.codes_set(msgid, 'unpack', 1)
+            except eccodes.CodesInternalError:
+                LOGGER.warning('failed to unpack message in %s', filename)
+                if incomplete is not None:
+                    incomplete.append(each_message)
+                break
+
+            message_data, message_report_count = process_message(msgid, field_lists)
+            if message_report_count > 0:
+                # special temp decoding, sorry...
+                if report_type == 'temp':
+                    message_data = decode_temp_report(message_data, message_report_count)
+                message_data = add_epoch_seconds(message_data, message_report_count)
+            LOGGER.debug('found %i reports in message[%d] of %s',
+                         message_report_count, each_message, os.path.basename(filename))
+        finally:
+            # release the handle for this message
+            eccodes.codes_release(msgid)
+        if message_report_count > 0:
+            yield message_data, message_report_count
+    if rejected:
+        LOGGER.info('header filter rejected %d messages of %s',
+                    rejected, os.path.basename(filename))
+
+def _decode_message_range(job):
+    '''process pool worker for decode_file: decodes messages [start, stop) of a file
+    and hands the arrays back through shared memory'''
+    filename, offsets, report_type, field_lists, start, stop, header_filter = job
+    incomplete = []
+    with bufr_index.BufrIndex(filename, offsets) as index:
+        result = list(_iter_bufr_messages(index, report_type, field_lists,
+                                          start, stop, header_filter, incomplete))
+    path, layout = shared_arrays.export_messages(result)
+    return path, layout, not incomplete
+
+def message_ranges(message_count, parts):
+    '''splits message_count messages into at most parts contiguous [start, stop) ranges
+    of nearly equal size'''
+    parts = max(1, min(parts, message_count))
+    bounds = [message_count * each // parts for each in range(parts + 1)]
+    return [(bounds[each], bounds[each+1]) for each in range(parts)
+            if bounds[each] < bounds[each+1]]
+
+def _iter_decode_file_parallel(index, report_type, field_lists, workers, header_filter=None,
+                               pool=None):
+    '''iter_decode_file using pool, a multiprocessing.Pool, each of its processes decoding
+    a contiguous range of messages. Messages are yielded a range at a time, in order.
+    Without a pool one of workers processes is started for the file.
+    Falls back to decoding serially if there is nothing to split, if this is itself a
+    daemon process (e.g. a worker of obs2aws.start_decoders, which can't have children)
+    or if the pool can't be started'''
+    filename = index.filename
+    message_count = len(index)
+    #a few ranges per worker so one slow range doesn't hold up the rest
+    ranges = message_ranges(message_count, workers * RANGES_PER_WORKER)
+    own_pool = None
+    if len(ranges) <= 1 or multiprocessing.current_process().daemon:
+        pool = None
+    elif pool is None:
+        try:
+            pool = own_pool = multiprocessing.Pool(min(workers, len(ranges)))
+        except Exception, err:
+            LOGGER.warning('could not start %d decoding processes (%s), decoding %s serially',
+                           workers, err, filename)
+    if pool is None:
+        for message in _iter_bufr_messages(index, report_type, field_lists,
+                                           0, message_count, header_filter):
+            yield message
+        return
+
+    complete = True
+    finished = False
+    pending = collections.deque()
+    try:
+        #the workers map the file themselves but reuse our message offsets
+        for start, stop in ranges:
+            job = (filename, index.offsets, report_type, field_lists, start, stop,
+                   header_filter)
+            pending.append(pool.apply_async(_decode_message_range, (job,)))
+        while pending:
+            path, layout, range_complete = pending.popleft().get()
+            if not complete:
+                #an earlier range gave up, so like the serial decode we ignore the rest
+                shared_arrays.discard(path)
+                continue
+            for message in shared_arrays.import_messages(path, layout):
+                yield message
+            complete = range_complete
+        finished = True
+    finally:
+        if own_pool is not None:
+            if finished:
+                own_pool.close()
+            else:
+                own_pool.terminate()
+        if not finished:
+            #stopped early or failed: the ranges which finish leave shared files. A pool
+            #we were given keeps running, so wait for the rest of its ranges
+            for result in pending:
+                if own_pool is None:
+                    result.wait()
+                if result.ready() and result.successful():
+                    shared_arrays.discard(result.get()[0])
+        if own_pool is not None:
+            own_pool.join()
+    LOGGER.debug('decoded %d messages of %s in %d ranges', message_count,
+                 os.path.basename(filename), len(ranges))
+
+def iter_decode_file(filename, report_type, field_lists, workers=1, header_filter=None,
+                     offsets=None, pool=None):
+    '''Yields (message_data, report_count) for each message of the file as it is decoded,
+    so only one message needs to be held at a time. See decode_file'''
     if not os.path.exists(filename):
         LOGGER.error('decode_file could not find file: %s', filename)
-        return []
+        return
     if report_type == 'metar':
         # metar is so specialised that it has it's own decoding methods
-        return decode_metar_file(filename, field_lists)
-
-    # open bufr file
-    result = []
-    with open(filename) as bufr_file:
-        # loop through the messages in the file
-        for each_message in range(eccodes.codes_count_in_file(bufr_file)):
-            # get handle for message
-            msgid = eccodes.codes_bufr_new_from_file(bufr_file)
-            if msgid is None:
-                break # decoded all of the messages in the file
-            try:
-                # we need to instruct ecCodes to expand all the BUFR descriptors
-                try:
-                    eccodes.codes_set(msgid, 'unpack', 1)
-                except eccodes.CodesInternalError:
-                    LOGGER.warning('failed to unpack message in %s', filename)
-                    break
-
-                message_data, message_report_count = process_message(msgid, field_lists)
-                if message_report_count > 0:
-                    # special temp decoding, sorry...
-                    if report_type == 'temp':
-                        message_data = decode_temp_report(message_data, message_report_count)
-                    result.append((message_data, message_report_count))
-                LOGGER.debug('found %i reports in message[%d] of %s',
-                             message_report_count, each_message, os.path.basename(filename))
-            finally:
-                # release the handle for this message
-                eccodes.codes_release(msgid)
+        for message in iter_decode_metar_file(filename, field_lists):
+            yield message
+        return
+
+    # index the messages of the bufr file
+    with bufr_index.BufrIndex(filename, offsets) as index:
+        if workers > 1:
+            messages = _iter_decode_file_parallel(index, report_type, field_lists, workers,
+                                                  header_filter, pool)
+        else:
+            messages = _iter_bufr_messages(index, report_type, field_lists,
+                                           0, len(index), header_filter)
+        for message in messages:
+            yield message
 
-        return result
+def decode_file(filename, report_type, field_lists, workers=1, header_filter=None,
+                offsets=None, pool=None):
+    '''Returns a list of tuples, where each tuple is (message_data, report_count).
+    message_data is dictionary of name: values
+    where the name is the field and the values is a masked numpy array for all reports.
+    Note the length of these arrays is not necessarily the same as the number of reports.
+    Accumulated fields will have names like rain@60min or maxtemp@6h
+    Report times are replaced by a tools.EPOCH column (int64 seconds since 1970)
+    With workers > 1 the messages of a BUFR file are decoded by that many processes,
+    which gives the same result in the same order. Those are pool's processes if it is
+    given (a multiprocessing.Pool, e.g. from obs2aws.start_decoders), otherwise they are
+    started for the file: when decoding many files start one pool for them all.
+    BUFR messages which a HeaderFilter doesn't accept are dropped before unpacking.
+    offsets, the bufr_index offsets of some of the messages (e.g. from
+    dedup.Deduplicator.claim), restricts a BUFR file to those messages'''
+    return list(iter_decode_file(filename, report_type, field_lists, workers, header_filter,
+                                 offsets, pool))
@@ -0,0 +1,286 @@
+"""
+Drops bulletins which have already been processed, before they are decoded.
+The GTS often delivers the same bulletin more than once under different file names,
+so files are recognised by a hash of their contents, or for BUFR files optionally by
+a hash of the data section (section 4) of each message, so that a file with some new
+messages only has those decoded.
+The hashes are kept in a SeenSet on disk, which forgets them after a while. A file's
+hashes are only held in memory until the ProgressJournal records it as written
+everywhere (or, without a journal, until the writers have finished with it), so a file
+which fails, or a run which dies, doesn't lose its bulletins. Copies skipped while the
+file was still being written are decoded again if it fails.
+"""
+import collections
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+
+from . import bufr_index
+
+LOGGER = logging.getLogger()
+
+HASH = hashlib.sha1
+READ_SIZE = 1 << 20
+
+
+def file_digest(filename):
+    '''the hash of the contents of filename'''
+    digest = HASH()
+    with open(filename, 'rb') as contents:
+        while True:
+            chunk = contents.read(READ_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _length(message, offset):
+    '''the 3 octet length at the start of a section'''
+    return struct.unpack('>I', '\0' + message[offset:offset+3])[0]
+
+def data_section(message):
+    '''section 4 of a BUFR message, which holds the reports themselves, or the whole
+    message if the sections don't add up'''
+    try:
+        edition = ord(message[7])
+        offset = bufr_index.SECTION0_LENGTH
+        #the optional section 2 is flagged in octet 8 of section 1, octet 10 from edition 4
+        flags = ord(message[offset + (9 if edition >= 4 else 7)])
+        offset += _length(message, offset)
+        if flags & 0x80:
+            offset += _length(message, offset)
+        offset += _length(message, offset) #section 3
+        length = _length(message, offset)
+    except (IndexError, struct.error):
+        return message
+    if length < 4 or offset + length > len(message) - len(bufr_index.END):
+        return message
+    return message[offset:offset + length]
+
+def message_digest(message):
+    '''the hash of the data section of a BUFR message'''
+    return HASH(data_section(message)).hexdigest()
+
+class SeenSet(object):
+    """Hashes seen in the last max_age seconds, at most max_entries of them (the oldest
+    go first). Hashes are added in memory, and kept in an append-only file at path once
+    committed; the file is rewritten once it has gathered too many forgotten lines"""
+    def __init__(self, path, max_entries=200000, max_age=7*24*3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.seen = collections.OrderedDict() #digest: time first seen, oldest first
+        self.uncommitted = set()
+        self.lines = 0
+        if os.path.exists(path):
+            with open(path, 'r') as seen_file:
+                for line in seen_file:
+                    parts = line.split()
+                    if not line.endswith('\n') or len(parts) != 2:
+                        continue
+                    self.seen.pop(parts[0], None)
+                    self.seen[parts[0]] = float(parts[1])
+                    self.lines += 1
+        self._evict(time.time())
+        self.seen_file = open(path, 'a')
+        LOGGER.info('loaded %d hashes from %s', len(self.seen), path)
+
+    def __len__(self):
+        return len(self.seen)
+
+    def __contains__(self, digest):
+        with self.lock:
+            self._evict(time.time())
+            return digest in self.seen
+
+    def _evict(self, now):
+        while self.seen:
+            digest, seen = next(self.seen.iteritems())
+            if len(self.seen) <= self.max_entries and now - seen <= self.max_age:
+                break
+            del self.seen[digest]
+            self.uncommitted.discard(digest)
+
+    def add(self, digest):
+        '''adds digest in memory, True if it hadn't been seen already'''
+        with self.lock:
+            now = time.time()
+            self._evict(now)
+            if digest in self.seen:
+                return False
+            self.seen[digest] = now
+            self.uncommitted.add(digest)
+            return True
+
+    def claimed(self, digest):
+        '''True if digest was added but hasn't been committed (or discarded) yet'''
+        with self.lock:
+            return digest in self.uncommitted
+
+    def commit(self, digests):
+        '''writes those of digests which were added but not yet committed to the file'''
+        with self.lock:
+            for digest in digests:
+                if digest in self.uncommitted:
+                    self.uncommitted.remove(digest)
+                    self.seen_file.write('%s %.0f\n' % (digest, self.seen[digest]))
+                    self.lines += 1
+            self.seen_file.flush()
+            if self.lines > 2 * len(self.seen) + 1000:
+                self._compact()
+
+    def discard(self, digests):
+        '''forgets digests which haven't been committed, e.g. of a file that then failed'''
+        with self.lock:
+            for digest in digests:
+                if digest in self.uncommitted:
+                    self.uncommitted.remove(digest)
+                    del self.seen[digest]
+
+    def _compact(self):
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as seen_file:
+            for digest, seen in self.seen.iteritems():
+                if digest not in self.uncommitted:
+                    seen_file.write('%s %.0f\n' % (digest, seen))
+        self.seen_file.close()
+        os.rename(temp, self.path)
+        self.seen_file = open(self.path, 'a')
+        self.lines = len(self.seen) - len(self.uncommitted)
+
+    def close(self):
+        self.seen_file.close()
+
+class Deduplicator(object):
+    """Decides what of a file needs decoding, using a SeenSet.
+    With per_message, BUFR files are checked message by message, otherwise (and for
+    files without BUFR messages, like metar) the whole file is.
+    With a journal, the hashes a file claims are committed once the journal has it
+    written to all of its destinations, and released if a write fails; without one
+    they stay in memory until finish() (or commit() or release()) is called once the
+    writers are done with the file.
+    A file skipped because of hashes another file has only claimed is kept, and
+    released files hand those back by retries() to be claimed again.
+    Counts the duplicate files and messages skipped"""
+    def __init__(self, seen, per_message=False, journal=None):
+        self.seen = seen
+        self.per_message = per_message
+        self.journal = journal
+        self.lock = threading.Lock() #for claims, skipped and retrying, and adding to seen
+        self.claims = {} #filename: digests neither committed nor released
+        self.skipped = {} #digest only claimed: files skipped (wholly or partly) for it
+        self.retrying = [] #files skipped for hashes which were then released
+        self.duplicate_files = 0
+        self.duplicate_messages = 0
+
+    def claim(self, filename, destinations=None):
+        '''None if filename is a duplicate, else (offsets, digests) where offsets are the
+        bufr_index offsets of the messages to decode (None for the whole file).
+        A file the journal has written to some but not all of destinations isn't checked,
+        its hashes are already committed or were never claimed'''
+        if self.journal is not None and destinations:
+            remaining = self.journal.remaining(filename, destinations)
+            if len(remaining) < len(destinations):
+                LOGGER.info('not checking %s for duplicates, it is partly written', filename)
+                return None, []
+        result = self._claim(filename)
+        if result is not None:
+            with self.lock:
+                self.claims[filename] = result[1]
+            if self.journal is not None and destinations:
+                self.journal.when_done(filename, destinations,
+                                       lambda: self.commit(filename),
+                                       lambda: self.release(filename))
+        return result
+
+    def _add(self, filename, digests):
+        '''adds digests to seen, returning which of them are new. Those which another
+        file has only claimed note filename as skipped for them'''
+        new = []
+        own = set() #a message repeated in filename is only skipped for its own claim
+        with self.lock:
+            for digest in digests:
+                if self.seen.add(digest):
+                    new.append(True)
+                    own.add(digest)
+                    continue
+                new.append(False)
+                if digest not in own and self.seen.claimed(digest):
+                    skipped = self.skipped.setdefault(digest, [])
+                    if filename not in skipped:
+                        skipped.append(filename)
+        return new
+
+    def _claim(self, filename):
+        if self.per_message:
+            with bufr_index.BufrIndex(filename) as index:
+                digests = [message_digest(index.message(each)) for each in range(len(index))]
+                offsets = index.offsets
+            if digests:
+                new = [each for each, added in enumerate(self._add(filename, digests))
+                       if added]
+                self.duplicate_messages += len(digests) - len(new)
+                if not new:
+                    self.duplicate_files += 1
+                    LOGGER.info('skipping %s, all of its messages have been seen', filename)
+                    return None
+                if len(new) < len(digests):
+                    LOGGER.info('decoding %d of the %d messages of %s, the rest have been seen',
+                                len(new), len(digests), filename)
+                    return [offsets[each] for each in new], [digests[each] for each in new]
+                return None, digests
+        digest = file_digest(filename)
+        if not self._add(filename, [digest])[0]:
+            self.duplicate_files += 1
+            LOGGER.info('skipping %s, it is a duplicate', filename)
+            return None
+        return None, [digest]
+
+    def commit(self, filename):
+        '''keeps the hashes filename claimed, now that it has been written'''
+        with self.lock:
+            digests = self.claims.pop(filename, None)
+            if digests:
+                self.seen.commit(digests)
+                for digest in digests:
+                    self.skipped.pop(digest, None)
+
+    def release(self, filename):
+        '''forgets the hashes filename claimed, so another copy of it is decoded. The
+        files skipped for them are handed back by retries()'''
+        with self.lock:
+            digests = self.claims.pop(filename, None)
+            if digests:
+                self.seen.discard(digests)
+                for digest in digests:
+                    for skipped in self.skipped.pop(digest, []):
+                        if skipped not in self.retrying:
+                            self.retrying.append(skipped)
+        if digests:
+            LOGGER.info('released the hashes of %s', filename)
+
+    def finish(self, filenames, failed=()):
+        '''once the writers are done with filenames: without a journal, commits the
+        hashes of those which were written and releases those in failed (with a journal
+        that has already happened, see claim)'''
+        if self.journal is not None:
+            return
+        failed = set(failed)
+        for filename in filenames:
+            if filename in failed:
+                self.release(filename)
+            else:
+                self.commit(filename)
+
+    def retries(self):
+        '''the files skipped for hashes which were later released, to be claimed (and
+        decoded) again, in the order they were skipped'''
+        with self.lock:
+            retrying, self.retrying = self.retrying, []
+        if retrying:
+            LOGGER.info('%d skipped files need decoding after all', len(retrying))
+        return retrying
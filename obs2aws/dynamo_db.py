@@ -1,7 +1,9 @@
 '''classes and methods for dealaing with dyanmodb'''
 import datetime
 import logging
+import threading
 import time
+import zlib
 
 import botocore
 import numpy
@@ -12,26 +14,51 @@ from . import tools
 
 LOGGER = logging.getLogger()
 IDENTIFIER = 'obs_id'
+#characters of the geohash in report_type_geohash, the hash key of the geohash index
+GEOHASH_PRECISION = 2
+#the primary key of the tables, see create_table
+KEY_ATTRIBUTES = ('obs_id', 'datetime')
+#the geohash index and the write capacity create_table provisions
+INDEX_NAME = 'RecordTypeGeohashIndex'
+WRITE_CAPACITY = 100
+INDEX_WRITE_CAPACITY = 200
+
+def attribute_value(value):
+    '''the DynamoDB attribute for value, None if value is not valid and should be
+    left out of the row'''
+    if value is not None and not isinstance(value, numpy.ma.core.MaskedConstant):
+        if isinstance(value, float):
+#            return decimal.Decimal("%.6f" % value)
+            return {'N':"%.6f" % value}
+        elif isinstance(value, int):
+            return {'N':str(value)}
+        else:
+            #DynamoDB will not tolerate empty strings, so we just dont
+            #add the column. Also omit hex strings encoding missing
+            if (value != '') and (value != len(value) * '\xff'):
+                return {'S':str(value)}
+    return None
 
 class ObsDBRow(dict):
-    '''a single report in dynamodb'''
+    '''a single report in dynamodb.
+    epoch is the report time in seconds since 1970, when the row has been given one'''
+    epoch = None
+
     def set_attribute(self, fieldname, value):
         '''Only adds the value to the row if value is valid'''
-        if value is not None and not isinstance(value, numpy.ma.core.MaskedConstant):
-            if isinstance(value, float):
-#                self[fieldname] = decimal.Decimal("%.6f" % value)
-                self[fieldname] = {'N':"%.6f" % value}
-            elif isinstance(value, int):
-                self[fieldname] = {'N':str(value)}
-            else:
-                #DynamoDB will not tolerate empty strings, so we just dont
-                #add the column. Also omit hex strings encoding missing
-                if (value != '') and (value != len(value) * '\xff'):
-                    self[fieldname] = {'S':str(value)}
-
+        attribute = attribute_value(value)
+        if attribute is not None:
+            self[fieldname] = attribute
 
     def set_report_time(self, index):
-        '''set datetime attribute if that succeeds delete other time fields'''
+        '''set datetime attribute if that succeeds delete other time fields.
+        A tools.EPOCH attribute becomes the datetime attribute and the epoch of the row'''
+        if tools.EPOCH in self:
+            self.epoch = int(self[tools.EPOCH]['N'])
+            del self[tools.EPOCH]
+            if 'datetime' not in self:
+                self.set_attribute('datetime',
+                                   time.strftime('%Y%m%d%H%M%S', time.gmtime(self.epoch)))
         result = 'datetime' in self
         if not result:
             try:
@@ -123,10 +150,260 @@ class ObsDBRow(dict):
         return result
 
 
+#the field which identifies the station of report types other than wmo stations,
+#  and the format of the suffix added to it for the identifier
+STATION_ID_FIELDS = {'metar':('CCCC', '_{report_type}'),
+                     'ascat':('satelliteIdentifier', '_{index}_{report_type}'),
+                     'amv':('satelliteIdentifier', '_{index}_{report_type}'),
+                     'ship':('shipOrMobileLandStationIdentifier', '_{report_type}'),
+                     'buoy':('marineObservingPlatformIdentifier', '_{report_type}'),
+                     'amdar':('aircraftRegistrationNumberOrOtherIdentification',
+                              '_{report_type}')}
+
+def _column_kind(values):
+    '''how a column of values is turned into DynamoDB attributes, like attribute_value'''
+    dtype = values.dtype.type
+    if issubclass(dtype, float):
+        return 'f'
+    elif issubclass(dtype, int):
+        return 'i'
+    elif issubclass(dtype, str):
+        return 's'
+    return 'a' # the column holds the attributes themselves
+
+def shard_number(obs_id, shards):
+    '''which of shards the rows of obs_id belong to, the same in every process'''
+    return (zlib.crc32(obs_id) & 0xffffffff) % shards
+
+class RowBatch(object):
+    """Rows for dynamodb kept as columns, one typed numpy array per attribute
+    with a boolean array of the rows which have that attribute. The DynamoDB
+    attributes ({'N':..} or {'S':..}) are only made when rows are taken out, as
+    ObsDBRow instances, by row() or iterating over the batch.
+    overlay holds attributes which every row has, like s3key and ttl, so each
+    destination can have its own view (with_overlay) without copying the columns.
+    epochs are the report times of the rows, see ObsDBRow.epoch"""
+    def __init__(self, length, overlay=None):
+        self.length = length
+        self.columns = {} # name -> (kind, values, present)
+        self.overlay = {} if overlay is None else overlay
+        self.epochs = None
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        rows = [ObsDBRow() for _ in range(self.length)]
+        for name in self.columns:
+            for ddb_row, attribute in zip(rows, self.column_attributes(name)):
+                if attribute is not None:
+                    ddb_row[name] = attribute
+        for each, ddb_row in enumerate(rows):
+            self._finish_row(ddb_row, each)
+        return iter(rows)
+
+    def _finish_row(self, ddb_row, index):
+        ddb_row.update(self.overlay)
+        if self.epochs is not None and self.epochs[index] is not numpy.ma.masked:
+            ddb_row.epoch = int(self.epochs[index])
+        return ddb_row
+
+    @staticmethod
+    def _attributes(kind, values):
+        if kind == 'f':
+            return [{'N':"%.6f" % value} for value in values.tolist()]
+        elif kind == 'i':
+            return [{'N':str(value)} for value in values.tolist()]
+        elif kind == 's':
+            return [{'S':value} for value in values.tolist()]
+        return list(values)
+
+    def column_attributes(self, name):
+        '''the attributes of column name as a list with None for the rows which don't
+        have it, or None if there is no such column'''
+        if name not in self.columns:
+            return None
+        kind, values, present = self.columns[name]
+        attributes = self._attributes(kind, values)
+        for each in numpy.flatnonzero(~present):
+            attributes[each] = None
+        return attributes
+
+    def set_column(self, name, values, present=None):
+        '''values, an array with one value for each row, become the attribute name
+        of the rows which are present and where the value is valid (see attribute_value)'''
+        values = numpy.asarray(values)
+        if present is None:
+            present = numpy.ones(self.length, dtype=bool)
+        kind = _column_kind(values)
+        if kind == 's':
+            #also omit empty strings and hex strings encoding missing
+            present = present & (numpy.char.strip(values, '\xff') != '')
+        elif kind == 'a':
+            attributes = numpy.empty(self.length, dtype=object)
+            attributes[:] = [attribute_value(value) if wanted else None
+                             for value, wanted in zip(values.tolist(), present)]
+            values = attributes
+            present = numpy.array([each is not None for each in attributes], dtype=bool)
+        self.columns[name] = (kind, values, present)
+
+    def remove_column(self, name):
+        '''removes column name if the batch has it'''
+        self.columns.pop(name, None)
+
+    def take(self, rows):
+        '''a new batch of only these rows (an index or boolean array)'''
+        batch = RowBatch(len(numpy.arange(self.length)[rows]), dict(self.overlay))
+        for name, (kind, values, present) in self.columns.iteritems():
+            batch.columns[name] = (kind, values[rows], present[rows])
+        if self.epochs is not None:
+            batch.epochs = self.epochs[rows]
+        return batch
+
+    def shard_numbers(self, shards):
+        '''for each row, which of shards it belongs to by the crc32 of its obs_id
+        (see shard_number). Rows without one are in shard 0'''
+        numbers = numpy.zeros(self.length, dtype=int)
+        attributes = self.column_attributes(IDENTIFIER)
+        if attributes is None and IDENTIFIER in self.overlay:
+            attributes = [self.overlay[IDENTIFIER]] * self.length
+        for each, attribute in enumerate(attributes or []):
+            if attribute is not None:
+                numbers[each] = shard_number(attribute['S'], shards)
+        return numbers
+
+    def with_overlay(self, **attributes):
+        '''a view of this batch, sharing its columns, where every row also has these
+        attributes. Like ObsDBRow.set_attribute, invalid values are left out'''
+        batch = RowBatch(self.length, dict(self.overlay))
+        batch.columns = self.columns
+        batch.epochs = self.epochs
+        for name, value in attributes.iteritems():
+            attribute = attribute_value(value)
+            if attribute is not None:
+                batch.overlay[name] = attribute
+        return batch
+
+    def _parsed_numbers(self, name, rows):
+        '''number attribute name of the rows (indexs) as floats, exactly as they will be
+        written. nan for rows that don't have it'''
+        attributes = self.column_attributes(name) or [None] * self.length
+        text = [attributes[row]['N'] if attributes[row] is not None else 'nan' for row in rows]
+        return numpy.array(text + ['nan']).astype(float)[:len(rows)]
+
+    def set_station_ids(self, report_type, indexs):
+        '''ObsDBRow.set_station_id for all of the rows, indexs being the report index
+        of each row. Returns a boolean array of the rows which now have an identifier.
+        The fields which made up the identifier are only removed by finish'''
+        ids = [None] * self.length
+        if report_type in ['synop', 'temp', 'pilot', 'radarvvp']:
+            blocks = self.column_attributes('blockNumber') or [None] * self.length
+            numbers = self.column_attributes('stationNumber') or [None] * self.length
+            for row, (block, number) in enumerate(zip(blocks, numbers)):
+                if block is not None and number is not None:
+                    block, number = int(block['N']), int(number['N'])
+                    if report_type in ['radarvvp', 'temp']:
+                        ids[row] = '%2.2d%3.3d_%s_%s' %(block, number, indexs[row], report_type)
+                    else:
+                        ids[row] = '%2.2d%3.3d_%s' %(block, number, report_type)
+            self._station_fields = ['blockNumber', 'stationNumber']
+        else:
+            if report_type is not None and report_type.startswith('amv'):
+                fields = STATION_ID_FIELDS['amv']
+            else:
+                fields = STATION_ID_FIELDS.get(report_type)
+            if fields is None:
+                LOGGER.error('error unknown report_type "%s"', report_type)
+                return numpy.zeros(self.length, dtype=bool)
+            fieldname, suffix = fields
+            stations = self.column_attributes(fieldname) or [None] * self.length
+            for row, station in enumerate(stations):
+                if station is not None:
+                    ids[row] = station[station.keys()[0]] + \
+                               suffix.format(index=indexs[row], report_type=report_type)
+            self._station_fields = [fieldname]
+        result = numpy.array([each is not None for each in ids], dtype=bool)
+        self.set_column(IDENTIFIER, numpy.array([each or '' for each in ids] + [''])[:-1],
+                        result)
+        return result
+
+    def has_station_locations(self, rows):
+        '''ObsDBRow.has_station_location for the rows (a boolean array).
+        Also keeps the latitudes and longitudes of those rows for finish'''
+        wanted = numpy.flatnonzero(rows)
+        lats = self._parsed_numbers('latitude', wanted)
+        lons = self._parsed_numbers('longitude', wanted)
+        with numpy.errstate(invalid='ignore'): #nan is never in range
+            located = (-90.0 <= lats) & (lats <= 90.0) & (-180 <= lons) & (lons < 180)
+        result = numpy.zeros(self.length, dtype=bool)
+        result[wanted[located]] = True
+        self._locations = numpy.full((self.length, 2), numpy.nan)
+        self._locations[wanted, 0] = lats
+        self._locations[wanted, 1] = lons
+        return result
+
+    def set_report_times(self, rows, indexs):
+        '''ObsDBRow.set_report_time for the rows (a boolean array), indexs being the
+        report index of each row. Returns a boolean array of the rows which now have
+        a datetime'''
+        datetimes = self.column_attributes('datetime') or [None] * self.length
+        epochs = numpy.ma.masked_all(self.length, dtype=numpy.int64)
+        if tools.EPOCH in self.columns:
+            _, values, present = self.columns[tools.EPOCH]
+            from_epoch = rows & present
+            epochs[from_epoch] = values[from_epoch]
+            timestamps = tools.epoch_to_timestamps(numpy.where(from_epoch, values, 0)).tolist()
+            for row in numpy.flatnonzero(from_epoch):
+                if datetimes[row] is None:
+                    datetimes[row] = {'S':timestamps[row]}
+        time_fields = [self.column_attributes(name) for name in tools.TIME_FIELDS]
+        for row in numpy.flatnonzero(rows):
+            if datetimes[row] is None:
+                #work out the time the old way, from the individual time fields
+                ddb_row = ObsDBRow([(name, attributes[row])
+                                    for name, attributes in zip(tools.TIME_FIELDS, time_fields)
+                                    if attributes is not None and attributes[row] is not None])
+                if ddb_row.set_report_time(indexs[row]):
+                    datetimes[row] = ddb_row['datetime']
+        result = rows & numpy.array([each is not None for each in datetimes], dtype=bool)
+        values = numpy.empty(self.length, dtype=object)
+        values[:] = datetimes
+        self.columns['datetime'] = ('a', values, result)
+        self.epochs = epochs
+        return result
+
+    def finish(self, rows, report_type):
+        '''keeps only the rows (a boolean array) which passed set_station_ids,
+        has_station_locations and set_report_times, removing the fields that went
+        into the identifier and datetime and adding report_type_geohash'''
+        locations = self._locations[rows]
+        batch = self.take(rows)
+        for name in self._station_fields + [tools.EPOCH] + tools.TIME_FIELDS:
+            batch.remove_column(name)
+        geohashes = tools.geohash_encode(locations[:, 0], locations[:, 1], GEOHASH_PRECISION)
+        batch.set_column('report_type_geohash', numpy.char.add(report_type + '_', geohashes))
+        return batch
+
+
+_CONVENTIONS = {} #status: byteified conventions
+_TABLE_NAMES = {} #(status, region, archive): table name
+
+def get_conventions(status):
+    '''the conventions for status, loaded once'''
+    conv = _CONVENTIONS.get(status)
+    if conv is None:
+        conv = _CONVENTIONS[status] = tools.byteify(utils.get_conventions(status))
+    return conv
+
+def clear_caches():
+    '''forgets the conventions and table names, so they are loaded again'''
+    _CONVENTIONS.clear()
+    _TABLE_NAMES.clear()
+
 def get_client_retry(status, region, hostlocation, role_name):
     """ Indefinitely try to get an Amazon client. """
     #may need backoff algorithm??
-    conv = tools.byteify(utils.get_conventions(status))
+    conv = get_conventions(status)
     keys_path = conv[status][hostlocation]['path_to_iam_keys']
     try:
         client = connections.get_client(
@@ -142,11 +419,23 @@ def get_client_retry(status, region, hostlocation, role_name):
 
 def get_table_name(status, region, archive=True):
     '''Name of the table.  For archives this contains the year'''
-    conv = tools.byteify(utils.get_conventions(status))
-    if archive:
-        tbl_name = conv[status][region]["archived_observations_database_prefix"]
-    else:
-        tbl_name = conv[status][region]["recent_observations_database_name"]
+    tbl_name = _TABLE_NAMES.get((status, region, archive))
+    if tbl_name is None:
+        conv = get_conventions(status)
+        if archive:
+            tbl_name = conv[status][region]["archived_observations_database_prefix"]
+        else:
+            tbl_name = conv[status][region]["recent_observations_database_name"]
+        _TABLE_NAMES[(status, region, archive)] = tbl_name
+    return tbl_name
+
+def get_archive_table(year, status, region):
+    '''Name of the archive table for year'''
+    key = (status, region, year)
+    tbl_name = _TABLE_NAMES.get(key)
+    if tbl_name is None:
+        tbl_name = _TABLE_NAMES[key] = get_table_name(status, region, archive=True).replace(
+            '<yyyy>', str(year))
     return tbl_name
 
 
@@ -161,9 +450,63 @@ def get_archive_tables(date, status, region, overlap=7):
     """
     years = {d.year for d in [date, date + datetime.timedelta(overlap),
                               date - datetime.timedelta(overlap)]}
-    table_archive = get_table_name(status, region, archive=True)
 
-    return (table_archive.replace('<yyyy>', str(year)) for year in years)
+    return (get_archive_table(year, status, region) for year in years)
+
+class TableProvisioner(object):
+    """Keeps track of which tables exist, checking for and creating the others in a
+    background thread so writers don't have to wait for create_table.
+    exists(table_name) and create(table_name) do the work, e.g. the methods of a writer"""
+    def __init__(self, exists, create):
+        self.exists = exists
+        self.create = create
+        self.lock = threading.Lock()
+        self.ready = set()
+        self.provisioning = {} #table_name: threading.Event set once it is ready or failed
+
+    def is_ready(self, table_name):
+        '''True if table_name exists, otherwise makes sure it is being provisioned'''
+        if table_name in self.ready:
+            return True
+        self.provision(table_name)
+        return False
+
+    def provision(self, table_name):
+        '''starts provisioning table_name in the background, if it isn't ready or already
+        being provisioned'''
+        with self.lock:
+            if table_name in self.ready or table_name in self.provisioning:
+                return
+            done = self.provisioning[table_name] = threading.Event()
+        thread = threading.Thread(target=self._provision, args=(table_name, done),
+                                  name='provision-' + table_name)
+        thread.daemon = True
+        thread.start()
+
+    def _provision(self, table_name, done):
+        try:
+            if not self.exists(table_name):
+                self.create(table_name)
+            with self.lock:
+                self.ready.add(table_name)
+        except:
+            LOGGER.error('failed to provision table %s', table_name, exc_info=True)
+        finally:
+            with self.lock:
+                del self.provisioning[table_name]
+            done.set()
+
+    def wait(self, table_name, timeout=None):
+        '''waits for table_name to be provisioned, True if it is ready'''
+        with self.lock:
+            done = self.provisioning.get(table_name)
+        if done is None and table_name not in self.ready:
+            self.provision(table_name)
+            with self.lock:
+                done = self.provisioning.get(table_name)
+        if done is not None:
+            done.wait(timeout)
+        return table_name in self.ready
 
 
 def create_table(table_name, client):
@@ -178,8 +521,8 @@ def create_table(table_name, client):
         TableName=table_name,
         KeySchema=[{'AttributeName': 'obs_id', 'KeyType': 'HASH'},
                    {'AttributeName': 'datetime', 'KeyType': 'RANGE'}],
-        ProvisionedThroughput={'ReadCapacityUnits': 10, 'WriteCapacityUnits': 100},
-        GlobalSecondaryIndexes=[{'IndexName':'RecordTypeGeohashIndex',
+        ProvisionedThroughput={'ReadCapacityUnits': 10, 'WriteCapacityUnits': WRITE_CAPACITY},
+        GlobalSecondaryIndexes=[{'IndexName':INDEX_NAME,
                                  'KeySchema':[{'AttributeName': 'report_type_geohash',
                                                'KeyType': 'HASH'},
                                               {'AttributeName': 'datetime',
@@ -187,12 +530,23 @@ def create_table(table_name, client):
                                  'Projection': {
                                      'ProjectionType': 'ALL'
                                  },
-                                 'ProvisionedThroughput':{'ReadCapacityUnits': 10,
-                                                          'WriteCapacityUnits': 200}}])
+                                 'ProvisionedThroughput':{
+                                     'ReadCapacityUnits': 10,
+                                     'WriteCapacityUnits': INDEX_WRITE_CAPACITY}}])
     client.get_waiter('table_exists').wait(TableName=table_name)
     LOGGER.info('created table: %s=%s', table_name, str(table))
     return table
 
+def write_capacities(description):
+    '''the provisioned write capacity of a table and of its indexes, as
+    (units, {index_name: units}), from describe_table. 0 means on demand'''
+    table = description.get('Table', description)
+    units = table.get('ProvisionedThroughput', {}).get('WriteCapacityUnits', 0)
+    indexes = dict((index['IndexName'],
+                    index.get('ProvisionedThroughput', {}).get('WriteCapacityUnits', 0))
+                   for index in table.get('GlobalSecondaryIndexes', []))
+    return units, indexes
+
 def enable_time_to_live(table_name, client, enabled=True, attribute='ttl'):
     """enable time to live on the specified table"""
     try:
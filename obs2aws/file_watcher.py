@@ -0,0 +1,248 @@
+"""
+Finds observation files as they arrive, for running as a daemon rather than globbing
+the whole spool on each run (see obs2aws.find_files_to_process).
+The directories of the glob patterns are watched with inotify, or polled where
+inotify isn't available, and new files are kept in a heap ordered by the timestamp
+in their names.
+"""
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import glob
+import heapq
+import logging
+import os
+import select
+import struct
+import time
+
+LOGGER = logging.getLogger()
+
+#inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct('iIII')
+
+#only completely written files are picked up
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+
+
+def is_obs_file(filename):
+    '''observation files have at least one underscore in their basename'''
+    return '_' in os.path.basename(filename)
+
+def timestamp_key(filename):
+    '''the timestamp in the basename of an observation file, to sort them by'''
+    return os.path.basename(filename).split('_')[1]
+
+class PendingFiles(object):
+    """observation files waiting to be processed, popped oldest timestamp first.
+    A file already waiting isn't added again"""
+    def __init__(self):
+        self.heap = []
+        self.waiting = set()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, filename):
+        '''adds filename, True if it wasn't already waiting'''
+        if filename in self.waiting or not is_obs_file(filename):
+            return False
+        heapq.heappush(self.heap, (timestamp_key(filename), filename))
+        self.waiting.add(filename)
+        return True
+
+    def discard(self, filename):
+        '''forgets filename if it's waiting, e.g. when it has been removed'''
+        if filename in self.waiting:
+            self.waiting.remove(filename)
+            self.heap = [entry for entry in self.heap if entry[1] != filename]
+            heapq.heapify(self.heap)
+
+    def pop_all(self):
+        '''all of the waiting files, oldest first'''
+        result = [heapq.heappop(self.heap)[1] for _ in range(len(self.heap))]
+        self.waiting.clear()
+        return result
+
+class _Inotify(object):
+    """the inotify calls of libc"""
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, directory, mask):
+        '''the watch descriptor of directory'''
+        wd = self.libc.inotify_add_watch(self.fd, directory, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), directory)
+        return wd
+
+    def read(self, timeout):
+        '''the (wd, mask, name) events, waiting up to timeout seconds for any'''
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError, err:
+            if err.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class DirectoryWatcher(object):
+    """Watches the directories of patterns (glob patterns, as for find_files_to_process)
+    for new observation files which match them.
+    batches() gives the files found so far in timestamp order, starting with the files
+    already there, then whatever arrives, until stop() is called.
+    Without inotify the directories are listed every poll_seconds instead, and a file
+    is only taken once its size has stayed the same between two listings.
+    Everything is also rescanned every rescan_seconds in case an event was missed"""
+    def __init__(self, patterns, poll_seconds=5.0, rescan_seconds=600.0):
+        self.patterns = patterns
+        self.poll_seconds = poll_seconds
+        self.rescan_seconds = rescan_seconds
+        self.pending = PendingFiles()
+        self.inotify = None
+        self.watches = {} #wd: directory
+        self.sizes = {} #filename: size at the last listing, when polling
+        self.taken = set() #files given out by wait() which are still there
+        self.stopped = False
+        self.last_scan = None
+
+    def directories(self):
+        '''the existing directories the patterns can match files in'''
+        result = set()
+        for pattern in self.patterns:
+            for directory in glob.glob(os.path.dirname(pattern) or '.'):
+                if os.path.isdir(directory):
+                    result.add(directory)
+        return sorted(result)
+
+    def matches(self, filename):
+        '''True if filename is an observation file matching one of the patterns'''
+        return (is_obs_file(filename) and
+                any(fnmatch.fnmatch(filename, pattern) for pattern in self.patterns))
+
+    def start(self):
+        '''starts watching, then queues the files already there'''
+        try:
+            self.inotify = _Inotify()
+        except (AttributeError, OSError), err:
+            LOGGER.warning('inotify is not available (%s), polling every %.1fs instead',
+                           err, self.poll_seconds)
+            self.inotify = None
+        self.scan()
+
+    def scan(self):
+        '''queues the matching files which haven't been taken yet, adding watches for any
+        new directories'''
+        if self.inotify is not None:
+            watched = set(self.watches.itervalues())
+            for directory in self.directories():
+                if directory not in watched:
+                    try:
+                        self.watches[self.inotify.add_watch(directory, WATCH_MASK)] = directory
+                    except OSError, err:
+                        LOGGER.warning('could not watch %s: %s', directory, err)
+        listing = set()
+        for pattern in self.patterns:
+            listing.update(filename for filename in glob.glob(pattern)
+                           if self.matches(filename))
+        sizes = {}
+        for filename in listing - self.taken:
+            if self.inotify is not None or self.last_scan is None:
+                self.pending.push(filename)
+                continue
+            #when polling, a new file may still be being written
+            try:
+                sizes[filename] = os.path.getsize(filename)
+            except OSError: #removed since the glob
+                continue
+            if self.sizes.get(filename) == sizes[filename]:
+                self.pending.push(filename)
+        self.sizes = sizes
+        self.taken &= listing
+        self.last_scan = time.time()
+
+    def wait(self, timeout=None):
+        '''the queued files, oldest first, waiting up to timeout seconds (poll_seconds by
+        default) for some to arrive if there are none'''
+        if timeout is None:
+            timeout = self.poll_seconds
+        if not self.pending:
+            if self.inotify is None:
+                time.sleep(timeout)
+                self.scan()
+            else:
+                self._read_events(timeout)
+                if time.time() - self.last_scan > self.rescan_seconds:
+                    self.scan()
+        filenames = self.pending.pop_all()
+        self.taken.update(filenames)
+        return filenames
+
+    def _read_events(self, timeout):
+        '''queues the files which the inotify events say are new'''
+        for wd, mask, name in self.inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                LOGGER.warning('inotify queue overflowed, rescanning')
+                self.scan()
+                continue
+            if mask & IN_IGNORED: #the directory went away
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            filename = os.path.join(directory, name)
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self.pending.discard(filename)
+                self.taken.discard(filename)
+            elif self.matches(filename): #even if taken, it has been written again
+                self.pending.push(filename)
+
+    def batches(self):
+        '''the files as they arrive, as lists in timestamp order, until stop() is called'''
+        if self.last_scan is None:
+            self.start()
+        while not self.stopped:
+            filenames = self.wait()
+            if filenames:
+                LOGGER.info('%d new files to process', len(filenames))
+                yield filenames
+
+    def stop(self):
+        '''makes batches() finish, after at most poll_seconds'''
+        self.stopped = True
+
+    def close(self):
+        '''stops watching'''
+        self.stop()
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        self.watches = {}
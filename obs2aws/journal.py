@@ -0,0 +1,129 @@
+"""
+An append-only record of which destinations each observation file has been completely
+written to, so a run that dies part way through can be restarted without redoing
+the writes that finished.
+Destinations are named 'ddb:<key>' and 's3:<key>' for the keys of the ddb and s3
+queues (e.g. 'ddb:recent', 's3:archive'), and 'csv'.
+"""
+import logging
+import os
+import threading
+
+LOGGER = logging.getLogger()
+
+CSV = 'csv'
+
+
+def ddb_destination(key):
+    '''the journal name of the ddb queue with key'''
+    return 'ddb:' + key
+
+def s3_destination(key):
+    '''the journal name of the s3 queue with key'''
+    return 's3:' + key
+
+def file_destinations(report_type, keys):
+    '''all of the destinations a file of report_type is written to, for the keys of the
+    ddb and s3 queues'''
+    result = [ddb_destination(key) for key in keys] + [s3_destination(key) for key in keys]
+    if report_type == 'ascat':
+        result.append(CSV)
+    return result
+
+def file_version(filename):
+    '''identifies the contents of filename, so a file written again under the same name
+    isn't taken as done'''
+    stat = os.stat(filename)
+    return '%d-%d' % (stat.st_size, int(stat.st_mtime))
+
+class ProgressJournal(object):
+    """The file at path has a line 'filename<tab>version<tab>destination' for each
+    destination a file has been written to. Lines are flushed, and synced to disk if
+    sync, as they are recorded; a partly written last line is ignored when loading"""
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.done = {} #(filename, version): set of destinations
+        self.waiting = {} #filename: (set of destinations still to do, done, failed)
+        if os.path.exists(path):
+            with open(path, 'r') as journal:
+                for line in journal:
+                    parts = line.rstrip('\n').split('\t')
+                    if not line.endswith('\n') or len(parts) != 3:
+                        LOGGER.warning('ignoring incomplete line in %s: %r', path, line)
+                        continue
+                    self.done.setdefault((parts[0], parts[1]), set()).add(parts[2])
+            LOGGER.info('loaded progress of %d files from %s', len(self.done), path)
+        self.journal = open(path, 'a')
+
+    def _key(self, filename):
+        try:
+            return filename, file_version(filename)
+        except OSError:
+            return filename, ''
+
+    def remaining(self, filename, destinations):
+        '''those of destinations which filename hasn't been written to'''
+        with self.lock:
+            done = self.done.get(self._key(filename), ())
+        return [destination for destination in destinations if destination not in done]
+
+    def when_done(self, filename, destinations, done, failed=None):
+        '''calls done() once filename has been recorded for all of destinations (now, if
+        it already has), or failed() if record_failure() is called for it first'''
+        remaining = set(self.remaining(filename, destinations))
+        if not remaining:
+            done()
+            return
+        with self.lock:
+            self.waiting[filename] = (remaining, done, failed)
+
+    def record(self, filename, destination):
+        '''records that filename has been completely written to destination'''
+        key = self._key(filename)
+        finished = None
+        with self.lock:
+            waiter = self.waiting.get(filename)
+            if waiter is not None:
+                waiter[0].discard(destination)
+                if not waiter[0]:
+                    del self.waiting[filename]
+                    finished = waiter[1]
+            done = self.done.setdefault(key, set())
+            if destination not in done:
+                done.add(destination)
+                self.journal.write('%s\t%s\t%s\n' % (key[0], key[1], destination))
+                self.journal.flush()
+                if self.sync:
+                    os.fsync(self.journal.fileno())
+        if finished is not None:
+            finished()
+
+    def record_failure(self, filename, destination):
+        '''notes that filename couldn't be written to destination. Nothing is written,
+        a later run retries it, but the failed() of when_done() is called'''
+        LOGGER.debug('%s was not written to %s', filename, destination)
+        with self.lock:
+            waiter = self.waiting.pop(filename, None)
+        if waiter is not None and waiter[2] is not None:
+            waiter[2]()
+
+    def compact(self):
+        '''rewrites the journal without the files which have gone, e.g. after make_links'''
+        with self.lock:
+            self.done = dict((key, destinations) for key, destinations in self.done.iteritems()
+                             if self._key(key[0]) == key)
+            temp = self.path + '.tmp'
+            with open(temp, 'w') as journal:
+                for (filename, version), destinations in sorted(self.done.iteritems()):
+                    for destination in sorted(destinations):
+                        journal.write('%s\t%s\t%s\n' % (filename, version, destination))
+                journal.flush()
+                os.fsync(journal.fileno())
+            self.journal.close()
+            os.rename(temp, self.path)
+            self.journal = open(self.path, 'a')
+
+    def close(self):
+        self.journal.close()
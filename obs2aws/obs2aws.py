@@ -6,16 +6,17 @@ Created on Thu Jan 19 14:41:19 2017
 @author: Cory
 """
 #standard python library
-import copy
 import datetime
 import glob
+import itertools
 import logging
+import multiprocessing
 import numpy
 import os
+import Queue
 import traceback
 
 #third party
-import Geohash
 import simplejson
 
 #this package
@@ -23,73 +24,214 @@ from . import tools
 from . import decode
 from . import upload_to_s3
 from . import dynamo_db
+from . import file_watcher
+from . import journal as progress
 
 
 LOGGER = logging.getLogger()
+#how often writer_thread sends the batches of an idle batching writer which have
+#waited this long
+FLUSH_SECONDS = 5.0
 
 
 
 def decode_file_and_populate_writing_queues(filename, field_lists, report_type,
                                             s3_base_dict, ddb_queues,
                                             csv_queue, s3queues, failed,
-                                            ddb_recent_lifespan='3d'):
+                                            ddb_recent_lifespan='3d', header_filter=None,
+                                            journal=None, dedup=None, workers=1, pool=None):
     """decodes a raw observation file and populates queues for ddb, s3,
-    and csv writing.
+    and csv writing. The ddb and csv queues get one (filename, batches) item for the file,
+    batches being a list of dynamo_db.RowBatch.
     Files which fail to decode will be appended to the failed list.
-    ddb_queues and s3queus are dictionaries which MUST have the same keys"""
+    ddb_queues and s3queus are dictionaries which MUST have the same keys
+    header_filter is an optional decode.HeaderFilter for the BUFR messages, and with
+    workers > 1 the messages of a BUFR file are decoded by that many processes, those
+    of pool if it is given (see start_decoders)
+    With a journal.ProgressJournal, only the destinations the file hasn't already been
+    written to are queued, and a file which is done isn't decoded at all
+    With a dedup.Deduplicator, duplicates of files (or messages) already seen are
+    dropped before decoding. Without a journal, call dedup.finish with filename once
+    the writers are done with it"""
+    destinations = progress.file_destinations(report_type, s3_base_dict)
+    if journal is not None and not journal.remaining(filename, destinations):
+        LOGGER.info('skipping %s, it has already been written everywhere', filename)
+        return
+    offsets = None
     try:
-        _, timestamp, gtsheader, file_ext = tools.parse_filename(filename)
-        bounding_box, times, ddb_rows = get_s3keyinfo_ddb_rows(filename,
-                                                               field_lists,
-                                                               report_type,
-                                                               timestamp)
-        if bounding_box and times:
-            #there is only one ascat csv destination
-            if report_type == 'ascat':
-                for ddb_row in ddb_rows:
-                    csv_queue.put((filename, ddb_row))
-
-            #work out the expiry date for DDB recent items
-            secs = tools.parse_duration_to_seconds(ddb_recent_lifespan)
-            if secs is not None:
-                #ttl must be in UTC of course
-                ttl_datetime = datetime.datetime.utcnow() + datetime.timedelta(seconds=secs)
-                ttl = (ttl_datetime-datetime.datetime(1970, 1, 1)).total_seconds()
-                LOGGER.debug('setting ttl to %s (%s)', ttl_datetime, ttl)
-            else:
-                ttl = None
-
-            #potentially both recent and archive s3 and DDB destinations
-            for key, s3_base in s3_base_dict.iteritems():
-                s3key = upload_to_s3.get_s3key(s3_base, report_type, gtsheader,
-                                               file_ext, bounding_box, times)
-                if s3key.startswith('s3://'):
-                    s3queues[key].put((filename, s3key));
-                
-                indexi = 0;
-                for ddb_row in ddb_rows:
-                    ddb_row_copy = copy.copy(ddb_row)
-                    ddb_row_copy.set_attribute('s3key', s3key) #copes with blank
-                    
-                    if key == "recent":
-                        ddb_row_copy.set_attribute('ttl', ttl) #copes with None
-                    ddb_queues[key].put((filename, ddb_row_copy));
-                    #if key == "recent":
-                    #    ddb_row_copy.set_attribute('ttl', ttl) #copes with None
-                        #indexi = indexi + 1;
-                        #print indexi
-                    
-                    #print key + ': ' + str(ddb_queues[key].get(False));
-                    
-                    #if key == "recent":
-                    #    ddb_row_copy.set_attribute('ttl', ttl) #copes with None
-
+        if dedup is not None:
+            claim = dedup.claim(filename, destinations)
+            if claim is None:
+                return
+            offsets = claim[0]
+        _, timestamp, _, _ = tools.parse_filename(filename)
+        bounding_box, times, ddb_batches = get_s3keyinfo_ddb_rows(filename,
+                                                                  field_lists,
+                                                                  report_type,
+                                                                  timestamp,
+                                                                  header_filter,
+                                                                  offsets, workers, pool)
+        populate_writing_queues(filename, report_type, bounding_box, times, ddb_batches,
+                                s3_base_dict, ddb_queues, csv_queue, s3queues,
+                                ddb_recent_lifespan, journal)
     except:
         LOGGER.error("failed to decode file %s", filename)
         LOGGER.error(traceback.format_exc())
         failed.append(filename)
+        if dedup is not None:
+            dedup.release(filename)
         return
 
+def populate_writing_queues(filename, report_type, bounding_box, times, ddb_batches,
+                            s3_base_dict, ddb_queues, csv_queue, s3queues,
+                            ddb_recent_lifespan='3d', journal=None):
+    """populates the queues for ddb, s3 and csv writing with what
+    get_s3keyinfo_ddb_rows made of a file, see decode_file_and_populate_writing_queues"""
+    _, _, gtsheader, file_ext = tools.parse_filename(filename)
+    remaining = progress.file_destinations(report_type, s3_base_dict)
+    if journal is not None:
+        remaining = journal.remaining(filename, remaining)
+    if bounding_box and times:
+        #there is only one ascat csv destination
+        if report_type == 'ascat' and progress.CSV in remaining:
+            csv_queue.put((filename, ddb_batches))
+
+        #work out the expiry date for DDB recent items
+        secs = tools.parse_duration_to_seconds(ddb_recent_lifespan)
+        if secs is not None:
+            #ttl must be in UTC of course
+            ttl_datetime = datetime.datetime.utcnow() + datetime.timedelta(seconds=secs)
+            ttl = (ttl_datetime-datetime.datetime(1970, 1, 1)).total_seconds()
+            LOGGER.debug('setting ttl to %s (%s)', ttl_datetime, ttl)
+        else:
+            ttl = None
+
+        #potentially both recent and archive s3 and DDB destinations
+        for key, s3_base in s3_base_dict.iteritems():
+            s3key = upload_to_s3.get_s3key(s3_base, report_type, gtsheader,
+                                           file_ext, bounding_box, times)
+            if s3key.startswith('s3://'):
+                if progress.s3_destination(key) in remaining:
+                    s3queues[key].put((filename, s3key))
+            elif journal is not None: #nothing to upload
+                journal.record(filename, progress.s3_destination(key))
+
+            #each destination gets its own view of the rows, not a copy
+            if key == "recent":
+                overlay = {'s3key':s3key, 'ttl':ttl} #copes with blank and None
+            else:
+                overlay = {'s3key':s3key}
+            if progress.ddb_destination(key) in remaining:
+                ddb_queues[key].put((filename, [batch.with_overlay(**overlay)
+                                                for batch in ddb_batches]))
+    elif journal is not None:
+        #nothing will ever be written
+        for destination in remaining:
+            journal.record(filename, destination)
+
+def start_decoders(workers):
+    """a pool of workers processes for decode_files_and_populate_writing_queues, or None
+    if it can't be started. Start it once per run, before the writer threads, so the
+    processes don't inherit locks held by those threads"""
+    try:
+        return multiprocessing.Pool(workers)
+    except OSError:
+        LOGGER.warning('could not start %d decoding processes', workers)
+        return None
+
+def _decode_file_job(job, pool=None):
+    """decoder process worker: what get_s3keyinfo_ddb_rows makes of one file, as
+    (filename, report_type, bounding_box, times, ddb_batches, error) where error is
+    the traceback if that failed. Also run in this process, with the pool decoding the
+    messages"""
+    filename, field_lists, report_type, header_filter, offsets, workers = job
+    try:
+        _, timestamp, _, _ = tools.parse_filename(filename)
+        bounding_box, times, ddb_batches = get_s3keyinfo_ddb_rows(filename,
+                                                                  field_lists,
+                                                                  report_type,
+                                                                  timestamp,
+                                                                  header_filter,
+                                                                  offsets, workers, pool)
+        return filename, report_type, bounding_box, times, ddb_batches, None
+    except:
+        return filename, report_type, None, None, None, traceback.format_exc()
+
+def decode_files_and_populate_writing_queues(filenames, field_lists_by_type,
+                                             s3_base_dict, ddb_queues,
+                                             csv_queue, s3queues, failed,
+                                             ddb_recent_lifespan='3d', header_filter=None,
+                                             pool=None, journal=None, dedup=None,
+                                             workers=1):
+    """decode_file_and_populate_writing_queues for each of filenames, in order, e.g. from
+    find_files_to_process. The report type of a file comes from its name and its field
+    lists from field_lists_by_type (report_type: field_lists).
+    With a pool from start_decoders the files are decoded by its processes, while
+    this process fills the queues with the results in the order of filenames, or with
+    workers > 1 this process decodes the files and the pool's processes the messages of
+    each BUFR file. Without a pool, workers > 1 starts that many processes for each file.
+    Files which fail to decode will be appended to the failed list.
+    With a journal.ProgressJournal, files which are done aren't decoded and only the
+    destinations still to do are queued.
+    With a dedup.Deduplicator, duplicates of files (or messages) already seen are
+    dropped before decoding. Without a journal, call dedup.finish with filenames once
+    the writers are done with them, as watch_files_and_populate_writing_queues does."""
+    jobs = []
+    if dedup is not None:
+        duplicate_files, duplicate_messages = dedup.duplicate_files, dedup.duplicate_messages
+    for filename in filenames:
+        try:
+            report_type = tools.parse_filename(filename)[0]
+        except (IndexError, ValueError):
+            report_type = None
+        if report_type not in field_lists_by_type:
+            LOGGER.error("no field lists for the report type of file %s", filename)
+            failed.append(filename)
+            continue
+        destinations = progress.file_destinations(report_type, s3_base_dict)
+        if journal is not None and not journal.remaining(filename, destinations):
+            LOGGER.info('skipping %s, it has already been written everywhere', filename)
+            continue
+        offsets = None
+        if dedup is not None:
+            try:
+                claim = dedup.claim(filename, destinations)
+            except:
+                LOGGER.error("failed to check %s for duplicates", filename)
+                LOGGER.error(traceback.format_exc())
+                failed.append(filename)
+                continue
+            if claim is None:
+                continue
+            offsets = claim[0]
+        jobs.append((filename, field_lists_by_type[report_type], report_type, header_filter,
+                     offsets, workers))
+    if dedup is not None:
+        LOGGER.info('skipped %d duplicate files and %d duplicate messages',
+                    dedup.duplicate_files - duplicate_files,
+                    dedup.duplicate_messages - duplicate_messages)
+
+    if pool is None:
+        results = itertools.imap(_decode_file_job, jobs)
+    elif workers > 1:
+        results = (_decode_file_job(job, pool) for job in jobs)
+    else:
+        results = pool.imap(_decode_file_job, jobs)
+    for filename, report_type, bounding_box, times, ddb_batches, error in results:
+        if error is None:
+            try:
+                populate_writing_queues(filename, report_type, bounding_box, times,
+                                        ddb_batches, s3_base_dict, ddb_queues, csv_queue,
+                                        s3queues, ddb_recent_lifespan, journal)
+            except:
+                error = traceback.format_exc()
+        if error is not None:
+            LOGGER.error("failed to decode file %s", filename)
+            LOGGER.error(error)
+            failed.append(filename)
+            if dedup is not None:
+                dedup.release(filename)
+
 def find_files_to_process(patterns):
     '''finds all of the observation files. Files must have a basename
     which has at least one underscore in it and a timestamp is the second element
@@ -97,38 +239,147 @@ def find_files_to_process(patterns):
     result = []
     for pattern in patterns:
         for new_file in glob.glob(pattern):
-            if '_' in os.path.basename(new_file):
+            if file_watcher.is_obs_file(new_file):
                 result.append(new_file)
 
-    result.sort(key=lambda x: os.path.basename(x).split('_')[1])
+    result.sort(key=file_watcher.timestamp_key)
     return result
 
-
-def get_s3keyinfo_ddb_rows(filename, field_lists, report_type, timestamp):
+def watch_files_and_populate_writing_queues(watcher, field_lists_by_type, s3_base_dict,
+                                            ddb_queues, csv_queue, s3queues, failed,
+                                            ddb_recent_lifespan='3d', header_filter=None,
+                                            pool=None, processed=None, journal=None,
+                                            dedup=None, workers=1):
+    """the daemon version of find_files_to_process followed by
+    decode_files_and_populate_writing_queues: decodes the files that watcher, a
+    file_watcher.DirectoryWatcher, finds as they arrive, oldest first, until
+    watcher.stop() is called.
+    processed, if given, is called with each list of files once the writers have
+    finished with them (the queues are joined first, so the writer threads or engine
+    must call task_done for each item, as they do), e.g. to link them into the work
+    directories with make_links.
+    With a dedup.Deduplicator the queues are joined after each list too, so that it
+    can keep the hashes of the files written (see Deduplicator.finish) and decode the
+    duplicates it skipped for files which then failed, before they are processed"""
+    try:
+        for filenames in watcher.batches():
+            to_decode = filenames
+            while to_decode:
+                decode_files_and_populate_writing_queues(to_decode, field_lists_by_type,
+                                                         s3_base_dict, ddb_queues,
+                                                         csv_queue, s3queues, failed,
+                                                         ddb_recent_lifespan, header_filter,
+                                                         pool, journal, dedup, workers)
+                if processed is not None or dedup is not None:
+                    for queue in ddb_queues.values() + s3queues.values() + [csv_queue]:
+                        queue.join()
+                if dedup is None:
+                    break
+                dedup.finish(to_decode, failed)
+                to_decode = dedup.retries()
+            if processed is not None:
+                processed(filenames)
+    finally:
+        watcher.close()
+
+
+def get_s3keyinfo_ddb_rows(filename, field_lists, report_type, timestamp, header_filter=None,
+                           offsets=None, workers=1, pool=None):
     """returns the ingredients for the prospective s3 key and list of
-    DynamoDB entries from a raw observation file"""
-    ddb_rows = []
-    messages = decode.decode_file(filename, report_type, field_lists)
-    LOGGER.debug('filename: %s #messages: %d', filename, len(messages))
-    bounding_box = upload_to_s3.get_bounding_box(messages)
+    DynamoDB entries, as a dynamo_db.RowBatch for each message, from a raw observation file.
+    Messages are turned into rows as they are decoded, so only one decoded
+    message is held at a time. offsets restricts a BUFR file to some of its messages,
+    and with workers > 1 its messages are decoded by that many processes, pool's if it is
+    given, see decode.decode_file"""
+    ddb_batches = []
+    bounding_box = upload_to_s3.BoundingBox()
+    nominal_times = upload_to_s3.NominalTimes()
+    each = 0
+    for data, report_count in decode.iter_decode_file(filename, report_type, field_lists,
+                                                      workers=workers,
+                                                      header_filter=header_filter,
+                                                      offsets=offsets, pool=pool):
+        bounding_box.add(data, report_count)
+        nominal_times.add(data, report_count)
+        batch = make_row_batch(data, report_count, report_type)
+        if len(batch) > 0:
+            ddb_batches.append(batch)
+        LOGGER.info('made %d rows from message[%d] in %s', len(batch), each, filename)
+        each += 1
+    LOGGER.debug('filename: %s #messages: %d', filename, each)
+    bounding_box = bounding_box.result()
     LOGGER.debug('bounding box: %s', bounding_box)
     times = {}
     if bounding_box:
-        times = upload_to_s3.get_nominal_times(messages, timestamp, datetime.datetime.utcnow())
+        times = nominal_times.result(timestamp, datetime.datetime.utcnow())
         LOGGER.debug('times: %s', times)
-        if times:
-            each = 0
-            for data, report_count in messages:
-                rows = make_dyndb_rows(data, report_count, report_type)
-                ddb_rows.extend(rows)
-                LOGGER.info('made %d rows from message[%d] in %s', len(rows), each, filename)
-                each += 1
-    return bounding_box, times, ddb_rows
-
-
-def make_dyndb_rows(data, report_count, report_type):
-    '''makes the rows for dynamodb upload'''
-    ###THIS COULD BE MADE MUCH FASTER WITH NUMPY VECTORISATION, PARTICULARLY FOR ASCAT
+    if not times:
+        #without a bounding box and times there is nothing to write
+        ddb_batches = []
+    return bounding_box, times, ddb_batches
+
+
+def report_positions(values, report_count, report_type):
+    """for each report, the position in values of the value that report takes or -1 if
+    it takes none:
+      one value per report - its own value
+      a single value - every report shares it
+      at least report_count values - the first valid one of the fieldsize values from
+        its own position
+      fewer values - its own value for the old report types, else the first value"""
+    length = len(values)
+    reports = numpy.arange(report_count)
+    if length == report_count:
+        return reports
+    elif length == 1:
+        return numpy.zeros(report_count, dtype=int)
+    elif length == 0:
+        return numpy.full(report_count, -1, dtype=int)
+    fieldsize = length // report_count
+    if fieldsize > 0:  # there are at least report_count values
+        #the first valid position at or after each position (length if there isn't one)
+        valid_positions = numpy.where(numpy.ma.getmaskarray(values), length,
+                                      numpy.arange(length))
+        first_valid = numpy.minimum.accumulate(valid_positions[::-1])[::-1][reports]
+        first_valid[first_valid >= reports + fieldsize] = -1
+        return first_valid
+    elif report_type in ["metar", "synop", "ship"]:
+        #for old report types we try to use the index(th) element
+        return numpy.where(reports < length, reports, 0)
+    # who really knows?  We'll use the first valid value
+    return numpy.zeros(report_count, dtype=int)
+
+def _gather(values, positions):
+    """values (a masked array) at positions as (data, present) arrays. Rows at
+    position -1, or where the value is masked, are not present"""
+    data = numpy.ma.getdata(values)
+    if len(data) == 0:
+        return numpy.zeros(len(positions), dtype=data.dtype), \
+               numpy.zeros(len(positions), dtype=bool)
+    present = (positions >= 0) & ~numpy.ma.getmaskarray(values)[positions]
+    return data[positions], present
+
+def selected_wind_vectors(selected_indexs, report_count):
+    """which ascat reports (wind vector cells) have a selected wind vector and, for each
+    of those, the position of that wind vector in the 4*report_count ambiguity fields.
+    Returns the two arrays (reports, positions)"""
+    #probably no scat data in the file at all if there are fewer indexs than reports
+    selected_indexs = selected_indexs[:report_count]
+    reports = numpy.arange(len(selected_indexs))
+    wis = numpy.ma.getdata(selected_indexs)
+    valid = ~numpy.ma.getmaskarray(selected_indexs) & (wis >= 1) & (wis <= 4)
+    if len(selected_indexs) < report_count or not valid.all():
+        # no windvector selected for these WVCs
+        LOGGER.debug('ascat: %i of %i reports have no selected wind vector - ignoring',
+                     report_count - numpy.count_nonzero(valid), report_count)
+    reports = reports[valid]
+    positions = report_count * (wis[valid].astype(int) - 1) + reports
+    return reports, positions
+
+def make_row_batch(data, report_count, report_type):
+    '''makes the rows for dynamodb upload as a dynamo_db.RowBatch.
+    Each report takes its value of every field (column), see report_positions, and
+    then rows without a station identifier, location or time are dropped'''
     #by_length is a dictionary where each key is a number and the corresponding value
     #   values is the list of fieldnames that have 'number' occurances in the file
 
@@ -138,8 +389,6 @@ def make_dyndb_rows(data, report_count, report_type):
     for name, values in data.items():
         by_length[len(values)].append(name)
 
-    #iterate through data, writing to live and archive DynamoDB tables
-
     # check the lengths of these numpy masked arrays are sensible
     for actual_length in by_length:
         if actual_length > 1 and (actual_length % report_count != 0):
@@ -149,79 +398,46 @@ def make_dyndb_rows(data, report_count, report_type):
                             actual_length, report_type,
                             report_count, by_length[actual_length])
 
-    rows = []
-    #Go through the fields in the file
-    for index in range(report_count):
-        ddb_row = dynamo_db.ObsDBRow()
-
-        # Simplest case: one value for each report
-        for fieldname in by_length[report_count]:
-            ddb_row.set_attribute(fieldname, data[fieldname][index])
-
-        # Add all of the "singleton" fields that occur once in the file to this row
-        if report_count > 1:
-            for fieldname in by_length[1]:
-                ddb_row.set_attribute(fieldname, data[fieldname][0])
-
-        # special ascat code
-        if report_type == 'ascat':
-            if not 4*report_count in by_length:
-                LOGGER.info('ascat data does not have 4*report_count(=%s) in by_length',
-                            4*report_count)
-                #no data for any of the selected wind vectors, give up
-                return rows
-
-            if index >= len(data["indexOfSelectedWindVector"]):
-                #probably no scat data in the file at all ... but keep trying
-                LOGGER.debug('ascat[%i] index >= len(indexOfSelectedWindVector):%i - ignoring',
-                             index, len(data["indexOfSelectedWindVector"]))
-                continue
-            wi = data["indexOfSelectedWindVector"][index]
-            if not 1 <= wi <= 4:
-                # no windvector selected for this WVC
-                LOGGER.debug('invalid selected index of %i for ascat[%i] - ignoring', wi, index)
-                continue
+    reports = numpy.arange(report_count)
+    columns = {}
+    # special ascat code
+    if report_type == 'ascat':
+        if not 4*report_count in by_length:
+            LOGGER.info('ascat data does not have 4*report_count(=%s) in by_length',
+                        4*report_count)
+            #no data for any of the selected wind vectors, give up
+            return dynamo_db.RowBatch(0)
+        reports, vector_positions = selected_wind_vectors(data["indexOfSelectedWindVector"],
+                                                          report_count)
+        #only include data from selected windfactor, gathered for the whole swath
+        for fieldname in by_length[4*report_count]:
+            columns[fieldname] = _gather(data[fieldname], vector_positions)
+        #ascat reports only take fields with one value each or a single value
+        wanted_lengths = set([1, report_count])
+    else:
+        wanted_lengths = by_length.keys()
+
+    for length in wanted_lengths:
+        for fieldname in by_length.get(length, []):
+            values = data[fieldname]
+            columns[fieldname] = _gather(values,
+                                         report_positions(values, report_count,
+                                                          report_type)[reports])
+
+    batch = dynamo_db.RowBatch(len(reports))
+    for fieldname, (values, present) in columns.iteritems():
+        batch.set_column(fieldname, values, present)
+
+    #We must set the station identifier, lat,lon, (evelation) and time.
+    indexs = reports.tolist()
+    accepted = batch.set_station_ids(report_type, indexs)
+    accepted = batch.has_station_locations(accepted)
+    accepted = batch.set_report_times(accepted, indexs)
+    return batch.finish(accepted, report_type)
 
-            #only include data from selected windfactor
-            for fieldname in by_length[4*report_count]:
-                value = data[fieldname][report_count * (wi-1) + index]
-                ddb_row.set_attribute(fieldname, value)
-
-        else: # for anything left over
-            for length in by_length:
-                if length not in [1, report_count]:
-                    for fieldname in by_length[length]:
-                        fieldsize = length / report_count
-                        if fieldsize > 0:  # there are at least report_count values
-                            validvalues = data[fieldname][index:index+fieldsize].compressed()
-                            if len(validvalues) > 0:
-                                ddb_row.set_attribute(fieldname, validvalues[0])
-
-                        #for old report types we try to use the index(th) element
-                        elif index < length and report_type in ["metar", "synop", "ship"]:
-                            ddb_row.set_attribute(fieldname, data[fieldname][index])
-
-                        # who really knows?  We'll use the first valid value
-                        else:
-                            ddb_row.set_attribute(fieldname, data[fieldname][0])
-                            if fieldname not in by_length[1]:
-                                by_length[1].append(fieldname)
-
-
-        #We must set the station identifier, lat,lon, (evelation) and time.
-        if ddb_row.set_station_id(report_type, index) and \
-           ddb_row.has_station_location() and \
-           ddb_row.set_report_time(index):
-
-            #add geohash
-            geo = Geohash.encode(float(ddb_row['latitude']['N']),
-                                 float(ddb_row['longitude']['N']),
-                                 2)
-            ddb_row.set_attribute('report_type_geohash', '{}_{}'.format(
-                report_type, geo))
-
-            rows.append(ddb_row)
-    return rows
+def make_dyndb_rows(data, report_count, report_type):
+    '''makes the rows for dynamodb upload, a list of dynamo_db.ObsDBRow'''
+    return list(make_row_batch(data, report_count, report_type))
 
 def make_links(src_obs_filenames, dest_work_dirs):
     """takes a list of source observation file paths, of the form 
@@ -259,31 +475,77 @@ def read_config(config_file=None):
     LOGGER.info('loaded configuration from %s', config_file)
     return config
 
-def s3_thread(in_queue, role_name, keys_path, s3_options, failed):
-    '''thread to upload to s3'''
+def s3_thread(in_queue, role_name, keys_path, s3_options, failed, journal=None,
+              destination=None):
+    '''thread to upload to s3.
+    Uploads are recorded in journal, a journal.ProgressJournal, as destination
+    (e.g. journal.s3_destination('recent')) if given, as are the failures'''
     while True:
         filename, s3key = in_queue.get()
         try:
             upload_to_s3.s3copy(filename, s3key, role_name, keys_path, s3_options)
+            if journal is not None:
+                journal.record(filename, destination)
         except:
             LOGGER.error("Failed to upload %s to %s", filename, s3key)
             LOGGER.error(traceback.format_exc())
-            failed.append(filename)
+            _add_failed([filename], failed, journal, destination)
         in_queue.task_done()
 
-def writer_thread(writer, in_queue, failed):
-    '''thread to write to either dynamodb or csv'''
+def writer_thread(writer, in_queue, failed, journal=None, destination=None):
+    '''thread to write to either dynamodb or csv.
+    Each item is (filename, rows) where rows are all of the rows from that file, as a
+    list of dynamo_db.RowBatch, or a single row. A file is only added to failed once.
+    Files all of whose rows were written are recorded in journal, a
+    journal.ProgressJournal, as destination (e.g. journal.ddb_destination('recent'))
+    if given, as are the failures.
+    Batching writers (those with a flush method, like the DynDBWriters) are given the
+    filename with each row, and are flushed when idle, on 'QUIT', and after each file
+    if there is a journal'''
+    batching = hasattr(writer, 'flush')
     while True:
-        item = in_queue.get()
+        try:
+            item = in_queue.get(timeout=FLUSH_SECONDS if batching else None)
+        except Queue.Empty:
+            _add_failed(writer.flush(FLUSH_SECONDS), failed, journal, destination)
+            continue
         if item == 'QUIT':
+            if batching:
+                _add_failed(writer.flush(), failed, journal, destination)
             in_queue.task_done()
             return
-        filename, line = item
-        try:
-            writer.write(line)
-        except:
-            LOGGER.error("Failed to write line from %s to %s. line: %s",
-                         filename, writer.__class__.__name__, line)
-            LOGGER.error(traceback.format_exc())
-            failed.append(filename)
+        filename, rows = item
+        if isinstance(rows, dict):
+            rows = [[rows]]
+        file_failed = False
+        for batch in rows:
+            for line in batch:
+                try:
+                    if batching:
+                        writer.write(line, filename)
+                    else:
+                        writer.write(line)
+                except:
+                    LOGGER.error("Failed to write line from %s to %s. line: %s",
+                                 filename, writer.__class__.__name__, line)
+                    LOGGER.error(traceback.format_exc())
+                    if not file_failed:
+                        _add_failed([filename], failed, journal, destination)
+                        file_failed = True
+        if batching:
+            #with a journal, the file is only done once its rows are all sent
+            flushed_failed = writer.flush(None if journal is not None else FLUSH_SECONDS)
+            file_failed = file_failed or filename in flushed_failed
+            _add_failed(flushed_failed, failed, journal, destination)
+        if journal is not None and not file_failed:
+            journal.record(filename, destination)
         in_queue.task_done()
+
+def _add_failed(filenames, failed, journal=None, destination=None):
+    '''adds those of filenames which aren't already in failed, telling journal that they
+    weren't written to destination if given'''
+    for filename in filenames:
+        if filename not in failed:
+            failed.append(filename)
+        if journal is not None:
+            journal.record_failure(filename, destination)
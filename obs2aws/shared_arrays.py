@@ -0,0 +1,107 @@
+"""
+Passes decoded messages, lists of (message_data, report_count) where message_data
+is a dictionary of numpy masked arrays, between processes through a memory mapped
+file instead of pickling every array.
+The file lives in /dev/shm where that exists, so it never touches the disk.
+Only a small layout description (names, dtypes, shapes and offsets) is pickled.
+Arrays of python objects can't be mapped, so they travel in the layout instead.
+"""
+import logging
+import mmap
+import os
+import tempfile
+
+import numpy
+
+LOGGER = logging.getLogger()
+
+SHARED_MEMORY_DIR = '/dev/shm'
+ALIGNMENT = 16
+
+
+def _shared_dir():
+    if os.path.isdir(SHARED_MEMORY_DIR):
+        return SHARED_MEMORY_DIR
+    return None # the default temporary directory
+
+def _write_aligned(shared_file, offset, array):
+    '''writes the bytes of array at the next aligned offset and returns
+    (array_offset, next_offset)'''
+    padding = -offset % ALIGNMENT
+    if padding:
+        shared_file.write('\0' * padding)
+    array_offset = offset + padding
+    shared_file.write(array.tostring())
+    return array_offset, array_offset + array.nbytes
+
+def export_messages(messages):
+    '''writes the arrays of messages into a new shared file.
+    Returns (path, layout) which import_messages turns back into messages'''
+    handle, path = tempfile.mkstemp(prefix='obs2aws_', suffix='.arrays', dir=_shared_dir())
+    layout = []
+    offset = 0
+    try:
+        with os.fdopen(handle, 'wb') as shared_file:
+            for message_data, report_count in messages:
+                fields = []
+                for name, values in message_data.iteritems():
+                    values = numpy.ma.asarray(values)
+                    if values.dtype.hasobject:
+                        fields.append((name, values, None, None, None, None))
+                        continue
+                    data = numpy.ascontiguousarray(values.data)
+                    data_offset, offset = _write_aligned(shared_file, offset, data)
+                    mask = numpy.ma.getmask(values)
+                    if mask is numpy.ma.nomask:
+                        mask_offset = None
+                    else:
+                        mask_offset, offset = _write_aligned(shared_file, offset,
+                                                             numpy.ascontiguousarray(mask))
+                    fields.append((name, values.fill_value, data.dtype.str, data.shape,
+                                   data_offset, mask_offset))
+                layout.append((fields, report_count))
+    except:
+        discard(path)
+        raise
+    return path, layout
+
+def _mapped_array(shared_map, dtype, shape, offset):
+    dtype = numpy.dtype(dtype)
+    if shared_map is None or dtype.itemsize * int(numpy.prod(shape)) == 0:
+        return numpy.empty(shape, dtype=dtype)
+    return numpy.ndarray(shape, dtype=dtype, buffer=shared_map, offset=offset)
+
+def import_messages(path, layout):
+    '''maps a file written by export_messages and returns the list of
+    (message_data, report_count). The file itself is removed straight away, the
+    arrays keep the (copy on write) mapping alive for as long as they need it'''
+    with open(path, 'rb') as shared_file:
+        size = os.fstat(shared_file.fileno()).st_size
+        if size:
+            shared_map = mmap.mmap(shared_file.fileno(), size, access=mmap.ACCESS_COPY)
+        else:
+            shared_map = None
+    discard(path)
+    messages = []
+    for fields, report_count in layout:
+        message_data = {}
+        for name, values_or_fill, dtype, shape, data_offset, mask_offset in fields:
+            if dtype is None: # an object array which came in the layout
+                message_data[name] = values_or_fill
+                continue
+            data = _mapped_array(shared_map, dtype, shape, data_offset)
+            if mask_offset is None:
+                mask = numpy.ma.nomask
+            else:
+                mask = _mapped_array(shared_map, numpy.bool_, shape, mask_offset)
+            message_data[name] = numpy.ma.masked_array(data, mask=mask,
+                                                       fill_value=values_or_fill)
+        messages.append((message_data, report_count))
+    return messages
+
+def discard(path):
+    '''removes a shared file whose messages are not wanted'''
+    try:
+        os.remove(path)
+    except OSError:
+        LOGGER.warning('could not remove shared array file %s', path)
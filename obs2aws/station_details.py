@@ -7,6 +7,7 @@ import logging
 import os
 
 import MySQLdb
+import numpy
 
 LF = '\n'
 
@@ -94,6 +95,56 @@ def noaa_station_data_from_row(row):
     height = _int_from_string(row[11])
     return {LATITUDE:latitude, LONGITUDE:longitude, ELEVATION:height}
 
+def wmo_number(station_id):
+    """block*1000+station for a 5 digit WMO station identifier, else None"""
+    if len(station_id) == 5 and station_id.isdigit():
+        return int(station_id)
+    return None
+
+class StationArrays(object):
+    """The known stations as sorted arrays, so that the stations of a whole
+    message can be looked up at once. WMO stations are keyed by
+    block*1000+station, all others (mostly ICAO) by their identifier"""
+    def __init__(self, known_stations):
+        wmo, other = [], []
+        for station_id, details in known_stations.iteritems():
+            if details is None:
+                continue
+            number = wmo_number(station_id)
+            if number is None:
+                other.append((station_id, details))
+            else:
+                wmo.append((number, details))
+        self.wmo = self._table(wmo, numpy.int64)
+        self.other = self._table(other, str)
+
+    @staticmethod
+    def _table(stations, dtype):
+        """(ids, latitudes, longitudes, elevations) sorted by id. Unknown values are nan"""
+        stations.sort(key=lambda station: station[0])
+        def _column(name):
+            return numpy.array([numpy.nan if details[name] is None else details[name]
+                                for _, details in stations], dtype=float)
+        return (numpy.array([station_id for station_id, _ in stations], dtype=dtype),
+                _column(LATITUDE), _column(LONGITUDE), _column(ELEVATION))
+
+    @staticmethod
+    def lookup(table, keys):
+        """returns (found, latitudes, longitudes, elevations) arrays for keys"""
+        ids = table[0]
+        keys = numpy.asarray(keys)
+        if len(ids) == 0 or len(keys) == 0:
+            return not_found(len(keys))
+        positions = numpy.minimum(numpy.searchsorted(ids, keys), len(ids) - 1)
+        found = ids[positions] == keys
+        return [found] + [numpy.where(found, column[positions], numpy.nan)
+                          for column in table[1:]]
+
+def not_found(length):
+    """the result of a station lookup which found nothing"""
+    return [numpy.zeros(length, dtype=bool), numpy.full(length, numpy.nan),
+            numpy.full(length, numpy.nan), numpy.full(length, numpy.nan)]
+
 def is_modified(filename, file_mod_time):
     """True if has been modified """
     return os.path.exists(filename) and file_mod_time != os.path.getmtime(filename)
@@ -110,6 +161,7 @@ class StationDetails(object):
         self.station_file_age = None
         self.last_reload_check_time = None
         self.enabled = False
+        self.arrays = None
 
     def is_loaded(self):
         """true if any station are known at all"""
@@ -118,6 +170,7 @@ class StationDetails(object):
     def reload(self):
         """Clears memory cache and reloads from files on disk"""
         self.known_stations = {}
+        self.arrays = None
         self.read_noaa_stations()
         self.read_table_stations()
         self.last_reload_check_time = datetime.datetime.utcnow()
@@ -213,6 +266,7 @@ class StationDetails(object):
         if directories is None:
             self.enabled = False
             self.known_stations = {}
+            self.arrays = None
             self.station_table_filename = ''
             self.noaa_filename = ''
         else:
@@ -248,6 +302,46 @@ class StationDetails(object):
             self.known_stations[station_id_upper] = prism_station
         return self.known_stations[station_id_upper]
 
+    def _locate(self, table_name, keys, station_ids):
+        """looks up keys in the station arrays. Anything not in there is tried one
+        unique station at a time with station_details_for, which may ask prism"""
+        if not self.enabled:
+            return not_found(len(keys))
+        if not self.is_loaded():
+            self.reload()
+        if self.arrays is None:
+            self.arrays = StationArrays(self.known_stations)
+        result = StationArrays.lookup(getattr(self.arrays, table_name), keys)
+        found = result[0]
+        missing = numpy.flatnonzero(~found)
+        if len(missing) > 0:
+            unique_keys, inverse = numpy.unique(numpy.asarray(keys)[missing],
+                                                return_inverse=True)
+            for each, key in enumerate(unique_keys):
+                details = self.station_details_for(station_ids(key))
+                if details is not None:
+                    rows = missing[inverse == each]
+                    found[rows] = True
+                    for column, name in zip(result[1:], [LATITUDE, LONGITUDE, ELEVATION]):
+                        if details[name] is not None:
+                            column[rows] = details[name]
+        return result
+
+    def locate_wmo_stations(self, blocks, numbers):
+        """Vectorised station_details_for WMO block and station numbers.
+        Returns (found, latitudes, longitudes, elevations) arrays where values which
+        aren't known are nan"""
+        keys = numpy.asarray(blocks, dtype=numpy.int64) * 1000 + \
+               numpy.asarray(numbers, dtype=numpy.int64)
+        return self._locate('wmo', keys,
+                            lambda key: '%2.2d%3.3d' % (key // 1000, key % 1000))
+
+    def locate_other_stations(self, station_ids):
+        """Vectorised station_details_for identifiers which aren't WMO numbers,
+        typically ICAO. Returns the same as locate_wmo_stations"""
+        keys = numpy.char.upper(numpy.asarray(station_ids, dtype=str))
+        return self._locate('other', keys, str)
+
 STATIONS = StationDetails() # the singleton global object
 
 def set_stations_filenames(directories):
@@ -264,3 +358,15 @@ def get_station(station_id):
     Returns Returns a dictionary {'latitude':lat, 'longitude':lon, 'elevation':height}
     or None if the station is not found"""
     return STATIONS.station_details_for(station_id)
+
+def locate_wmo_stations(blocks, numbers):
+    """get_station for arrays of WMO block and station numbers.
+    Returns (found, latitudes, longitudes, elevations) arrays where values
+    which aren't known are nan"""
+    return STATIONS.locate_wmo_stations(blocks, numbers)
+
+def locate_other_stations(station_ids):
+    """get_station for an array of (ICAO) identifiers.
+    Returns (found, latitudes, longitudes, elevations) arrays where values
+    which aren't known are nan"""
+    return STATIONS.locate_other_stations(station_ids)
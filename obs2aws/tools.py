@@ -7,6 +7,7 @@ Created on Thu Jan 12 11:51:05 2017
 
 @author: wim
 """
+import datetime
 import logging
 import numpy
 import os
@@ -119,6 +120,68 @@ def change_to_si_units(old_unit, old_value, key='', is_lowercase=False):
                 UREG.unknown[unit] = error
             return None
 
+#how values in a unit are changed to si units, worked out once per unit
+SI_ALREADY = 'si'
+SI_UNKNOWN = 'unknown'
+SI_AFFINE = 'affine'
+SI_PER_VALUE = 'per value'
+_SI_CONVERSIONS = {}
+#values spread over many magnitudes, either side of 0 and 1, to check that the
+#conversion pint gives for 0 and 1 holds for others, i.e. that it is a straight line
+_SI_CHECK_VALUES = [-1.0e6, -273.15, -2.0, -0.5, 0.25, 2.0, 3.7, 101325.0, 1.0e9]
+_SI_CHECK_TOLERANCE = 1e-12
+
+def si_conversion(old_unit, key=''):
+    '''works out, once per unit, how change_to_si_units changes values in old_unit.
+    Returns (SI_AFFINE, scale, offset) when it is value * scale + offset,
+    (SI_ALREADY,) when values are returned unchanged, (SI_UNKNOWN,) when the unit is
+    not known or (SI_PER_VALUE,) when we can't do better than asking pint every time.
+    The offset and scale are what pint makes of 0 and of 1 less that of 0, so units
+    with an offset (degC) and a scale together are affine too, while logarithmic
+    units, where pint's conversion isn't a straight line, go per value'''
+    if old_unit in _SI_CONVERSIONS:
+        return _SI_CONVERSIONS[old_unit]
+    marker = 1.5 #SI units give back the very same object
+    if change_to_si_units(old_unit, marker, key) is marker:
+        conversion = (SI_ALREADY,)
+    else:
+        offset = change_to_si_units(old_unit, 0.0, key)
+        if offset is None:
+            conversion = (SI_UNKNOWN,)
+        else:
+            scale = change_to_si_units(old_unit, 1.0, key) - offset
+            conversion = (SI_AFFINE, scale, offset)
+            for value in _SI_CHECK_VALUES:
+                expected = change_to_si_units(old_unit, value, key)
+                if not abs(value * scale + offset - expected) <= \
+                   _SI_CHECK_TOLERANCE * max(abs(expected), abs(value * scale), abs(offset)):
+                    LOGGER.debug('unit %s is not affine, converting it per value', old_unit)
+                    conversion = (SI_PER_VALUE,)
+                    break
+    _SI_CONVERSIONS[old_unit] = conversion
+    return conversion
+
+def change_array_to_si_units(old_unit, old_values, key=''):
+    '''change_to_si_units for a whole array of values, working out the conversion
+    only once for the unit. Returns a numpy array, or a list if the values had to be
+    converted one at a time'''
+    conversion = si_conversion(old_unit, key)
+    if conversion[0] == SI_ALREADY:
+        return numpy.asarray(old_values)
+    elif conversion[0] == SI_UNKNOWN:
+        return [None] * len(old_values)
+    elif conversion[0] == SI_AFFINE:
+        try:
+            values = numpy.asarray(old_values, dtype=float)
+        except ValueError:
+            pass #change_to_si_units knows what to do with these
+        else:
+            _, scale, offset = conversion
+            if scale != 1.0:
+                values = values * scale
+            return values + offset
+    return [change_to_si_units(old_unit, value, key) for value in old_values]
+
 def lon_180_180(lon):
     '''returns -180 < result <= 180'''
     if lon > 180:
@@ -127,6 +190,84 @@ def lon_180_180(lon):
         return lon + 360.0
     return lon
 
+def lons_180_180(lons):
+    '''lon_180_180 for a numpy array of longitudes'''
+    return numpy.where(lons > 180, lons - 360.0,
+                       numpy.where(lons <= -180, lons + 360.0, lons))
+
+def seconds_to_timedelta64(seconds):
+    '''numpy timedelta64 array for an array of (possibly fractional) seconds, rounded to
+    the microsecond like datetime.timedelta'''
+    return numpy.round(numpy.asarray(seconds, dtype=float) * 1e6).astype('m8[us]')
+
+def datetime64_to_timestamps(times):
+    '''formats a numpy datetime64 array as '%Y%m%d%H%M%S' strings, dropping any
+    fraction of a second'''
+    times = numpy.asarray(times)
+    if times.size == 0:
+        return numpy.zeros(times.shape, dtype='S14')
+    text = numpy.datetime_as_string(times.astype('M8[s]'))
+    for separator in ['-', 'T', ':']:
+        text = numpy.char.replace(text, separator, '')
+    return text.astype('S14')
+
+#decoded report times are carried as one int64 column of seconds since 1970
+EPOCH = 'epoch_seconds'
+TIME_FIELDS = ['year', 'month', 'day', 'hour', 'minute', 'second']
+
+def epoch_seconds(years, months, days, hours, minutes, seconds=0):
+    '''int64 seconds since 1970 from arrays of the time fields, which are broadcast
+    against each other (so each has length 1 or the length of the longest).
+    The result is masked where a field is masked or the fields don't make a valid
+    datetime.datetime'''
+    fields = [numpy.ma.asarray(field) for field in
+              [years, months, days, hours, minutes, seconds]]
+    invalid = numpy.zeros(1, dtype=bool)
+    for field in fields:
+        invalid = invalid | numpy.ma.getmaskarray(field)
+    years, months, days, hours, minutes, seconds = numpy.broadcast_arrays(
+        *[numpy.ma.getdata(field).astype(numpy.int64) for field in fields])
+    invalid = invalid | (years < datetime.MINYEAR) | (years > datetime.MAXYEAR) | \
+        (months < 1) | (months > 12) | (days < 1) | \
+        (hours < 0) | (hours > 23) | (minutes < 0) | (minutes > 59) | \
+        (seconds < 0) | (seconds > 59)
+    #invalid times get a harmless date while we work, then they are masked
+    years = numpy.where(invalid, 1970, years)
+    month_starts = ((years - 1970) * 12 + numpy.where(invalid, 0, months - 1)).astype('M8[M]')
+    dates = month_starts.astype('M8[D]') + numpy.where(invalid, 0, days - 1)
+    #a day past the end of its month spills over into the next month
+    invalid = invalid | (dates.astype('M8[M]') != month_starts)
+    result = dates.astype(numpy.int64) * 86400 + hours * 3600 + minutes * 60 + seconds
+    return numpy.ma.masked_array(result, mask=numpy.broadcast_to(invalid, result.shape))
+
+def epoch_to_timestamps(epochs):
+    '''formats an array of seconds since 1970 as '%Y%m%d%H%M%S' strings'''
+    return datetime64_to_timestamps(numpy.asarray(epochs, dtype=numpy.int64).astype('M8[s]'))
+
+GEOHASH_BASE32 = numpy.array(list('0123456789bcdefghjkmnpqrstuvwxyz'))
+
+def geohash_encode(lats, lons, precision=12):
+    '''Geohash.encode for arrays of latitudes and longitudes, returning an array of
+    geohashes with precision characters. Same bisection: longitude first, and a bit is
+    set when the value is above the middle of its interval'''
+    lats = numpy.asarray(lats, dtype=float)
+    lons = numpy.asarray(lons, dtype=float)
+    if precision < 1 or len(lats) == 0:
+        return numpy.zeros(len(lats), dtype='S%d' % max(precision, 1))
+    intervals = [(lons, numpy.full(lons.shape, -180.0), numpy.full(lons.shape, 180.0)),
+                 (lats, numpy.full(lats.shape, -90.0), numpy.full(lats.shape, 90.0))]
+    codes = numpy.zeros((len(lats), precision), dtype=int)
+    for each in range(precision * 5):
+        values, low, high = intervals[each % 2]
+        mid = (low + high) / 2
+        with numpy.errstate(invalid='ignore'): #nan is never above
+            above = values > mid
+        numpy.copyto(low, mid, where=above)
+        numpy.copyto(high, mid, where=~above)
+        codes[:, each // 5] = codes[:, each // 5] * 2 + above
+    characters = numpy.ascontiguousarray(GEOHASH_BASE32[codes])
+    return characters.view('S%d' % precision).ravel()
+
 
 def create_event(runinit, process, source, destination):
     """Create an event for AppSupport"""
@@ -187,47 +328,67 @@ def parse_duration_to_seconds(time_str):
 def get_time_periods_from_fields(values, units, indexs):
     '''Takes 3 lists of equal length and
     returns time periods of the current message as a list of tuples (title, index) '''
-    info = []
-    #If a numpy masked "array" has only one element, then the mask for that element 
-    # is a single property of the array, so you read the mask without using an index
-    # "values.mask"
-    #If there is more than one element, the mask is a genuine numpy array of booleans.
-    # and you read the mask using an index   "values.mask[index]"
-    #each_masked lets us know which situation is which
-    each_masked = isinstance(values.mask, numpy.ndarray)
+    values = numpy.ma.asarray(values)
     len_values = len(values)
-    for each in range(len_values):
-        value = values[each]
-        try:
-            index = indexs[each]
-            unit = units[each]
-            if each_masked and values.mask[each]:
-                title = '?'
-                value = None
-            elif not each_masked and values.mask:
-                title = '?'
-                value = None
-            else:
-                title = str(abs(values[each]))+units[each]
-        except (IndexError, ValueError, numpy.ma.MaskError):
-            title = '?'
-            LOGGER.info('problem with time[%i]', each)
-        info.append({'t':title, 'v':value, 'i':index, 'u':unit})
-
-    #If there are two consecutive time periods then we interpret those as 
-    # valid_from : valid_to 
-    for each in range(1, len_values):
-        if (info[each]['v'] is not None and info[each-1]['v'] is not None) and \
-           (info[each]['u'] == info[each-1]['u']) and \
-           (info[each]['i'] == info[each-1]['i'] + 1):
-            if info[each]['v'] == 0:
-                info[each]['t'] = '?'#valid_to is nominal time, pretend it's missing
-            else:
-                info[each]['t'] = '{}-{}{}'.format(abs(info[each-1]['v']),
-                                                   abs(info[each]['v']),
-                                                   info[each]['u'])
-                info[each-1]['t'] = info[each]['t']
-
-    titles = [info[each]['t'] for each in range(len_values)]
-    return titles, indexs
+    #any values without a unit and index can't be given a title
+    len_known = min(len_values, len(units), len(indexs))
+    if len_known < len_values:
+        LOGGER.info('problem with time[%i:%i]', len_known, len_values)
+    valid = ~numpy.ma.getmaskarray(values)
+    valid[len_known:] = False
+    magnitudes = numpy.abs(numpy.ma.getdata(values))
+    unit_array = numpy.asarray(units[:len_known])
+    index_array = numpy.asarray(numpy.ma.getdata(indexs[:len_known]))
 
+    titles = numpy.array(['?'] * len_values, dtype=object)
+    known = numpy.flatnonzero(valid)
+    titles[known] = [str(magnitudes[each]) + unit_array[each] for each in known]
+
+    #If there are two consecutive time periods then we interpret those as
+    # valid_from : valid_to
+    # pairs[k] is True when time[k-1]:time[k] is such a pair
+    pairs = numpy.zeros(len_values, dtype=bool)
+    if len_known > 1:
+        pairs[1:len_known] = valid[1:len_known] & valid[:len_known-1] & \
+            (unit_array[1:] == unit_array[:-1]) & (index_array[1:] == index_array[:-1] + 1)
+    for each in numpy.flatnonzero(pairs):
+        if magnitudes[each] == 0:
+            titles[each] = '?' #valid_to is nominal time, pretend it's missing
+        else:
+            titles[each] = '{}-{}{}'.format(magnitudes[each-1], magnitudes[each],
+                                            unit_array[each])
+    #the earlier time of a pair takes the title of that pair, unless valid_to is nominal
+    # time. Where pairs overlap the later pair wins
+    takes_next = numpy.zeros(len_values, dtype=bool)
+    takes_next[:-1] = pairs[1:] & (magnitudes[1:] != 0)
+    takes = numpy.flatnonzero(takes_next)
+    titles[takes] = titles[takes + 1]
+
+    return titles.tolist(), indexs
+
+def resolve_time_period_titles(value_indexs, value_valid, time_titles, time_indexs):
+    '''For each value of an accumulated field returns the title of its preceding time
+    period, or '?' if there isn't one.
+    value_indexs are the (descriptor) indexs of the values and value_valid says which
+    values are not missing. A value which is not missing steps back over any earlier
+    unknown ('?') time periods to the most recent known one.
+    time_titles and time_indexs are as returned by get_time_periods_from_fields'''
+    len_values = len(value_indexs)
+    result = numpy.array(['?'] * len_values, dtype=object)
+    len_titles = len(time_titles)
+    if len_titles == 0 or len_values == 0:
+        return result
+    titles = numpy.array(time_titles, dtype=object)
+    #we want the preceding time title, so we work out the index in the sorted
+    # time_index array
+    match_index = numpy.searchsorted(numpy.ma.getdata(time_indexs),
+                                     numpy.ma.getdata(value_indexs), side='left') - 1
+    in_range = (match_index >= 0) & (match_index < len_titles)
+    match_index[~in_range] = 0
+    #most recent known title at or before each time period (or the first one)
+    positions = numpy.arange(len_titles)
+    positions[titles == '?'] = 0
+    latest_known = numpy.maximum.accumulate(positions)
+    match_index = numpy.where(value_valid, latest_known[match_index], match_index)
+    result[in_range] = titles[match_index[in_range]]
+    return result
@@ -36,52 +36,77 @@ def _lon_0_360(lon):
     else:
         return lon
 
-def get_bounding_box(messages):
-    '''returns the minimum bounds which cover all of the reports in these messages '''
-    north = None
-    each_message = 0
-    for data, report_count in messages:
+class BoundingBox(object):
+    """The minimum bounds which cover all of the reports of the messages added so far.
+    Messages can be added one at a time as they are decoded"""
+    def __init__(self):
+        self.north = None
+        self.south = None
+        self.west = None
+        self.east = None
+        self.message_count = 0
+
+    def add(self, data, report_count):
+        '''extends the bounds to cover the reports in one message'''
         for each in range(report_count):
             try:
                 lat = data['latitude'][each]
                 lon = _lon_0_360(data['longitude'][each])
                 if -90.0 <= lat <= 90.0:
-                    if north is None:
-                        north = lat
-                        south = lat
-                        west = lon
-                        east = lon
+                    if self.north is None:
+                        self.north = lat
+                        self.south = lat
+                        self.west = lon
+                        self.east = lon
                     else:
-                        north = max(north, lat)
-                        south = min(south, lat)
-                        if lon < west or lon > east:
-                            dist_west = _lon_angle_eastward_between(lon, west)
-                            dist_east = _lon_angle_eastward_between(east, lon)
+                        self.north = max(self.north, lat)
+                        self.south = min(self.south, lat)
+                        if lon < self.west or lon > self.east:
+                            dist_west = _lon_angle_eastward_between(lon, self.west)
+                            dist_east = _lon_angle_eastward_between(self.east, lon)
                             if dist_east < dist_west:#extend eastern bound
-                                east = lon
+                                self.east = lon
                             else:#extend western bound
-                                west = lon
-                            if east < west:
-                                east += 360.0
+                                self.west = lon
+                            if self.east < self.west:
+                                self.east += 360.0
             except (IndexError, KeyError, ValueError, numpy.ma.MaskError):
                 LOGGER.debug('problem reading lat or long [%d] in message[%s]',
-                             each, each_message)
-        each_message += 1
-    if north is not None:
-        west = tools.lon_180_180(west)
-        east = tools.lon_180_180(east)
-        return {'s':south, 'n':north, 'w':west, 'e':east}
-    else:
-        return {}
+                             each, self.message_count)
+        self.message_count += 1
 
-def get_nominal_times(messages, timestamp, received):
-    '''Returns a tuple of (valid_from, valid_to) from all of the reports in these messages.
-    Fall back to the timestamp in the filename for both valid_from and valid_to
-     if all else fails'''
-    valid_from = None
-    valid_to = None
-    each_message = 0
+    def result(self):
+        '''returns the bounds as a dictionary, empty if no report had a location'''
+        if self.north is not None:
+            return {'s':self.south, 'n':self.north,
+                    'w':tools.lon_180_180(self.west), 'e':tools.lon_180_180(self.east)}
+        else:
+            return {}
+
+def get_bounding_box(messages):
+    '''returns the minimum bounds which cover all of the reports in these messages '''
+    bounding_box = BoundingBox()
     for data, report_count in messages:
+        bounding_box.add(data, report_count)
+    return bounding_box.result()
+
+class NominalTimes(object):
+    """The earliest and latest report times of the messages added so far.
+    Messages can be added one at a time as they are decoded"""
+    def __init__(self):
+        self.valid_from = None
+        self.valid_to = None
+        self.message_count = 0
+
+    def add(self, data, report_count):
+        '''takes in the report times of one message'''
+        if tools.EPOCH in data:
+            epochs = data[tools.EPOCH][:report_count].compressed()
+            if len(epochs) > 0:
+                self._add_times(datetime.datetime.utcfromtimestamp(int(epochs.min())),
+                                datetime.datetime.utcfromtimestamp(int(epochs.max())))
+            self.message_count += 1
+            return
         has_second = 'second' in data
         for each in range(report_count):
             try:
@@ -103,24 +128,41 @@ def get_nominal_times(messages, timestamp, received):
                                                    data['hour'][each],
                                                    data['minute'][each],
                                                    second)
-                if valid_from is None:
-                    valid_from = valid_time
-                    valid_to = valid_time
-                elif valid_time < valid_from:
-                    valid_from = valid_time
-                elif valid_time > valid_to:
-                    valid_to = valid_time
+                self._add_times(valid_time, valid_time)
             except (IndexError, KeyError, ValueError, numpy.ma.MaskError):
                 LOGGER.debug('problem reading time of report[%d] in message[%s]',
-                             each, each_message)
-
-        each_message += 1
-    if valid_from is None:
-        #work out a default time from the filename.  Typically this is when the bulletin
-        # was sent, so it may be quite a bit later than the validity of the reports.
-        valid_from = datetime.datetime.strptime(timestamp, '%Y%m%d%H%M%S')
-        valid_to = valid_from
-    return {'valid_from':valid_from, 'valid_to':valid_to, 'received':received}
+                             each, self.message_count)
+        self.message_count += 1
+
+    def _add_times(self, earliest, latest):
+        if self.valid_from is None:
+            self.valid_from = earliest
+            self.valid_to = latest
+        else:
+            self.valid_from = min(self.valid_from, earliest)
+            self.valid_to = max(self.valid_to, latest)
+
+    def result(self, timestamp, received):
+        '''Returns a dictionary of valid_from, valid_to and received.
+        Fall back to the timestamp in the filename for both valid_from and valid_to
+        if no report had a time'''
+        valid_from = self.valid_from
+        valid_to = self.valid_to
+        if valid_from is None:
+            #work out a default time from the filename.  Typically this is when the bulletin
+            # was sent, so it may be quite a bit later than the validity of the reports.
+            valid_from = datetime.datetime.strptime(timestamp, '%Y%m%d%H%M%S')
+            valid_to = valid_from
+        return {'valid_from':valid_from, 'valid_to':valid_to, 'received':received}
+
+def get_nominal_times(messages, timestamp, received):
+    '''Returns a tuple of (valid_from, valid_to) from all of the reports in these messages.
+    Fall back to the timestamp in the filename for both valid_from and valid_to
+     if all else fails'''
+    nominal_times = NominalTimes()
+    for data, report_count in messages:
+        nominal_times.add(data, report_count)
+    return nominal_times.result(timestamp, received)
 
 def get_s3key(s3_base, report_type, gts_header, file_ext, bounding_box, times):
     '''some of this is in the configuration and the remainder is derived from the filename
@@ -0,0 +1,437 @@
+"""
+Writes the items of the writing queues filled by
+obs2aws.decode_file_and_populate_writing_queues with several writes in flight for
+each destination, instead of one blocking thread per destination.
+Writes that raise are retried after a growing delay, and a file is added to the
+failed list (once) if any of its writes still fails.
+drain() waits for everything queued so far and shutdown() stops the engine, which
+replaces putting 'QUIT' on the queues.
+With a journal.ProgressJournal, each file whose writes to a destination all succeed
+is recorded in it under the name of the destination, so use the journal's names
+(e.g. journal.ddb_destination('recent')) for the destinations, and those which fail
+are reported to it.
+Writes are plain callables so local stand-ins can replace DynamoDB, S3 or the csv
+files, e.g. for testing.
+"""
+import logging
+import Queue
+import threading
+import time
+import traceback
+
+import numpy
+
+from . import dynamo_db
+from . import upload_to_s3
+
+LOGGER = logging.getLogger()
+
+#how often idle threads check whether the engine is stopping
+POLL_SECONDS = 0.5
+#batching writers are flushed of batches this old when their queue is idle
+FLUSH_SECONDS = 5.0
+
+
+def rows_of(item):
+    '''the (filename, row) writes of a ddb or csv queue item, which is (filename, batches)
+    or (filename, row)'''
+    filename, rows = item
+    if isinstance(rows, dict):
+        return [(filename, rows)]
+    return [(filename, row) for batch in rows for row in batch]
+
+def uploads_of(item):
+    '''the (filename, s3key) write of an s3 queue item'''
+    return [item]
+
+class _ItemProgress(object):
+    """how many writes of one queue item are still to finish"""
+    def __init__(self, filename, remaining):
+        self.filename = filename
+        self.remaining = remaining
+        self.failed = False
+
+class Destination(object):
+    """A writing queue and how its items are written.
+    write is called with each (filename, unit) that writes_of makes of an item, by up to
+    in_flight threads at once. A write that raises is tried again up to retries times,
+    waiting retry_delay seconds, then twice as long each time"""
+    def __init__(self, name, in_queue, write, writes_of=rows_of, in_flight=4,
+                 retries=3, retry_delay=1.0):
+        self.name = name
+        self.in_queue = in_queue
+        self.write = write
+        self.writes_of = writes_of
+        self.in_flight = in_flight
+        self.retries = retries
+        self.retry_delay = retry_delay
+        #a little more than in_flight so the writers never wait for the dispatcher
+        self.pending = Queue.Queue(maxsize=2 * in_flight)
+        self.lock = threading.Lock()
+        #the flush method of a batching writer, and the items still being written, by
+        #filename, so the failures it reports can be put down to them
+        self.flush = None
+        self.flush_lock = threading.Lock()
+        self.items = {}
+        self.written = 0
+        self.retried = 0
+        self.failures = 0
+
+class WriterEngine(object):
+    """Writes the items of any number of destinations, see Destination"""
+    def __init__(self, failed, journal=None):
+        self.failed = failed
+        self.journal = journal
+        self.destinations = []
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def add_destination(self, name, in_queue, write, writes_of=rows_of, in_flight=4,
+                        retries=3, retry_delay=1.0):
+        '''adds a Destination, which is started by start()'''
+        destination = Destination(name, in_queue, write, writes_of, in_flight,
+                                  retries, retry_delay)
+        self.destinations.append(destination)
+        return destination
+
+    def add_writer(self, name, in_queue, writer, in_flight=4, **kwargs):
+        '''a ddb or csv queue written by writer, anything with a write(row) method.
+        Use in_flight=1 for writers which must see the rows in order, like the csv writers.
+        Batching writers, with write(row, source) and flush() like the DynDBWriters, are
+        flushed when idle, on shutdown, and after each item if there is a journal'''
+        if hasattr(writer, 'flush'):
+            write = writer.write
+        else:
+            write = lambda row, source: writer.write(row)
+        destination = self.add_destination(name, in_queue, lambda filename, row:
+                                           write(row, filename), rows_of, in_flight, **kwargs)
+        if hasattr(writer, 'flush'):
+            destination.flush = writer.flush
+        return destination
+
+    def add_s3(self, name, in_queue, role_name, keys_path, s3_options, in_flight=4, **kwargs):
+        '''an s3 queue, uploaded like s3_thread does'''
+        def upload(filename, s3key):
+            upload_to_s3.s3copy(filename, s3key, role_name, keys_path, s3_options)
+        return self.add_destination(name, in_queue, upload, uploads_of, in_flight, **kwargs)
+
+    def start(self):
+        '''starts a dispatching thread and in_flight writing threads for each destination'''
+        for destination in self.destinations:
+            threads = [threading.Thread(target=self._dispatch, args=(destination,),
+                                        name='dispatch-' + destination.name)]
+            threads += [threading.Thread(target=self._work, args=(destination,),
+                                         name='write-' + destination.name)
+                        for _ in range(destination.in_flight)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            self.threads.extend(threads)
+
+    def drain(self):
+        '''waits until every item put on the queues so far has been written, or has failed'''
+        for destination in self.destinations:
+            destination.in_queue.join()
+
+    def shutdown(self):
+        '''drains the queues, flushes the batching writers then stops all of the threads'''
+        self.drain()
+        for destination in self.destinations:
+            self._flush(destination)
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for destination in self.destinations:
+            LOGGER.info('%s: %d written, %d retried, %d failed', destination.name,
+                        destination.written, destination.retried, destination.failures)
+
+    def _dispatch(self, destination):
+        '''splits the items of a destination's queue into writes for its writing threads'''
+        while not self.stopping.is_set():
+            try:
+                item = destination.in_queue.get(timeout=POLL_SECONDS)
+            except Queue.Empty:
+                self._flush(destination, FLUSH_SECONDS)
+                continue
+            if item == 'QUIT': #the old way of stopping, shutdown() does that now
+                destination.in_queue.task_done()
+                continue
+            try:
+                writes = destination.writes_of(item)
+            except:
+                LOGGER.error("Failed to read item from %s for %s", item[0], destination.name)
+                LOGGER.error(traceback.format_exc())
+                with destination.lock:
+                    self._item_failed(destination, item[0])
+                destination.in_queue.task_done()
+                continue
+            if not writes:
+                if self.journal is not None:
+                    self.journal.record(item[0], destination.name)
+                destination.in_queue.task_done()
+                continue
+            progress = _ItemProgress(item[0], len(writes))
+            with destination.lock:
+                destination.items[progress.filename] = progress
+            for write in writes:
+                destination.pending.put((progress, write))
+
+    def _work(self, destination):
+        '''writes whatever the dispatcher hands over until the engine stops'''
+        while True:
+            try:
+                progress, write = destination.pending.get(timeout=POLL_SECONDS)
+            except Queue.Empty:
+                if self.stopping.is_set():
+                    return
+                continue
+            succeeded = self._write(destination, write)
+            with destination.lock:
+                progress.remaining -= 1
+                if succeeded:
+                    destination.written += 1
+                else:
+                    destination.failures += 1
+                    self._item_failed(destination, progress.filename)
+                finished = progress.remaining == 0
+            if finished:
+                #with a journal, the item is only done once its rows are all sent
+                self._flush(destination, None if self.journal is not None else FLUSH_SECONDS)
+                with destination.lock:
+                    destination.items.pop(progress.filename, None)
+                if not progress.failed and self.journal is not None:
+                    self.journal.record(progress.filename, destination.name)
+                destination.in_queue.task_done()
+
+    def _item_failed(self, destination, filename):
+        '''marks the item from filename as failed, holding destination.lock'''
+        progress = destination.items.get(filename)
+        if progress is not None:
+            if progress.failed:
+                return
+            progress.failed = True
+        if filename not in self.failed:
+            self.failed.append(filename)
+        if self.journal is not None:
+            self.journal.record_failure(filename, destination.name)
+
+    def _flush(self, destination, max_age=None):
+        '''flushes a batching writer, putting the rows which failed down to their items'''
+        if destination.flush is None:
+            return
+        with destination.flush_lock:
+            try:
+                failed_sources = destination.flush(max_age)
+            except:
+                LOGGER.error("Failed to flush %s", destination.name)
+                LOGGER.error(traceback.format_exc())
+                with destination.lock:
+                    failed_sources = list(destination.items)
+            with destination.lock:
+                destination.failures += len(failed_sources)
+                for filename in failed_sources:
+                    self._item_failed(destination, filename)
+
+    def _write(self, destination, write):
+        '''does one write, with retries. True if it succeeded'''
+        filename, unit = write
+        for attempt in range(destination.retries + 1):
+            try:
+                destination.write(filename, unit)
+                return True
+            except:
+                if attempt < destination.retries:
+                    delay = destination.retry_delay * 2 ** attempt
+                    LOGGER.warning('write from %s to %s failed, retrying in %.1fs',
+                                   filename, destination.name, delay)
+                    with destination.lock:
+                        destination.retried += 1
+                    time.sleep(delay)
+                else:
+                    LOGGER.error("Failed to write line from %s to %s. line: %s",
+                                 filename, destination.name, unit)
+                    LOGGER.error(traceback.format_exc())
+        return False
+
+def split_by_shard(rows, shards):
+    '''the rows of a ddb queue item (a list of dynamo_db.RowBatch, or a row) split by
+    dynamo_db.shard_number, as {shard: list of batches or rows}'''
+    if isinstance(rows, dict):
+        obs_id = rows.get(dynamo_db.IDENTIFIER, {}).get('S')
+        return {dynamo_db.shard_number(obs_id, shards) if obs_id else 0: [rows]}
+    parts = {}
+    for batch in rows:
+        numbers = batch.shard_numbers(shards)
+        for shard in numpy.unique(numbers):
+            parts.setdefault(int(shard), []).append(batch.take(numbers == shard))
+    return parts
+
+class _Shard(object):
+    """one worker of a ShardedWriterPool, with its own writer and queue"""
+    def __init__(self, number, writer, max_pending):
+        self.number = number
+        self.writer = writer
+        self.batching = hasattr(writer, 'flush')
+        self.queue = Queue.Queue(maxsize=max_pending)
+        self.rows = 0
+        self.errors = 0
+        self.files = 0 #that it has written rows of
+        self.busy_seconds = 0.0
+
+    def stats(self):
+        '''the counters of this worker'''
+        return {'worker': self.number, 'rows': self.rows, 'errors': self.errors,
+                'files': self.files, 'busy_seconds': self.busy_seconds,
+                'rows_per_second': self.rows / self.busy_seconds if self.busy_seconds else 0.0}
+
+class ShardedWriterPool(object):
+    """Writes a ddb queue with a number of workers, each with its own writer from
+    make_writer() and so its own client. Each row goes to worker
+    dynamo_db.shard_number(obs_id, workers), so all of the rows of a station are written
+    by one worker, in order.
+    Files are added to failed (once) if any of their rows fail, and recorded in journal,
+    if given, as destination once all of their rows are written (failures are reported
+    to it too).
+    Like WriterEngine, drain() waits for the queue and shutdown() flushes the writers
+    and stops, instead of 'QUIT'. stats() has the counters of each worker"""
+    def __init__(self, make_writer, in_queue, failed, workers=4, journal=None,
+                 destination=None, max_pending=8):
+        self.in_queue = in_queue
+        self.failed = failed
+        self.journal = journal
+        self.destination = destination
+        self.shards = [_Shard(number, make_writer(), max_pending) for number in range(workers)]
+        self.lock = threading.Lock()
+        self.items = {} #filename: _ItemProgress of the files being written
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def start(self):
+        '''starts the dispatching thread and a thread for each worker'''
+        self.threads = [threading.Thread(target=self._dispatch, name='dispatch-shards')]
+        self.threads += [threading.Thread(target=self._work, args=(shard,),
+                                          name='shard-%d' % shard.number)
+                         for shard in self.shards]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def drain(self):
+        '''waits until every item put on the queue so far has been written, or has failed'''
+        self.in_queue.join()
+
+    def shutdown(self):
+        '''drains the queue, flushes the writers then stops all of the threads'''
+        self.drain()
+        for shard in self.shards:
+            self._flush(shard)
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for shard in self.shards:
+            LOGGER.info('%s worker %d: %d rows from %d files in %.1fs, %d errors',
+                        self.destination, shard.number, shard.rows, shard.files,
+                        shard.busy_seconds, shard.errors)
+
+    def stats(self):
+        '''the counters of each worker'''
+        return [shard.stats() for shard in self.shards]
+
+    def _dispatch(self):
+        '''splits the items of the queue between the workers'''
+        while not self.stopping.is_set():
+            try:
+                item = self.in_queue.get(timeout=POLL_SECONDS)
+            except Queue.Empty:
+                continue
+            if item == 'QUIT': #the old way of stopping, shutdown() does that now
+                self.in_queue.task_done()
+                continue
+            filename, rows = item
+            try:
+                parts = split_by_shard(rows, len(self.shards))
+            except:
+                LOGGER.error("Failed to split the rows from %s", filename)
+                LOGGER.error(traceback.format_exc())
+                self._item_failed(filename)
+                self.in_queue.task_done()
+                continue
+            if not parts:
+                self._finish(_ItemProgress(filename, 0))
+                continue
+            progress = _ItemProgress(filename, len(parts))
+            with self.lock:
+                self.items[filename] = progress
+            for shard, part in sorted(parts.iteritems()):
+                self.shards[shard].queue.put((progress, part))
+
+    def _work(self, shard):
+        '''writes the rows the dispatcher hands to shard until the pool stops'''
+        while True:
+            try:
+                progress, part = shard.queue.get(timeout=POLL_SECONDS)
+            except Queue.Empty:
+                if self.stopping.is_set():
+                    return
+                self._flush(shard, FLUSH_SECONDS)
+                continue
+            started = time.time()
+            for batch in part:
+                for row in ([batch] if isinstance(batch, dict) else batch):
+                    try:
+                        if shard.batching:
+                            shard.writer.write(row, progress.filename)
+                        else:
+                            shard.writer.write(row)
+                        shard.rows += 1
+                    except:
+                        shard.errors += 1
+                        LOGGER.error("Failed to write line from %s to %s. line: %s",
+                                     progress.filename, self.destination, row)
+                        LOGGER.error(traceback.format_exc())
+                        self._item_failed(progress.filename)
+            #with a journal, the file is only done once its rows are all sent
+            self._flush(shard, None if self.journal is not None else FLUSH_SECONDS)
+            shard.busy_seconds += time.time() - started
+            shard.files += 1
+            with self.lock:
+                progress.remaining -= 1
+                finished = progress.remaining == 0
+            if finished:
+                self._finish(progress)
+
+    def _finish(self, progress):
+        with self.lock:
+            self.items.pop(progress.filename, None)
+        if not progress.failed and self.journal is not None:
+            self.journal.record(progress.filename, self.destination)
+        self.in_queue.task_done()
+
+    def _item_failed(self, filename):
+        with self.lock:
+            progress = self.items.get(filename)
+            if progress is not None:
+                if progress.failed:
+                    return
+                progress.failed = True
+            if filename not in self.failed:
+                self.failed.append(filename)
+        if self.journal is not None:
+            self.journal.record_failure(filename, self.destination)
+
+    def _flush(self, shard, max_age=None):
+        '''flushes a batching writer, putting the rows which failed down to their files'''
+        if not shard.batching:
+            return
+        try:
+            failed_sources = shard.writer.flush(max_age)
+        except:
+            LOGGER.error("Failed to flush %s worker %d", self.destination, shard.number)
+            LOGGER.error(traceback.format_exc())
+            with self.lock:
+                failed_sources = list(self.items)
+        shard.errors += len(failed_sources)
+        for filename in failed_sources:
+            self._item_failed(filename)
@@ -1,7 +1,12 @@
 '''dynamodb rules'''
+import collections
 import copy
 from datetime import datetime
+import hashlib
 import logging
+import random
+import threading
+import time
 import traceback
 
 from botocore.exceptions import ClientError
@@ -11,14 +16,169 @@ from obs2aws import dynamo_db
 
 LOGGER = logging.getLogger()
 
+#rows are sent in batch_write_item requests of up to BATCH_SIZE (the most it takes),
+#which are sent when full or when flushed. The writer threads flush idle writers of the
+#batches older than their FLUSH_SECONDS (see obs2aws.writer_thread and writer_engine)
+BATCH_SIZE = 25
+#how many times items which weren't processed are sent again
+BATCH_RETRIES = 8
+BACKOFF_SECONDS = 0.05
+MAX_BACKOFF_SECONDS = 10.0
+THROTTLE_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException',
+                   'RequestLimitExceeded')
+RETRY_ERRORS = THROTTLE_ERRORS + ('InternalServerError',)
+#how the write rate of a TokenBucket adapts: it is cut by THROTTLE_FACTOR when writes
+#are throttled and goes back up by RATE_STEP of its maximum after each batch which isn't
+RATE_STEP = 0.02
+THROTTLE_FACTOR = 0.5
+MIN_RATE = 1.0
+#items which were written in the last WRITTEN_SECONDS, at most WRITTEN_ITEMS of them, are
+#not written again unless they have changed, other than in VOLATILE_ATTRIBUTES
+WRITTEN_ITEMS = 200000
+WRITTEN_SECONDS = 6 * 3600
+VOLATILE_ATTRIBUTES = ('ttl', 'availability_datetime', 's3key')
 
 
+def backoff_delay(attempt):
+    '''how long to wait before retry number attempt (from 0), a random time up to an
+    exponentially growing limit so writers don't retry in step'''
+    return random.uniform(0, min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** attempt))
+
+class TokenBucket(object):
+    """The write capacity units per second to spend on a table or index, at most
+    max_rate (what is provisioned).
+    acquire() waits until the bucket isn't in debt, so rows wait here rather than being
+    throttled. The estimate taken is settled against the capacity DynamoDB says the
+    batch consumed, which also keeps the estimate of units per item up to date"""
+    def __init__(self, max_rate):
+        self.max_rate = float(max_rate)
+        self.rate = self.max_rate
+        self.tokens = self.rate
+        self.units_per_item = 1.0
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        self.throttles = 0
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, items):
+        '''waits for capacity for items, returning the units taken'''
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 0:
+                    units = items * self.units_per_item
+                    self.tokens -= units
+                    return units
+                wait = -self.tokens / self.rate
+            time.sleep(wait)
+
+    def settle(self, taken, consumed, items):
+        '''corrects for the units consumed by items which were written'''
+        with self.lock:
+            self.tokens += taken - consumed
+            if items:
+                self.units_per_item = 0.8 * self.units_per_item + 0.2 * consumed / items
+
+    def throttled(self):
+        '''writes were throttled, so slows down'''
+        with self.lock:
+            self.throttles += 1
+            self.rate = max(MIN_RATE, self.rate * THROTTLE_FACTOR)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        '''a batch was written without throttling, so speeds up a little'''
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_STEP)
+
+_BUCKETS = {} #(region, table_name) or (region, table_name, index_name): TokenBucket
+_BUCKETS_LOCK = threading.Lock()
+
+def shared_bucket(name, max_rate):
+    '''the TokenBucket for a table or index, named by (region, table_name[, index_name]),
+    shared by all the writers of this process. None for tables which are on demand
+    (max_rate 0)'''
+    if not max_rate:
+        return None
+    with _BUCKETS_LOCK:
+        bucket = _BUCKETS.get(name)
+        if bucket is None:
+            bucket = _BUCKETS[name] = TokenBucket(max_rate)
+        return bucket
+
+def consumed_capacity(response, table_name):
+    '''the units a batch_write_item with ReturnConsumedCapacity='INDEXES' consumed on
+    table_name and on each of its indexes, as (units, {index_name: units})'''
+    for consumed in response.get('ConsumedCapacity', []):
+        if consumed.get('TableName') == table_name:
+            units = consumed.get('Table', {}).get('CapacityUnits',
+                                                  consumed.get('CapacityUnits', 0.0))
+            indexes = dict((name, index.get('CapacityUnits', 0.0)) for name, index in
+                           consumed.get('GlobalSecondaryIndexes', {}).iteritems())
+            return units, indexes
+    return None
+
+def content_hash(item):
+    '''a hash of the attributes of item, other than VOLATILE_ATTRIBUTES'''
+    return hashlib.sha1(repr(sorted((name, sorted(attribute.iteritems()))
+                                    for name, attribute in item.iteritems()
+                                    if name not in VOLATILE_ATTRIBUTES))).digest()
+
+class WrittenCache(object):
+    """content_hash of the items written recently, by table and key, so items which
+    haven't changed needn't be written again. Holds at most max_items, forgetting the
+    oldest first, and forgets them after max_age seconds"""
+    def __init__(self, max_items=WRITTEN_ITEMS, max_age=WRITTEN_SECONDS):
+        self.max_items = max_items
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.written = collections.OrderedDict() #(table_name, key): (hash, when written)
+
+    def _evict(self, now):
+        while self.written:
+            key, (_, written) = next(self.written.iteritems())
+            if len(self.written) <= self.max_items and now - written <= self.max_age:
+                break
+            del self.written[key]
+
+    def unchanged(self, table_name, key, digest):
+        '''True if the item was written recently with the same content_hash'''
+        with self.lock:
+            self._evict(time.time())
+            entry = self.written.get((table_name, key))
+            return entry is not None and entry[0] == digest
+
+    def add(self, table_name, keys_and_hashes):
+        '''remembers the content_hash of items which have been written'''
+        with self.lock:
+            now = time.time()
+            for key, digest in keys_and_hashes:
+                self.written.pop((table_name, key), None)
+                self.written[(table_name, key)] = (digest, now)
+            self._evict(now)
+
+def item_key(item):
+    '''the primary key of a ddb item'''
+    return tuple(item[name]['S'] for name in dynamo_db.KEY_ATTRIBUTES)
+
 def datetime_str2datetime(datetime_str):
     """returns a datetime instance from a string YYYYMMDDHHMMSS"""
     return datetime.strptime(datetime_str, '%Y%m%d%H%M%S')
 
 class DynDBWriter(object):
-    """base class for writing to dynamodb"""
+    """base class for writing to dynamodb.
+    Rows are buffered per table and written BATCH_SIZE at a time with batch_write_item.
+    Call flush() to send what is buffered; it returns the sources given to write() of
+    the rows which couldn't be written since the last flush.
+    Tables are checked for and created in the background (see
+    dynamo_db.TableProvisioner), and rows for a table which isn't ready yet wait in
+    its batch.
+    Items which were recently written with the same contents (see WrittenCache) are
+    skipped, and counted in saved_writes"""
     def __init__(self, status, region, hostlocation, role_name):
         self.status = status
         self.region = region
@@ -27,8 +187,21 @@ class DynDBWriter(object):
         self.table_name = dynamo_db.get_table_name(status=self.status,
                                                    region=self.region, archive=False)
         self.client = self._get_client()
-        if not self._table_exists(self.table_name):
-            self._create_table(self.table_name)
+        self._init_batches()
+        self.provisioner.provision(self.table_name)
+
+    def _init_batches(self):
+        self.provisioner = dynamo_db.TableProvisioner(self._table_exists, self._create_table)
+        self.capacities = {} #table_name: dynamo_db.write_capacities
+        self.written = WrittenCache()
+        self.saved_writes = 0
+        self.lock = threading.Lock() #for batches, failed_sources, saved_writes and sending
+        #batches are sent without the lock, so flush() waits on sent until none are
+        self.sent = threading.Condition(self.lock)
+        self.sending = 0
+        self.batches = {} #table_name: OrderedDict of item_key: (item, source, content_hash)
+        self.batch_started = {} #table_name: when the first row of its batch was added
+        self.failed_sources = []
 
     def _get_client(self):
         return dynamo_db.get_client_retry(self.status, self.region,
@@ -36,29 +209,170 @@ class DynDBWriter(object):
 
     def _table_exists(self, table_name):
         try:
-            self.client.describe_table(TableName=table_name)
+            description = self.client.describe_table(TableName=table_name)
+            self.capacities[table_name] = dynamo_db.write_capacities(description)
             return True
         except ClientError:
             return False
 
+    def _buckets(self, table_name):
+        '''the (index_name or None, TokenBucket) to write to table_name with'''
+        units, indexes = self.capacities.get(table_name, (
+            dynamo_db.WRITE_CAPACITY, {dynamo_db.INDEX_NAME:dynamo_db.INDEX_WRITE_CAPACITY}))
+        buckets = [(None, shared_bucket((self.region, table_name), units))]
+        buckets += [(index_name, shared_bucket((self.region, table_name, index_name),
+                                               index_units))
+                    for index_name, index_units in sorted(indexes.iteritems())]
+        return [(name, bucket) for name, bucket in buckets if bucket is not None]
+
     def _create_table(self, table_name):
         dynamo_db.create_table(table_name, self.client)
 
-    def write(self, data_dict):
-        '''writes a row to dynamodb'''
+    def write(self, data_dict, source=None):
+        '''writes a row to dynamodb, in a batch. source (e.g. the filename) is what flush()
+        reports if the row can't be written'''
+        self._add(self.table_name, data_dict, source)
 
+    def _add(self, table_name, item, source):
+        '''buffers item for table_name, sending the batch once it is full'''
+        key = item_key(item)
+        digest = content_hash(item)
+        full = None
+        with self.lock:
+            if self.written.unchanged(table_name, key, digest):
+                self.saved_writes += 1
+                return
+            batch = self.batches.setdefault(table_name, collections.OrderedDict())
+            if not batch:
+                self.batch_started[table_name] = time.time()
+            #a batch can't hold two items with the same key, the later put wins anyway
+            batch.pop(key, None)
+            batch[key] = (item, source, digest)
+            if len(batch) >= BATCH_SIZE and self.provisioner.is_ready(table_name):
+                full = self.batches.pop(table_name)
+                self.sending += 1
+        if full is not None:
+            self._send(table_name, full)
+
+    def flush(self, max_age=None):
+        '''sends the buffered rows, or only the batches older than max_age seconds, and
+        returns the sources of the rows which failed since the last flush.
+        Without max_age this waits for tables which are still being provisioned.
+        Batches which other threads are sending are waited for, so their failures are
+        in what is returned'''
+        ready = []
+        waiting = []
+        with self.lock:
+            now = time.time()
+            for table_name, batch in self.batches.items():
+                if not batch or (max_age is not None and
+                                 now - self.batch_started[table_name] < max_age):
+                    continue
+                if self.provisioner.is_ready(table_name):
+                    ready.append((table_name, self.batches.pop(table_name)))
+                elif max_age is None:
+                    waiting.append((table_name, self.batches.pop(table_name)))
+                else:
+                    continue
+                self.sending += 1
+        #the lock isn't held while sending, so rows can be added meanwhile
+        for table_name, batch in ready:
+            self._send(table_name, batch)
+        for table_name, batch in waiting:
+            if self.provisioner.wait(table_name):
+                self._send(table_name, batch)
+            else:
+                self._fail(table_name, batch, 'the table could not be provisioned')
+                self._sent()
+        with self.lock:
+            while self.sending:
+                self.sent.wait()
+            failed, self.failed_sources = self.failed_sources, []
+            if max_age is None and self.saved_writes:
+                LOGGER.info('%s has skipped %d unchanged items', self.__class__.__name__,
+                            self.saved_writes)
+        return failed
+
+    def _send(self, table_name, batch):
+        '''writes batch, taken out of self.batches (counting it in self.sending),
+        BATCH_SIZE items at a time'''
         try:
-            self.client.put_item(TableName=self.table_name, Item=data_dict)
-#            LOGGER.debug('Wrote %s to %s', data_dict, self.__class__.__name__)
-        except ClientError, err:
-            LOGGER.warning('Failed to write item: %s to %s', data_dict,
-                           self.__class__.__name__)
-            LOGGER.warning(traceback.format_exc())
-            if err.response['Error']['Code'] == "ExpiredTokenException":
-                self.client = self._get_client()
-                self.write(data_dict)
-        except UnicodeDecodeError:
-            LOGGER.warning('could not decode unicode: %s', data_dict)
+            items = batch.items()
+            for start in range(0, len(items), BATCH_SIZE):
+                self._send_batch(table_name,
+                                 collections.OrderedDict(items[start:start + BATCH_SIZE]))
+        finally:
+            self._sent()
+
+    def _sent(self):
+        with self.lock:
+            self.sending -= 1
+            self.sent.notify_all()
+
+    def _send_batch(self, table_name, batch):
+        '''writes a batch of up to BATCH_SIZE items, retrying the unprocessed items.
+        Waits for the token buckets of the table and its indexes first, and retries
+        after throttling only cost a retry once the buckets are at their slowest.
+        Called without self.lock, so other threads can add rows while this waits'''
+        buckets = self._buckets(table_name)
+        attempt = 0
+        while batch:
+            requests = [{'PutRequest':{'Item':item}} for item, _, _ in batch.itervalues()]
+            taken = [bucket.acquire(len(requests)) for _, bucket in buckets]
+            throttled = False
+            try:
+                response = self.client.batch_write_item(RequestItems={table_name:requests},
+                                                        ReturnConsumedCapacity='INDEXES')
+                unprocessed = response.get('UnprocessedItems', {}).get(table_name, [])
+                sent = batch
+                batch = collections.OrderedDict(
+                    (key, sent[key]) for key in
+                    (item_key(request['PutRequest']['Item']) for request in unprocessed))
+                self.written.add(table_name, [(key, digest) for key, (_, _, digest)
+                                              in sent.iteritems() if key not in batch])
+                throttled = bool(batch)
+                consumed = consumed_capacity(response, table_name)
+                if consumed is not None:
+                    written = len(requests) - len(unprocessed)
+                    for (index_name, bucket), units in zip(buckets, taken):
+                        if index_name is None:
+                            bucket.settle(units, consumed[0], written)
+                        else:
+                            bucket.settle(units, consumed[1].get(index_name, units), written)
+            except ClientError, err:
+                code = err.response['Error']['Code']
+                throttled = code in THROTTLE_ERRORS
+                if code == "ExpiredTokenException":
+                    self.client = self._get_client()
+                elif code not in RETRY_ERRORS:
+                    self._fail(table_name, batch, traceback.format_exc())
+                    return
+            except Exception:
+                self._fail(table_name, batch, traceback.format_exc())
+                return
+            for _, bucket in buckets:
+                if throttled:
+                    bucket.throttled()
+                else:
+                    bucket.succeeded()
+            if batch:
+                if throttled and buckets and any(bucket.rate > MIN_RATE
+                                                 for _, bucket in buckets):
+                    continue #the buckets make it wait
+                if attempt >= BATCH_RETRIES:
+                    self._fail(table_name, batch, 'still unprocessed after %d retries'
+                               % BATCH_RETRIES)
+                    return
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+
+    def _fail(self, table_name, batch, reason):
+        LOGGER.warning('Failed to write %d items to %s from %s: %s', len(batch), table_name,
+                       self.__class__.__name__, reason)
+        with self.lock:
+            for _, source, _ in batch.itervalues():
+                if source not in self.failed_sources:
+                    self.failed_sources.append(source)
 
 
 class DynDBProdWriter(DynDBWriter):
@@ -85,11 +399,16 @@ class DynDBArchiveWriter(DynDBWriter):
         self.hostlocation = hostlocation
         self.role_name = role_name
         self.client = self._get_client()
-        self.existing_table_names = []
+        self._init_batches()
+        self.provisioned_years = set()
+        self._provision_ahead(datetime.utcnow().year)
 
-    def write(self, data_dict):
+    def write(self, data_dict, source=None):
 
-        date = datetime_str2datetime(data_dict['datetime']['S'])
+        if getattr(data_dict, 'epoch', None) is not None:
+            date = datetime.utcfromtimestamp(data_dict.epoch)
+        else:
+            date = datetime_str2datetime(data_dict['datetime']['S'])
 
         #make a copy, since we want to add the availability_time field and we
         #want to limit the affect of this change
@@ -98,25 +417,15 @@ class DynDBArchiveWriter(DynDBWriter):
         data_dict['availability_datetime'] = {
             'S':datetime.utcnow().strftime('%Y%m%d%H%M')}
 
-        def write_helper():
-            '''helps write to ddb'''
-            desired_table_names = dynamo_db.get_archive_tables(date,
-                                                               region=self.region,
-                                                               status=self.status)
-#            LOGGER.debug('DynDBArchiveWriter writing "%s"', str(data_dict))
-            for table_name in desired_table_names:
-                if not table_name in self.existing_table_names:
-                    if not self._table_exists(table_name):
-                        self._create_table(table_name)
-                    self.existing_table_names.append(table_name)
-                self.client.put_item(TableName=table_name, Item=data_dict)
+        self._provision_ahead(date.year)
+        for table_name in dynamo_db.get_archive_tables(date, region=self.region,
+                                                       status=self.status):
+            self._add(table_name, data_dict, source)
 
-        try:
-            write_helper()
-        except ClientError as err:
-            if err.response['Error']['Code'] == "ExpiredTokenException":
-                self.client = self._get_client()
-                write_helper()
-        except Exception as err:
-            LOGGER.error('DynDBArchiveWriter writing Exception - %s', err.message)
-            raise err
+    def _provision_ahead(self, year):
+        '''starts provisioning the tables of year and the year after, unless already done'''
+        if year not in self.provisioned_years:
+            self.provisioned_years.add(year)
+            for table_year in (year, year + 1):
+                self.provisioner.provision(dynamo_db.get_archive_table(
+                    table_year, status=self.status, region=self.region))
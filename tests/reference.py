@@ -0,0 +1,413 @@
+"""
+The report by report code obs2aws had before it was vectorised, kept as it was so the
+tests can check that the new code gives the same results.
+Don't tidy this up, it is only here to be compared against.
+"""
+import datetime
+import glob
+import logging
+import os
+
+import eccodes
+import Geohash
+import numpy
+
+from obs2aws import tools
+
+LOGGER = logging.getLogger()
+IDENTIFIER = 'obs_id'
+
+
+def find_files_to_process(patterns):
+    '''finds all of the observation files. Files must have a basename
+    which has at least one underscore in it and a timestamp is the second element
+    in that basename.'''
+    result = []
+    for pattern in patterns:
+        for new_file in glob.glob(pattern):
+            if '_' in os.path.basename(new_file):
+                result.append(new_file)
+
+    result.sort(key=lambda x: os.path.basename(x).split('_')[1])
+    return result
+
+def bufr_typical_timestamp(msgid):
+    '''gets the typical datetime from section1 of a BUFR message and returns as
+    a masked numpy array'''
+    try:
+        date = datetime.datetime(eccodes.codes_get(msgid, 'typicalYear'),
+                                 eccodes.codes_get(msgid, 'typicalMonth'),
+                                 eccodes.codes_get(msgid, 'typicalDay'),
+                                 eccodes.codes_get(msgid, 'typicalHour'),
+                                 eccodes.codes_get(msgid, 'typicalMinute'),
+                                 eccodes.codes_get(msgid, 'typicalSecond'))
+        result = [date.strftime('%Y%m%d%H%M%S')]
+        LOGGER.debug('bufr_typical_timestamp: %s -> %s', str(date), str(result))
+        return numpy.ma.asarray(result)
+    except (ValueError, eccodes.CodesInternalError):
+        LOGGER.warning('could not get typical date')
+        return None
+
+def get_time_periods_from_fields(values, units, indexs):
+    '''Takes 3 lists of equal length and
+    returns time periods of the current message as a list of tuples (title, index) '''
+    info = []
+    #If a numpy masked "array" has only one element, then the mask for that element 
+    # is a single property of the array, so you read the mask without using an index
+    # "values.mask"
+    #If there is more than one element, the mask is a genuine numpy array of booleans.
+    # and you read the mask using an index   "values.mask[index]"
+    #each_masked lets us know which situation is which
+    each_masked = isinstance(values.mask, numpy.ndarray)
+    len_values = len(values)
+    for each in range(len_values):
+        value = values[each]
+        try:
+            index = indexs[each]
+            unit = units[each]
+            if each_masked and values.mask[each]:
+                title = '?'
+                value = None
+            elif not each_masked and values.mask:
+                title = '?'
+                value = None
+            else:
+                title = str(abs(values[each]))+units[each]
+        except (IndexError, ValueError, numpy.ma.MaskError):
+            title = '?'
+            LOGGER.info('problem with time[%i]', each)
+        info.append({'t':title, 'v':value, 'i':index, 'u':unit})
+
+    #If there are two consecutive time periods then we interpret those as 
+    # valid_from : valid_to 
+    for each in range(1, len_values):
+        if (info[each]['v'] is not None and info[each-1]['v'] is not None) and \
+           (info[each]['u'] == info[each-1]['u']) and \
+           (info[each]['i'] == info[each-1]['i'] + 1):
+            if info[each]['v'] == 0:
+                info[each]['t'] = '?'#valid_to is nominal time, pretend it's missing
+            else:
+                info[each]['t'] = '{}-{}{}'.format(abs(info[each-1]['v']),
+                                                   abs(info[each]['v']),
+                                                   info[each]['u'])
+                info[each-1]['t'] = info[each]['t']
+
+    titles = [info[each]['t'] for each in range(len_values)]
+    return titles, indexs
+
+def accumulated_field_arrays(fieldname, values, indexs, time_titles, time_indexs):
+    '''the accumulated field part of process_message_get_field_array, given the values
+    and indexs it decoded'''
+    field, required_title = fieldname.split('@')
+    len_values = len(values)
+    result = {}
+    for each in range(len_values):
+        if isinstance(values.mask, numpy.ndarray) and values.mask[each]:
+            value = None  #continue #this particular value is missing
+        elif isinstance(values.mask, numpy.bool_) and values.mask:
+            value = None#  continue #all of these values are missing
+        else:
+            value = values[each]
+
+        #we want the precding time title = (value and unit)
+        # so we work out the index in the sorted time_index array
+        match_index = numpy.searchsorted(time_indexs,
+                                         indexs[min(each, len(indexs)-1)],
+                                         side='left') - 1
+        if 0 <= match_index < len(time_titles):
+            #If required, we step back to the most recent valid time_title
+            if value is not None:
+                while match_index > 0 and time_titles[match_index] == '?':
+                    match_index -= 1
+            if time_titles[match_index] != '?' and \
+               (not required_title or required_title == time_titles[match_index]):
+                key = field + '@' + time_titles[match_index]
+                if not key in result:
+                    result[key] = [value]
+                else:
+                    result[key].append(value)
+    for key, values in result.items():
+        result[key] = numpy.ma.masked_equal(numpy.asarray(values), None)
+    return result
+
+def translate_metar_data(data, timestamp):
+    '''Produces a dictionary of numpy masked arrays which is compatible with the
+    output of eccodes BUFR decoding. In the process it converts strings to
+      floats or integers. Year and month are added from the timestamp.
+    Converts everything to SI'''
+    result = {}
+    def _simple(key, values):
+        return key, values.compressed().tolist()
+    def _str_to_int(key, values):
+        return key, [int(val) for val in values.compressed().tolist()]
+    def _str_to_int_if_integer(key, values):
+        return key, [int(val) if str(val).isdigit() else val \
+                     for val in values.compressed().tolist()]
+    def _temperature(key, values):
+        return 'airTemperature', [tools.change_to_si_units('degC', val) \
+                                 for val in values.compressed().tolist()]
+    def _dewpoint(key, values):
+        return key, [tools.change_to_si_units('degC', val) \
+                     for val in values.compressed().tolist()]
+    def _qnh_in_hpa(key, values):
+        return 'pressureReducedToMeanSeaLevel', \
+             [tools.change_to_si_units('hPa', float(val.replace('Q', ''))) \
+              for val in values.compressed().tolist()]
+    def _qnh_in_inhg00(key, values):
+        return 'pressureReducedToMeanSeaLevel', \
+             [tools.change_to_si_units('inhg00', float(val.replace('A', ''))) \
+              for val in values.compressed().tolist()]
+    def _windspeed(key, values):
+        if 'windUnits' in data and \
+                   len(data['windUnits'].compressed()) > 0:
+            windunits = data['windUnits'].compressed()[0]
+        else:
+            windunits = 'knots'
+        return key, [tools.change_to_si_units(windunits, int(val)) \
+                     for val in values.compressed().tolist()]
+    trans = {'latitude':_simple, 'longitude':_simple, 'CCCC':_simple,
+             'name':_simple, 'elevation':_simple,
+             'day':_str_to_int, 'hour':_str_to_int, 'minute':_str_to_int,
+             'windDirection':_str_to_int_if_integer,
+             'temperature':_temperature,
+             'dewPointTemperature':_dewpoint,
+             'qnhInHectoPascal':_qnh_in_hpa,
+             'qnhInHundrethsOfInchOfMercury': _qnh_in_inhg00,
+             'windSpeed':_windspeed}
+    for key in trans:
+        if key in data:
+            if len(data[key].compressed()) > 0: # there are valid values
+                try:
+                    newkey, lst = trans[key](key, data[key])
+                    result[newkey] = numpy.ma.asarray(lst)
+                except ValueError:
+                    LOGGER.warning('wrong type translating metar %s - ignoring that field', key)
+
+    #ALWAYs get the year and month from timestamp since eccodes makes these 'undefined'
+    result['year'] = numpy.ma.asarray([int(timestamp[:4])])
+    result['month'] = numpy.ma.asarray([int(timestamp[4:6])])
+    return result
+
+def decode_temp_report(data, report_count):
+    '''decode lat,lon,time displacements into geniune latitude and longitude and
+    datetime arrays.  We have to do this here instead of obs2aws.py
+    because bounding_box calculations rely on latitude and longitude'''
+    result = {}
+    if 'latitudeDisplacement' in data and \
+          len(data['latitudeDisplacement'].compressed()) >= report_count:
+        lats, lons, dates = [], [], []
+        basetime = datetime.datetime(data['year'][0],
+                                     data['month'][0],
+                                     data['day'][0],
+                                     data['hour'][0],
+                                     data['minute'][0],
+                                     data['second'][0])
+        lastdate = basetime
+        baselat = data['latitude'].compressed()[0]
+        baselon = data['longitude'].compressed()[0]
+        for each in range(report_count):
+            if not data['timePeriod'].mask[each]:
+                lastdate = basetime + datetime.timedelta(days=0, seconds=data['timePeriod'][each])
+            dates.append(lastdate.strftime('%Y%m%d%H%M%S'))
+            if data['latitudeDisplacement'].mask[each]:
+                lats.append(eccodes.CODES_MISSING_DOUBLE)
+            else:
+                lats.append(baselat + data['latitudeDisplacement'][each])
+            if data['longitudeDisplacement'].mask[each]:
+                lons.append(eccodes.CODES_MISSING_DOUBLE)
+            else:
+                lons.append(tools.lon_180_180(baselon + data['longitudeDisplacement'][each]))
+
+        result['latitude'] = numpy.ma.masked_values(lats, eccodes.CODES_MISSING_DOUBLE)
+        result['longitude'] = numpy.ma.masked_values(lons, eccodes.CODES_MISSING_DOUBLE)
+        result['datetime'] = numpy.ma.asarray(dates)
+        for field in data:
+            if field not in ['latitude', 'longitude',
+                             'latitudeDisplacement', 'longitudeDisplacement',
+                             'datetime', 'year', 'month', 'day', 'hour', 'minute', 'second',
+                             'timePeriod']:
+                result[field] = data[field]
+        return result
+    else:
+        return data
+
+class ObsDBRow(dict):
+    '''a single report in dynamodb'''
+    def set_attribute(self, fieldname, value):
+        '''Only adds the value to the row if value is valid'''
+        if value is not None and not isinstance(value, numpy.ma.core.MaskedConstant):
+            if isinstance(value, float):
+                self[fieldname] = {'N':"%.6f" % value}
+            elif isinstance(value, int):
+                self[fieldname] = {'N':str(value)}
+            else:
+                #DynamoDB will not tolerate empty strings, so we just dont
+                #add the column. Also omit hex strings encoding missing
+                if (value != '') and (value != len(value) * '\xff'):
+                    self[fieldname] = {'S':str(value)}
+
+    def set_report_time(self, index):
+        '''set datetime attribute if that succeeds delete other time fields'''
+        result = 'datetime' in self
+        if not result:
+            try:
+                if 'second' in self:
+                    seconds = int(self['second']['N'])
+                else:
+                    seconds = 0
+                item_time = datetime.datetime(int(self['year']['N']),
+                                              int(self['month']['N']),
+                                              int(self['day']['N']),
+                                              int(self['hour']['N']),
+                                              int(self['minute']['N']),
+                                              seconds)
+                self.set_attribute('datetime', item_time.strftime('%Y%m%d%H%M%S'))
+                result = True
+            except ValueError:
+                LOGGER.warning('bad time value in row[%s]', index)
+            except KeyError:
+                LOGGER.warning('missing a time field in row[%s]', index)
+        if result:
+            #since we have datetime defined we don't need the individual time fields
+            for key in ['year', 'month', 'day', 'hour', 'minute', 'second']:
+                if key in self:
+                    del self[key]
+        return result
+
+    def _set_station_attribute(self, oldkey, newkey, delete_key=True, suffix=None):
+        result = oldkey in self
+        if result:
+            newvalue = self[oldkey]
+            if suffix is not None:
+                #then the newvalue must be a string
+                newvalue = {'S':newvalue[newvalue.keys()[0]] + suffix}
+            self[newkey] = newvalue
+            if delete_key:
+                del self[oldkey]
+        return result
+
+    def has_station_location(self):
+        """Returns true if the latitide and longitude are filled in correctly"""
+        result = 'latitude' in self and 'longitude' in self
+        if result:
+            result = (-90.0 <= float(self['latitude']['N']) <= 90.0) and \
+                     (-180 <= float(self['longitude']['N']) < 180)
+        return result
+
+    def set_station_id(self, report_type, index):
+        '''set the station identifier. Unfortunately this is specific to report_type'''
+        if report_type in ['synop', 'temp', 'pilot', 'radarvvp']:
+            result = 'blockNumber' in self and 'stationNumber' in self
+            if result:
+                block = int(self['blockNumber']['N'])
+                number = int(self['stationNumber']['N'])
+                if report_type in ['radarvvp', 'temp']:
+                    self.set_attribute(IDENTIFIER, '%2.2d%3.3d_%s_%s' %(block,
+                                                                        number,
+                                                                        index,
+                                                                        report_type))
+                else:
+                    self.set_attribute(IDENTIFIER, '%2.2d%3.3d_%s' %(block, number,
+                                                                     report_type))
+                del self['blockNumber']
+                del self['stationNumber']
+        elif report_type == 'metar':
+            result = self._set_station_attribute('CCCC',
+                                                 IDENTIFIER,
+                                                 suffix='_'+report_type)
+        elif (report_type is not None and report_type.startswith('amv')) or report_type == 'ascat':
+            result = self._set_station_attribute('satelliteIdentifier',
+                                                 IDENTIFIER,
+                                                 suffix='_{}_{}'.format(index, report_type))
+        elif report_type == 'ship':
+            result = self._set_station_attribute('shipOrMobileLandStationIdentifier',
+                                                 IDENTIFIER,
+                                                 suffix='_'+report_type)
+        elif report_type == 'buoy':
+            result = self._set_station_attribute('marineObservingPlatformIdentifier',
+                                                 IDENTIFIER,
+                                                 suffix='_'+report_type)
+        elif report_type == 'amdar':
+            result = self._set_station_attribute('aircraftRegistrationNumberOrOtherIdentification',
+                                                 IDENTIFIER,
+                                                 suffix='_'+report_type)
+        else:
+            LOGGER.error('error unknown report_type "%s"', report_type)
+            result = False
+
+        return result
+
+def make_dyndb_rows(data, report_count, report_type):
+    '''makes the rows for dynamodb upload'''
+    by_length = {len(data[key]):[] for key in data}
+    by_length[1] = []  # always include singleton length
+    for name, values in data.items():
+        by_length[len(values)].append(name)
+
+    rows = []
+    #Go through the fields in the file
+    for index in range(report_count):
+        ddb_row = ObsDBRow()
+
+        # Simplest case: one value for each report
+        for fieldname in by_length[report_count]:
+            ddb_row.set_attribute(fieldname, data[fieldname][index])
+
+        # Add all of the "singleton" fields that occur once in the file to this row
+        if report_count > 1:
+            for fieldname in by_length[1]:
+                ddb_row.set_attribute(fieldname, data[fieldname][0])
+
+        # special ascat code
+        if report_type == 'ascat':
+            if not 4*report_count in by_length:
+                #no data for any of the selected wind vectors, give up
+                return rows
+
+            if index >= len(data["indexOfSelectedWindVector"]):
+                #probably no scat data in the file at all ... but keep trying
+                continue
+            wi = data["indexOfSelectedWindVector"][index]
+            if not 1 <= wi <= 4:
+                # no windvector selected for this WVC
+                continue
+
+            #only include data from selected windfactor
+            for fieldname in by_length[4*report_count]:
+                value = data[fieldname][report_count * (wi-1) + index]
+                ddb_row.set_attribute(fieldname, value)
+
+        else: # for anything left over
+            for length in by_length:
+                if length not in [1, report_count]:
+                    for fieldname in by_length[length]:
+                        fieldsize = length / report_count
+                        if fieldsize > 0:  # there are at least report_count values
+                            validvalues = data[fieldname][index:index+fieldsize].compressed()
+                            if len(validvalues) > 0:
+                                ddb_row.set_attribute(fieldname, validvalues[0])
+
+                        #for old report types we try to use the index(th) element
+                        elif index < length and report_type in ["metar", "synop", "ship"]:
+                            ddb_row.set_attribute(fieldname, data[fieldname][index])
+
+                        # who really knows?  We'll use the first valid value
+                        else:
+                            ddb_row.set_attribute(fieldname, data[fieldname][0])
+                            if fieldname not in by_length[1]:
+                                by_length[1].append(fieldname)
+
+        #We must set the station identifier, lat,lon, (evelation) and time.
+        if ddb_row.set_station_id(report_type, index) and \
+           ddb_row.has_station_location() and \
+           ddb_row.set_report_time(index):
+
+            #add geohash
+            geo = Geohash.encode(float(ddb_row['latitude']['N']),
+                                 float(ddb_row['longitude']['N']),
+                                 2)
+            ddb_row.set_attribute('report_type_geohash', '{}_{}'.format(
+                report_type, geo))
+
+            rows.append(ddb_row)
+    return rows
@@ -0,0 +1,76 @@
+'''tests that BufrIndex finds the messages eccodes would read from a file'''
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from obs2aws import bufr_index
+
+TESTDATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'testdata')
+
+
+def reference_messages(contents):
+    '''the messages of contents read the way codes_bufr_new_from_file does: "BUFR", the
+    length in section 0, and a "7777" at the end of that, else look further on'''
+    messages = []
+    position = contents.find('BUFR')
+    while position >= 0:
+        length = struct.unpack('>I', '\0' + contents[position+4:position+7])[0]
+        message = contents[position:position+length]
+        if length >= 12 and len(message) == length and message.endswith('7777'):
+            messages.append(message)
+            position = contents.find('BUFR', position + length)
+        else:
+            position = contents.find('BUFR', position + 4)
+    return messages
+
+class BufrIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(TESTDATA, 'amv_20120214010000.bufr'), 'rb') as amv:
+            self.amv = amv.read()
+        self.message = reference_messages(self.amv)[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def index_of(self, contents):
+        '''the messages BufrIndex finds in a file of contents'''
+        path = os.path.join(self.directory, 'test.bufr')
+        with open(path, 'wb') as bufr:
+            bufr.write(contents)
+        with bufr_index.BufrIndex(path) as index:
+            messages = [str(index.message(each)) for each in range(len(index))]
+            offsets = index.offsets
+        #an index made from the offsets of another doesn't scan the file again
+        with bufr_index.BufrIndex(path, offsets) as index:
+            self.assertEqual([str(index.message(each)) for each in range(len(index))],
+                             messages)
+        return messages
+
+    def test_testdata(self):
+        for name in sorted(os.listdir(TESTDATA)):
+            with open(os.path.join(TESTDATA, name), 'rb') as bufr:
+                contents = bufr.read()
+            self.assertEqual(self.index_of(contents), reference_messages(contents))
+
+    def test_gts_bulletins(self):
+        contents = ''.join(['\x01\r\r\n%03d\r\r\nIUCN41 KWBC 140100\r\r\n' % each + self.message +
+                            '\r\r\n\x03' for each in range(3)])
+        self.assertEqual(self.index_of(contents), [self.message] * 3)
+
+    def test_false_starts_and_truncation(self):
+        contents = 'BUFR junk' + self.message + 'BUFR\xff\xff\xff' + self.message[:-1] + \
+            self.message + self.message[:100]
+        messages = self.index_of(contents)
+        self.assertEqual(messages, reference_messages(contents))
+        self.assertEqual(messages, [self.message] * 2)
+
+    def test_empty_file(self):
+        self.assertEqual(self.index_of(''), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,273 @@
+'''tests of decoding BUFR files message by message and in parallel, of filtering
+messages by their headers, of resolving accumulated fields and of translating METAR
+and TEMP reports, with eccodes faked'''
+import datetime
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import eccodes
+import numpy
+
+from obs2aws import obs2aws
+from obs2aws import decode
+from obs2aws import bufr_index
+from obs2aws import tools
+from tests import reference
+
+
+def bufr_message(number):
+    '''a BUFR message (as far as bufr_index can tell) holding number'''
+    body = ' %d ' % number
+    length = bufr_index.SECTION0_LENGTH + len(body) + len(bufr_index.END)
+    return bufr_index.START + struct.pack('>I', length)[1:] + '\x04' + body + \
+        bufr_index.END
+
+def fake_messages(index, report_type, field_lists, start, stop, header_filter=None,
+                  incomplete=None):
+    '''stands in for decode._iter_bufr_messages, each message holding the number in it
+    and the process which decoded it'''
+    for each in range(start, min(stop, len(index))):
+        number = int(str(index.message(each))[bufr_index.SECTION0_LENGTH:-4])
+        yield {'number': numpy.ma.masked_array([number]),
+               'pid': numpy.ma.masked_array([os.getpid()])}, 1
+
+class ParallelDecodeTest(unittest.TestCase):
+    def setUp(self):
+        self.iter_bufr_messages = decode._iter_bufr_messages
+        decode._iter_bufr_messages = fake_messages
+        self.directory = tempfile.mkdtemp()
+        self.pool = None
+
+    def tearDown(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        decode._iter_bufr_messages = self.iter_bufr_messages
+        shutil.rmtree(self.directory)
+
+    def bufr_file(self, name, count):
+        '''writes a file of count messages, returning its path'''
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as bufr:
+            bufr.write(''.join(bufr_message(each) for each in range(count)))
+        return path
+
+    def test_serial(self):
+        filename = self.bufr_file('synop_20170101000000_A.bufr', 5)
+        messages = decode.decode_file(filename, 'synop', [])
+        self.assertEqual([data['number'][0] for data, _ in messages], range(5))
+
+    def test_uses_the_pool_given_for_every_file(self):
+        self.pool = obs2aws.start_decoders(2)
+        pids = set()
+        for name, count in [('synop_20170101000000_A.bufr', 30),
+                            ('synop_20170101000000_B.bufr', 7)]:
+            messages = decode.decode_file(self.bufr_file(name, count), 'synop', [],
+                                          workers=2, pool=self.pool)
+            self.assertEqual([data['number'][0] for data, _ in messages], range(count))
+            pids.update(data['pid'][0] for data, _ in messages)
+        self.assertNotIn(os.getpid(), pids)
+        self.assertTrue(len(pids) <= 2)
+
+    def test_stopping_early_leaves_the_pool_running(self):
+        self.pool = obs2aws.start_decoders(2)
+        filename = self.bufr_file('synop_20170101000000_A.bufr', 30)
+        messages = decode.iter_decode_file(filename, 'synop', [], workers=2, pool=self.pool)
+        self.assertEqual(next(messages)[0]['number'][0], 0)
+        messages.close()
+        self.assertEqual(self.pool.apply(max, ([1, 2],)), 2)
+
+def codes_get(msgid, key):
+    '''stands in for eccodes.codes_get, the messages being dictionaries of their keys'''
+    try:
+        return msgid[key]
+    except KeyError:
+        raise eccodes.CodesInternalError(key)
+
+def header(year=2017, month=1, day=2, hour=3, **keys):
+    '''section 1 of a message'''
+    keys.update({'typicalYear': year, 'typicalMonth': month, 'typicalDay': day,
+                 'typicalHour': hour, 'typicalMinute': 4, 'typicalSecond': 5})
+    return keys
+
+class HeaderFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.codes_get = getattr(eccodes, 'codes_get', None)
+        eccodes.codes_get = codes_get
+
+    def tearDown(self):
+        eccodes.codes_get = self.codes_get
+
+    def test_typical_date_as_before(self):
+        for msgid in [header(), header(month=13), header(hour=24), {}]:
+            expected = reference.bufr_typical_timestamp(msgid)
+            result = decode.bufr_typical_timestamp(msgid)
+            if expected is None:
+                self.assertEqual(result, None)
+            else:
+                self.assertEqual(result.tolist(), expected.tolist())
+
+    def test_accepts_everything_by_default(self):
+        self.assertTrue(decode.HeaderFilter().accepts(header()))
+        self.assertTrue(decode.HeaderFilter().accepts({}))
+
+    def test_categories(self):
+        header_filter = decode.HeaderFilter(categories=[0, 2], sub_categories=[7],
+                                            centres=[74])
+        self.assertTrue(header_filter.accepts(header(dataCategory=2, dataSubCategory=7,
+                                                     bufrHeaderCentre=74)))
+        self.assertFalse(header_filter.accepts(header(dataCategory=1)))
+        self.assertFalse(header_filter.accepts(header(internationalDataSubCategory=8,
+                                                      dataSubCategory=7)))
+        self.assertFalse(header_filter.accepts(header(bufrHeaderCentre=98)))
+        #what can't be read doesn't reject the message
+        self.assertTrue(header_filter.accepts(header()))
+
+    def test_dates(self):
+        header_filter = decode.HeaderFilter(earliest=datetime.datetime(2017, 1, 2),
+                                            latest=datetime.datetime(2017, 1, 3))
+        self.assertTrue(header_filter.accepts(header()))
+        self.assertFalse(header_filter.accepts(header(day=1)))
+        self.assertFalse(header_filter.accepts(header(day=3)))
+        self.assertTrue(header_filter.accepts(header(month=13)))
+
+def random_masked(random, values):
+    '''values as a masked array with about a third of them masked'''
+    return numpy.ma.masked_array(values, mask=random.randint(3, size=len(values)) == 0)
+
+def time_periods(random):
+    '''the values, units and indexs of the time period descriptors of a message'''
+    count = random.randint(0, 8)
+    values = random_masked(random, random.randint(-6, 7, count))
+    units = [random.choice(['h', 'min']) for _ in range(count)]
+    indexs = numpy.ma.asarray(numpy.cumsum(random.randint(1, 3, count)))
+    return values, units, indexs
+
+class AccumulatedFieldsTest(unittest.TestCase):
+    def setUp(self):
+        self.decode_bufr_array = decode.decode_bufr_array
+        self.decode_bufr_array_attribute = decode.decode_bufr_array_attribute
+
+    def tearDown(self):
+        decode.decode_bufr_array = self.decode_bufr_array
+        decode.decode_bufr_array_attribute = self.decode_bufr_array_attribute
+
+    def test_time_periods_as_before(self):
+        random = numpy.random.RandomState(0)
+        for _ in range(2000):
+            values, units, indexs = time_periods(random)
+            self.assertEqual(tools.get_time_periods_from_fields(values, units, indexs)[0],
+                             reference.get_time_periods_from_fields(values, units, indexs)[0])
+
+    def test_fields_as_before(self):
+        random = numpy.random.RandomState(1)
+        for _ in range(2000):
+            time_titles, time_indexs = tools.get_time_periods_from_fields(*time_periods(random))
+            count = random.randint(1, 12)
+            values = random_masked(random, random.uniform(0, 10, count))
+            last_index = time_indexs[-1] + 2 if len(time_indexs) else 4
+            indexs = numpy.ma.asarray(numpy.sort(random.randint(0, last_index, count)))
+            if random.randint(4) == 0:
+                indexs = indexs[:random.randint(1, count + 1)]
+            decode.decode_bufr_array = lambda msgid, key, plan=None: values
+            decode.decode_bufr_array_attribute = \
+                lambda msgid, key, attribute, required_length=None, plan=None: indexs
+            for fieldname in ['rain@'] + ['rain@' + title for title in set(time_titles)]:
+                expected = reference.accumulated_field_arrays(fieldname, values, indexs,
+                                                              time_titles, time_indexs)
+                result = decode.process_message_get_field_array(None, fieldname, time_titles,
+                                                                time_indexs)
+                self.assertEqual(sorted(result), sorted(expected))
+                for key in result:
+                    self.assertEqual(result[key].dtype.kind, expected[key].dtype.kind)
+                    self.assertEqual(result[key].tolist(), expected[key].tolist())
+
+def metar_data(random, count, wind_units=None):
+    '''what eccodes decodes from a metar message, with some of each field masked'''
+    def strings(values):
+        return random_masked(random, numpy.array(values))
+    data = {'CCCC': strings(['K%03d' % each for each in random.randint(0, 999, count)]),
+            'latitude': random_masked(random, random.uniform(-90, 90, count)),
+            'longitude': random_masked(random, random.uniform(-180, 180, count)),
+            'elevation': random_masked(random, random.randint(0, 3000, count)),
+            'day': strings(['%02d' % each for each in random.randint(1, 29, count)]),
+            'hour': strings(['%02d' % each for each in random.randint(0, 24, count)]),
+            'minute': strings(['%02d' % each for each in random.randint(0, 60, count)]),
+            'windDirection': strings([random.choice(['VRB', '%03d' % (10 * each)])
+                                      for each in random.randint(0, 37, count)]),
+            'temperature': random_masked(random, random.uniform(-40, 40, count).round()),
+            'dewPointTemperature': strings([random.choice(['%02d', 'M%02d']) % each
+                                            for each in random.randint(0, 30, count)]),
+            'qnhInHectoPascal': strings(['Q%04d' % each
+                                         for each in random.randint(950, 1050, count)]),
+            'qnhInHundrethsOfInchOfMercury': strings(['A%04d' % each for each in
+                                                      random.randint(2800, 3100, count)]),
+            'windSpeed': strings(['%02d' % each for each in random.randint(0, 60, count)])}
+    if wind_units is not None:
+        data['windUnits'] = numpy.ma.masked_array([wind_units])
+    return data
+
+class MetarTest(unittest.TestCase):
+    def setUp(self):
+        tools._SI_CONVERSIONS.clear()
+
+    def test_as_before(self):
+        random = numpy.random.RandomState(2)
+        for count in [1, 2, 40]:
+            for wind_units in [None, 'KT', 'MPS', 'knots']:
+                data = metar_data(random, count, wind_units)
+                expected = reference.translate_metar_data(data, '20170102030405')
+                result = decode.translate_metar_data(data, '20170102030405')
+                self.assertEqual(sorted(result), sorted(expected))
+                for key in result:
+                    self.assertEqual(result[key].tolist(), expected[key].tolist())
+
+def temp_message(random, report_count):
+    '''a decoded temp message, its levels displaced from where the sonde was launched'''
+    extra = random.randint(3)
+    def masked_levels(values):
+        #extra levels are masked, so there are still enough to decode the displacements
+        values = numpy.ma.masked_array(values)
+        values[random.permutation(len(values))[:extra]] = numpy.ma.masked
+        return values
+    return {'year': numpy.ma.asarray([2016 + random.randint(3)]),
+            'month': numpy.ma.asarray([random.randint(1, 13)]),
+            'day': numpy.ma.asarray([random.randint(1, 29)]),
+            'hour': numpy.ma.asarray([random.randint(24)]),
+            'minute': numpy.ma.asarray([random.randint(60)]),
+            'second': numpy.ma.asarray([random.randint(60)]),
+            'latitude': numpy.ma.asarray([random.uniform(-80, 80)]),
+            'longitude': numpy.ma.asarray([random.choice([-179.9, 179.9, 0.0])]),
+            'timePeriod': random_masked(random, numpy.cumsum(random.uniform(0, 30.5,
+                                                                            report_count))),
+            'latitudeDisplacement': masked_levels(random.uniform(-0.5, 0.5,
+                                                                 report_count + extra)),
+            'longitudeDisplacement': masked_levels(random.uniform(-0.5, 0.5,
+                                                                  report_count + extra)),
+            'airTemperature': random_masked(random, random.uniform(200, 300, report_count))}
+
+class TempReportTest(unittest.TestCase):
+    def test_as_before(self):
+        random = numpy.random.RandomState(3)
+        for _ in range(200):
+            report_count = random.randint(1, 60)
+            data = temp_message(random, report_count)
+            expected = reference.decode_temp_report(data, report_count)
+            result = decode.decode_temp_report(data, report_count)
+            self.assertEqual(tools.epoch_to_timestamps(result.pop(tools.EPOCH)).tolist(),
+                             expected.pop('datetime').tolist())
+            self.assertEqual(sorted(result), sorted(expected))
+            for key in result:
+                self.assertEqual(result[key].tolist(), expected[key].tolist())
+
+    def test_too_few_displacements(self):
+        data = temp_message(numpy.random.RandomState(4), 10)
+        data['latitudeDisplacement'][:] = numpy.ma.masked
+        self.assertTrue(decode.decode_temp_report(data, 10) is data)
+
+
+if __name__ == '__main__':
+    unittest.main()
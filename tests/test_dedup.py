@@ -0,0 +1,132 @@
+'''tests of the Deduplicator, which only keeps the hashes of files the journal has
+written everywhere'''
+import unittest
+
+from obs2aws import dedup
+from obs2aws import journal
+from tests.test_journal import DESTINATIONS, JournalTestCase
+
+
+class WhenDoneTest(JournalTestCase):
+    def test_when_done(self):
+        filename = self.obs_file('amv_20170101000000_A.bufr')
+        progress = journal.ProgressJournal(self.journal_path)
+        calls = []
+        progress.when_done(filename, ['ddb:recent', 's3:recent'],
+                           lambda: calls.append('done'), lambda: calls.append('failed'))
+        progress.record(filename, 'ddb:recent')
+        self.assertEqual(calls, [])
+        progress.record(filename, 's3:recent')
+        self.assertEqual(calls, ['done'])
+        progress.record_failure(filename, 's3:recent')
+        self.assertEqual(calls, ['done'])
+        progress.close()
+
+class DeduplicatorTest(JournalTestCase):
+    def setUp(self):
+        JournalTestCase.setUp(self)
+        self.progress = journal.ProgressJournal(self.journal_path, sync=False)
+        self.seen = dedup.SeenSet(self.seen_path)
+        self.dedup = dedup.Deduplicator(self.seen, journal=self.progress)
+
+    def tearDown(self):
+        self.progress.close()
+        self.seen.close()
+        JournalTestCase.tearDown(self)
+
+    def reopen(self):
+        '''a new journal, SeenSet and Deduplicator from the same files, as after a restart'''
+        self.progress.close()
+        self.seen.close()
+        self.progress = journal.ProgressJournal(self.journal_path, sync=False)
+        self.seen = dedup.SeenSet(self.seen_path)
+        self.dedup = dedup.Deduplicator(self.seen, journal=self.progress)
+
+    def test_duplicates(self):
+        first = self.obs_file('amv_20170101000000_A.bufr')
+        copy = self.obs_file('amv_20170101000000_B.bufr')
+        self.assertEqual(self.dedup.claim(first, DESTINATIONS)[0], None)
+        self.assertEqual(self.dedup.claim(copy, DESTINATIONS), None)
+        self.assertEqual(self.dedup.duplicate_files, 1)
+
+    def test_hashes_kept_once_written_everywhere(self):
+        first = self.obs_file('amv_20170101000000_A.bufr')
+        self.dedup.claim(first, DESTINATIONS)
+        for destination in DESTINATIONS[:-1]:
+            self.progress.record(first, destination)
+        self.reopen()
+        self.assertEqual(len(self.seen), 0)
+
+        self.progress.record(first, DESTINATIONS[-1])
+        copy = self.obs_file('amv_20170101000000_B.bufr')
+        self.assertNotEqual(self.dedup.claim(copy, DESTINATIONS), None)
+        for destination in DESTINATIONS:
+            self.progress.record(copy, destination)
+        self.reopen()
+        self.assertEqual(len(self.seen), 1)
+        another = self.obs_file('amv_20170101000001_C.bufr')
+        self.assertEqual(self.dedup.claim(another, DESTINATIONS), None)
+
+    def test_failed_write_releases_hashes(self):
+        first = self.obs_file('amv_20170101000000_A.bufr')
+        self.dedup.claim(first, DESTINATIONS)
+        self.progress.record(first, 'ddb:recent')
+        self.progress.record_failure(first, 'ddb:archive')
+        self.assertEqual(len(self.seen), 0)
+        copy = self.obs_file('amv_20170101000000_B.bufr')
+        self.assertNotEqual(self.dedup.claim(copy, DESTINATIONS), None)
+
+    def test_partly_written_file_is_not_checked(self):
+        first = self.obs_file('amv_20170101000000_A.bufr')
+        self.progress.record(first, 'ddb:recent')
+        self.reopen()
+        self.assertEqual(self.dedup.claim(first, DESTINATIONS), (None, []))
+        self.assertEqual(len(self.seen), 0)
+
+    def test_copy_skipped_for_a_failed_file_is_retried(self):
+        first = self.obs_file('amv_20170101000000_A.bufr')
+        copy = self.obs_file('amv_20170101000000_B.bufr')
+        self.dedup.claim(first, DESTINATIONS)
+        self.assertEqual(self.dedup.claim(copy, DESTINATIONS), None)
+        self.progress.record_failure(first, 'ddb:recent')
+        self.assertEqual(self.dedup.retries(), [copy])
+        self.assertEqual(self.dedup.retries(), [])
+        self.assertNotEqual(self.dedup.claim(copy, DESTINATIONS), None)
+
+    def test_copy_skipped_for_a_written_file_is_not_retried(self):
+        first = self.obs_file('amv_20170101000000_A.bufr')
+        copy = self.obs_file('amv_20170101000000_B.bufr')
+        self.dedup.claim(first, DESTINATIONS)
+        self.dedup.claim(copy, DESTINATIONS)
+        for destination in DESTINATIONS:
+            self.progress.record(first, destination)
+        self.assertEqual(self.dedup.skipped, {})
+        self.assertEqual(self.dedup.retries(), [])
+
+class NoJournalTest(JournalTestCase):
+    def setUp(self):
+        JournalTestCase.setUp(self)
+        self.seen = dedup.SeenSet(self.seen_path)
+        self.dedup = dedup.Deduplicator(self.seen)
+
+    def tearDown(self):
+        self.seen.close()
+        JournalTestCase.tearDown(self)
+
+    def test_finish_keeps_hashes_of_written_files(self):
+        written = self.obs_file('amv_20170101000000_A.bufr')
+        failed = self.obs_file('amv_20170101000000_B.bufr', 'other BUFR contents')
+        copy = self.obs_file('amv_20170101000000_C.bufr', 'other BUFR contents')
+        self.dedup.claim(written)
+        self.dedup.claim(failed)
+        self.assertEqual(self.dedup.claim(copy), None)
+        self.dedup.finish([written, failed, copy], [failed])
+        self.assertEqual(self.dedup.claims, {})
+        self.assertEqual(self.dedup.retries(), [copy])
+        self.seen.close()
+        self.seen = dedup.SeenSet(self.seen_path)
+        self.assertEqual(len(self.seen), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+'''tests of the batching, retries and written item cache of DynDBWriter, against a
+fake DynamoDB client'''
+import threading
+import unittest
+
+from botocore.exceptions import ClientError
+
+from obs2aws.writers import dyndb_writer
+
+
+class FakeClient(object):
+    """Stores the items of batch_write_item, leaving those whose obs_id is in
+    unprocessed (as many times as it says) unprocessed, and raising error if set"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = {}
+        self.requests = []
+        self.unprocessed = {} #obs_id: times to leave it unprocessed, -1 for always
+        self.error = None
+
+    def describe_table(self, TableName):
+        return {'Table': {'TableName': TableName}} #on demand, so no token buckets
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity=None):
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            (table_name, requests), = RequestItems.items()
+            self.requests.append(requests)
+            unprocessed = []
+            for request in requests:
+                item = request['PutRequest']['Item']
+                times = self.unprocessed.get(item['obs_id']['S'], 0)
+                if times:
+                    self.unprocessed[item['obs_id']['S']] = times - 1
+                    unprocessed.append(request)
+                else:
+                    self.items[(table_name,) + dyndb_writer.item_key(item)] = item
+            return {'UnprocessedItems': {table_name: unprocessed} if unprocessed else {}}
+
+class FakeWriter(dyndb_writer.DynDBWriter):
+    """a DynDBWriter of table 'recent' with a FakeClient"""
+    def __init__(self):
+        self.status = 'test'
+        self.region = 'test-region'
+        self.table_name = 'recent'
+        self.client = FakeClient()
+        self._init_batches()
+
+def row(obs_id, value=0, ttl=None):
+    '''a ddb item'''
+    item = {'obs_id': {'S': obs_id}, 'datetime': {'S': '20170101000000'},
+            'value': {'N': str(value)}}
+    if ttl is not None:
+        item['ttl'] = {'N': str(ttl)}
+    return item
+
+class DynDBWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.backoff = dyndb_writer.BACKOFF_SECONDS
+        dyndb_writer.BACKOFF_SECONDS = 0.001
+        self.writer = FakeWriter()
+        self.client = self.writer.client
+
+    def tearDown(self):
+        dyndb_writer.BACKOFF_SECONDS = self.backoff
+
+    def test_batches(self):
+        for each in range(60):
+            self.writer.write(row('s%d' % each), 'f1')
+        self.writer.write(row('s0', 9), 'f1')
+        self.assertEqual(self.writer.flush(), [])
+        self.assertEqual(len(self.client.items), 60)
+        self.assertEqual(self.client.items[('recent', 's0', '20170101000000')]['value'],
+                         {'N': '9'})
+        for requests in self.client.requests:
+            self.assertTrue(len(requests) <= dyndb_writer.BATCH_SIZE)
+            keys = [dyndb_writer.item_key(request['PutRequest']['Item'])
+                    for request in requests]
+            self.assertEqual(len(set(keys)), len(keys))
+
+    def test_retries_unprocessed_items(self):
+        self.client.unprocessed = {'s1': 2, 's2': 1}
+        for each in range(5):
+            self.writer.write(row('s%d' % each), 'f1')
+        self.assertEqual(self.writer.flush(), [])
+        self.assertEqual(len(self.client.items), 5)
+        self.assertEqual([len(requests) for requests in self.client.requests], [5, 2, 1])
+
+    def test_reports_sources_still_unprocessed(self):
+        self.client.unprocessed = {'bad': -1}
+        self.writer.write(row('good'), 'f1')
+        self.writer.write(row('bad'), 'f2')
+        self.assertEqual(self.writer.flush(), ['f2'])
+        self.assertEqual(len(self.client.requests), dyndb_writer.BATCH_RETRIES + 1)
+        self.assertEqual(self.writer.flush(), [])
+
+    def test_reports_sources_of_failed_batch(self):
+        self.client.error = ClientError({'Error': {'Code': 'ValidationException',
+                                                   'Message': 'bad item'}},
+                                        'BatchWriteItem')
+        self.writer.write(row('s1'), 'f1')
+        self.writer.write(row('s2'), 'f2')
+        self.assertEqual(sorted(self.writer.flush()), ['f1', 'f2'])
+
+    def test_flush_waits_for_other_sends(self):
+        self.assertTrue(self.writer.provisioner.wait('recent'))
+        self.client.unprocessed = dict(('s%d' % each, -1) for each in range(25))
+        sending = threading.Event()
+        carry_on = threading.Event()
+        send_batch = self.writer._send_batch
+        def blocked_send_batch(table_name, batch):
+            sending.set()
+            carry_on.wait()
+            send_batch(table_name, batch)
+        self.writer._send_batch = blocked_send_batch
+        thread = threading.Thread(target=lambda: [self.writer.write(row('s%d' % each), 'f1')
+                                                  for each in range(25)])
+        thread.daemon = True
+        thread.start()
+        flushed = []
+        try:
+            self.assertTrue(sending.wait(5.0))
+            flusher = threading.Thread(target=lambda: flushed.append(self.writer.flush()))
+            flusher.daemon = True
+            flusher.start()
+            flusher.join(0.2)
+            self.assertEqual(flushed, []) #still waiting for the full batch
+        finally:
+            carry_on.set()
+        thread.join()
+        flusher.join()
+        self.assertEqual(flushed, [['f1']])
+
+    def test_skips_unchanged_items(self):
+        self.writer.write(row('s1', 1, ttl=100), 'f1')
+        self.writer.flush()
+        self.writer.write(row('s1', 1, ttl=200), 'f2') #only volatile attributes changed
+        self.writer.write(row('s1', 2), 'f3')
+        self.writer.flush()
+        self.assertEqual(self.writer.saved_writes, 1)
+        self.assertEqual(sum(len(requests) for requests in self.client.requests), 2)
+
+    def test_unprocessed_items_are_not_cached(self):
+        self.client.unprocessed = {'s1': -1}
+        self.writer.write(row('s1'), 'f1')
+        self.assertEqual(self.writer.flush(), ['f1'])
+        self.client.unprocessed = {}
+        self.writer.write(row('s1'), 'f2')
+        self.assertEqual(self.writer.flush(), [])
+        self.assertEqual(self.writer.saved_writes, 0)
+        self.assertEqual(len(self.client.items), 1)
+
+class WrittenCacheTest(unittest.TestCase):
+    def test_forgets_oldest(self):
+        cache = dyndb_writer.WrittenCache(max_items=2)
+        cache.add('recent', [(('a',), 'x'), (('b',), 'y'), (('c',), 'z')])
+        self.assertFalse(cache.unchanged('recent', ('a',), 'x'))
+        self.assertTrue(cache.unchanged('recent', ('c',), 'z'))
+        self.assertFalse(cache.unchanged('recent', ('c',), 'changed'))
+        self.assertFalse(cache.unchanged('archive', ('c',), 'z'))
+
+if __name__ == '__main__':
+    unittest.main()
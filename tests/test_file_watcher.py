@@ -0,0 +1,108 @@
+'''tests that DirectoryWatcher finds the files find_files_to_process (tests/reference.py)
+found, in the same order, and then the ones which arrive'''
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from obs2aws import file_watcher
+from obs2aws import obs2aws
+from tests import reference
+
+
+class DirectoryWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ['synop', 'amv', 'empty']:
+            os.mkdir(os.path.join(self.directory, name))
+        self.patterns = [os.path.join(self.directory, 'synop', '*.bufr'),
+                         os.path.join(self.directory, 'amv', 'amv_*'),
+                         os.path.join(self.directory, 'empty', '*'),
+                         os.path.join(self.directory, 'missing', '*')]
+        random = numpy.random.RandomState(0)
+        timestamps = random.permutation(200) + 20170101000000
+        for each, timestamp in enumerate(timestamps[:100]):
+            kind = ['synop', 'amv'][each % 2]
+            self.write(kind, '%s_%d_%d.bufr' % (kind, timestamp, each))
+        #files which don't match, or aren't observation files
+        self.write('synop', 'synop_20170101000000.txt')
+        self.write('synop', 'nounderscore.bufr')
+        self.write('amv', 'synop_20170101000000_A.bufr')
+        self.later = timestamps[100:]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, kind, name):
+        '''writes an observation file, the path of which it returns'''
+        path = os.path.join(self.directory, kind, name)
+        with open(path, 'w') as obs:
+            obs.write(name)
+        return path
+
+    def watcher(self, inotify=True):
+        '''a started DirectoryWatcher of the patterns, polling if not inotify'''
+        watcher = file_watcher.DirectoryWatcher(self.patterns, poll_seconds=0.01)
+        if inotify:
+            watcher.start()
+            if watcher.inotify is None:
+                self.skipTest('inotify is not available')
+        else:
+            watcher.scan()
+        return watcher
+
+    def test_find_files_to_process(self):
+        expected = reference.find_files_to_process(self.patterns)
+        self.assertEqual(len(expected), 100)
+        self.assertEqual(obs2aws.find_files_to_process(self.patterns), expected)
+
+    def test_files_already_there(self):
+        expected = reference.find_files_to_process(self.patterns)
+        for inotify in [True, False]:
+            watcher = self.watcher(inotify)
+            try:
+                self.assertEqual(watcher.wait(0), expected)
+                self.assertEqual(watcher.wait(0), [])
+            finally:
+                watcher.close()
+
+    def test_files_which_arrive(self):
+        for inotify in [True, False]:
+            watcher = self.watcher(inotify)
+            try:
+                watcher.wait(0)
+                arrived = [self.write('amv', 'amv_%d_%s.bufr' % (timestamp, inotify))
+                           for timestamp in self.later[:50]]
+                filenames = []
+                for _ in range(100):
+                    if len(filenames) == len(arrived):
+                        break
+                    batch = watcher.wait(0.01)
+                    #each list comes oldest first
+                    self.assertEqual(batch, sorted(batch, key=file_watcher.timestamp_key))
+                    filenames.extend(batch)
+                self.assertEqual(sorted(filenames), sorted(arrived))
+            finally:
+                watcher.close()
+
+class PendingFilesTest(unittest.TestCase):
+    def test_as_sorted(self):
+        random = numpy.random.RandomState(1)
+        names = ['/obs/synop_%d_%d.bufr' % (timestamp, each) for each, timestamp in
+                 enumerate(random.randint(20170101000000, 20170101000050, 200))]
+        pending = file_watcher.PendingFiles()
+        for name in names + names[:20] + ['/obs/nounderscore']:
+            pending.push(name)
+        pending.discard(names[0])
+        expected = sorted(set(names[1:]), key=file_watcher.timestamp_key)
+        result = pending.pop_all()
+        self.assertEqual([file_watcher.timestamp_key(name) for name in result],
+                         [file_watcher.timestamp_key(name) for name in expected])
+        self.assertEqual(sorted(result), sorted(expected))
+        self.assertEqual(len(pending), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+'''tests of resuming from a ProgressJournal'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from obs2aws import journal
+
+DESTINATIONS = journal.file_destinations('amv', ['recent', 'archive'])
+
+
+class JournalTestCase(unittest.TestCase):
+    """a temporary directory to write the journal and observation files in"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.directory, 'journal')
+        self.seen_path = os.path.join(self.directory, 'seen')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def obs_file(self, name, contents='BUFR contents'):
+        '''writes an observation file, returning its path'''
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as obs:
+            obs.write(contents)
+        return path
+
+class ProgressJournalTest(JournalTestCase):
+    def test_resumes(self):
+        filename = self.obs_file('amv_20170101000000_A.bufr')
+        progress = journal.ProgressJournal(self.journal_path)
+        progress.record(filename, 'ddb:recent')
+        progress.record(filename, 's3:recent')
+        progress.close()
+        with open(self.journal_path, 'a') as partial:
+            partial.write(filename + '\tpartly written')
+        progress = journal.ProgressJournal(self.journal_path)
+        self.assertEqual(progress.remaining(filename, DESTINATIONS),
+                         ['ddb:archive', 's3:archive'])
+        progress.close()
+
+    def test_rewritten_file_is_not_done(self):
+        filename = self.obs_file('amv_20170101000000_A.bufr')
+        progress = journal.ProgressJournal(self.journal_path)
+        for destination in DESTINATIONS:
+            progress.record(filename, destination)
+        self.assertEqual(progress.remaining(filename, DESTINATIONS), [])
+        self.obs_file('amv_20170101000000_A.bufr', 'different BUFR contents')
+        self.assertEqual(progress.remaining(filename, DESTINATIONS), DESTINATIONS)
+        progress.close()
+
+    def test_compact_drops_files_which_have_gone(self):
+        kept = self.obs_file('amv_20170101000000_A.bufr')
+        gone = self.obs_file('amv_20170101000000_B.bufr')
+        progress = journal.ProgressJournal(self.journal_path)
+        progress.record(kept, 'ddb:recent')
+        progress.record(gone, 'ddb:recent')
+        os.remove(gone)
+        progress.compact()
+        progress.close()
+        with open(self.journal_path) as lines:
+            self.assertEqual([line.split('\t')[0] for line in lines], [kept])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+'''tests that the rows, and their attributes, made from decoded messages are the ones the
+report by report code (tests/reference.py) made'''
+import calendar
+import copy as copying
+import time
+import unittest
+
+import numpy
+
+from obs2aws import obs2aws
+from obs2aws import decode
+from obs2aws import dynamo_db
+from tests import reference
+
+
+def masked(values, every=None, seed=0):
+    '''values as a masked array with roughly one in every of them masked'''
+    values = numpy.asarray(values)
+    mask = numpy.zeros(len(values), dtype=bool)
+    if every is not None:
+        mask = numpy.random.RandomState(seed).randint(every, size=len(values)) == 0
+    return numpy.ma.masked_array(values, mask=mask)
+
+def time_fields(report_count, random, every=None):
+    '''random raw time fields, some of them out of range, and some masked'''
+    return {'year': masked(random.randint(2016, 2019, report_count), every, 1),
+            'month': masked(random.randint(1, 14, report_count), every, 2),
+            'day': masked(random.randint(1, 32, report_count), every, 3),
+            'hour': masked(random.randint(0, 24, report_count), every, 4),
+            'minute': masked(random.randint(0, 60, report_count), every, 5),
+            'second': masked(random.randint(0, 61, report_count), 4, 6)}
+
+def synop_message(report_count, random):
+    '''a decoded synop message, with singleton and repeated fields'''
+    data = time_fields(report_count, random, every=20)
+    data.update({'blockNumber': masked(random.randint(1, 99, report_count), 30, 7),
+                 'stationNumber': masked(random.randint(1, 999, report_count)),
+                 'latitude': masked(random.uniform(-95, 95, report_count), 30, 8),
+                 'longitude': masked(random.uniform(-185, 185, report_count)),
+                 'airTemperature': masked(random.uniform(250, 300, report_count), 5, 9),
+                 'cloudType': masked(random.randint(0, 10, 3 * report_count), 2, 10),
+                 'centre': masked([74])})
+    return data
+
+def amv_message(report_count, random):
+    '''a decoded amv message, sharing its time'''
+    data = dict((name, values[:1]) for name, values in
+                time_fields(1, random).items())
+    data.update({'satelliteIdentifier': masked(['M%02d' % each for each in
+                                                random.randint(8, 12, report_count)]),
+                 'latitude': masked(random.uniform(-60, 60, report_count)),
+                 'longitude': masked(random.uniform(-60, 60, report_count)),
+                 'windSpeed': masked(random.uniform(0, 50, report_count), 6, 11)})
+    return data
+
+def ascat_message(report_count, random):
+    '''a decoded ascat message, with four wind vectors for each report'''
+    data = time_fields(report_count, random, every=20)
+    data.update({'satelliteIdentifier': masked(['4'] * report_count),
+                 'latitude': masked(random.uniform(-90, 90, report_count)),
+                 'longitude': masked(random.uniform(-180, 180, report_count)),
+                 'indexOfSelectedWindVector': masked(random.randint(0, 6, report_count),
+                                                     10, 12),
+                 'windSpeedAt10M': masked(random.uniform(0, 30, 4 * report_count), 7, 13)})
+    return data
+
+def copy(data):
+    '''a copy of data with copies of its arrays'''
+    return dict((name, values.copy()) for name, values in data.items())
+
+class RowsTest(unittest.TestCase):
+    def assert_rows(self, data, report_count, report_type):
+        expected = reference.make_dyndb_rows(copy(data), report_count, report_type)
+        rows = obs2aws.make_dyndb_rows(decode.add_epoch_seconds(copy(data), report_count),
+                                       report_count, report_type)
+        self.assertTrue(len(expected) > 0)
+        self.assertEqual(len(rows), len(expected))
+        for row, expected_row in zip(rows, expected):
+            self.assertEqual(row, expected_row)
+
+    def test_synop(self):
+        random = numpy.random.RandomState(0)
+        self.assert_rows(synop_message(500, random), 500, 'synop')
+
+    def test_amv(self):
+        random = numpy.random.RandomState(1)
+        self.assert_rows(amv_message(300, random), 300, 'amv')
+
+    def test_ascat(self):
+        random = numpy.random.RandomState(2)
+        self.assert_rows(ascat_message(400, random), 400, 'ascat')
+
+    def test_ascat_selected_wind_vectors(self):
+        random = numpy.random.RandomState(5)
+        for _ in range(20):
+            report_count = random.randint(1, 80)
+            data = ascat_message(report_count, random)
+            data['windDirectionAt10M'] = masked(random.uniform(0, 360, 4 * report_count), 3)
+            #too few selected wind vectors, perhaps none, for all of the reports
+            shortened = copy(data)
+            shortened['indexOfSelectedWindVector'] = \
+                data['indexOfSelectedWindVector'][:random.randint(report_count)]
+            for message in [data, shortened]:
+                expected = reference.make_dyndb_rows(copy(message), report_count, 'ascat')
+                rows = obs2aws.make_dyndb_rows(
+                    decode.add_epoch_seconds(copy(message), report_count),
+                    report_count, 'ascat')
+                self.assertEqual(rows, expected)
+
+    def test_ascat_without_wind_vectors(self):
+        data = ascat_message(10, numpy.random.RandomState(6))
+        del data['windSpeedAt10M']
+        self.assertEqual(reference.make_dyndb_rows(copy(data), 10, 'ascat'), [])
+        self.assertEqual(obs2aws.make_dyndb_rows(decode.add_epoch_seconds(data, 10), 10,
+                                                 'ascat'), [])
+
+    def test_masked_seconds_count_as_zero(self):
+        data = {'blockNumber': masked([3, 3]), 'stationNumber': masked([772, 773]),
+                'latitude': masked([51.5, 52.0]), 'longitude': masked([-0.1, 0.5]),
+                'year': masked([2017, 2017]), 'month': masked([1, 1]), 'day': masked([2, 2]),
+                'hour': masked([12, 12]), 'minute': masked([0, 30]),
+                'second': numpy.ma.masked_array([0, 0], mask=[True, True])}
+        rows = obs2aws.make_dyndb_rows(decode.add_epoch_seconds(data, 2), 2, 'synop')
+        self.assertEqual([row['datetime']['S'] for row in rows],
+                         ['20170102120000', '20170102123000'])
+
+class ColumnAttributesTest(unittest.TestCase):
+    def assert_attributes(self, values):
+        '''the attributes of a column of values are those set_attribute gave each value'''
+        expected = []
+        for value in values:
+            row = reference.ObsDBRow()
+            row.set_attribute('name', value)
+            expected.append(row.get('name'))
+        batch = dynamo_db.RowBatch(len(values))
+        batch.set_column('name', numpy.ma.getdata(values), ~numpy.ma.getmaskarray(values))
+        self.assertEqual(batch.column_attributes('name'), expected)
+
+    def test_numbers(self):
+        random = numpy.random.RandomState(4)
+        self.assert_attributes(masked(random.uniform(-1e6, 1e6, 200), 5))
+        self.assert_attributes(masked(numpy.array([0.0, -0.0, 1e-7, 5e-7, 1e20, 2.5e-6])))
+        self.assert_attributes(masked(random.randint(-2**40, 2**40, 200), 5))
+
+    def test_strings(self):
+        self.assert_attributes(masked(['EGLL', '', ' ', '\xff\xff\xff\xff', '\xffA', 'x'], 3))
+
+    def test_objects(self):
+        self.assert_attributes(numpy.ma.masked_array([1.5, None, 'M05', '', 7, '\xff'],
+                                                     dtype=object))
+
+class RowBatchTest(unittest.TestCase):
+    def test_destination_views_as_copied_rows(self):
+        data = synop_message(300, numpy.random.RandomState(7))
+        rows = reference.make_dyndb_rows(copy(data), 300, 'synop')
+        batch = obs2aws.make_row_batch(decode.add_epoch_seconds(copy(data), 300), 300, 'synop')
+        for s3key, ttl in [('s3://bucket/synop/key', 1.5e9), ('', None), ('key', 1490000000)]:
+            expected = []
+            for ddb_row in rows:
+                ddb_row_copy = copying.copy(ddb_row)
+                ddb_row_copy.set_attribute('s3key', s3key)
+                ddb_row_copy.set_attribute('ttl', ttl)
+                expected.append(ddb_row_copy)
+            self.assertEqual(list(batch.with_overlay(s3key=s3key, ttl=ttl)), expected)
+        #the views share the batch's columns, which are left as they were
+        self.assertEqual(list(batch), rows)
+
+    def test_row_epochs(self):
+        data = synop_message(100, numpy.random.RandomState(8))
+        for row in obs2aws.make_dyndb_rows(decode.add_epoch_seconds(data, 100), 100, 'synop'):
+            self.assertEqual(row.epoch, calendar.timegm(time.strptime(row['datetime']['S'],
+                                                                      '%Y%m%d%H%M%S')))
+
+    def test_take(self):
+        data = synop_message(100, numpy.random.RandomState(9))
+        batch = obs2aws.make_row_batch(decode.add_epoch_seconds(data, 100), 100, 'synop')
+        rows = list(batch)
+        wanted = numpy.arange(len(batch)) % 3 == 0
+        taken = list(batch.take(wanted))
+        self.assertEqual(taken, [row for row, keep in zip(rows, wanted) if keep])
+        self.assertEqual([row.epoch for row in taken],
+                         [row.epoch for row, keep in zip(rows, wanted) if keep])
+
+
+if __name__ == '__main__':
+    unittest.main()
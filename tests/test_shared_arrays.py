@@ -0,0 +1,66 @@
+'''tests that messages come back from shared memory as they went in'''
+import os
+import unittest
+
+import numpy
+
+from obs2aws import shared_arrays
+
+
+def messages():
+    '''decoded messages with the kinds of array decode makes'''
+    random = numpy.random.RandomState(0)
+    return [({'airTemperature': numpy.ma.masked_array(random.uniform(250, 300, 7),
+                                                      mask=random.randint(2, size=7) == 0),
+              'stationNumber': numpy.ma.masked_array(random.randint(0, 999, 7)),
+              'epoch': numpy.ma.masked_array(random.randint(0, 2**40, 7).astype(numpy.int64),
+                                             mask=[True] * 7),
+              'CCCC': numpy.ma.masked_array(['EGLL', 'NZAA', ''], fill_value='X'),
+              'objects': numpy.ma.masked_array([u'a', None, 3], dtype=object),
+              'empty': numpy.ma.masked_array([], dtype=float),
+              'levels': numpy.ma.masked_array(random.uniform(0, 1, (3, 4)))}, 7),
+            ({'latitude': numpy.ma.masked_array([51.5], mask=[False])}, 1)]
+
+class SharedArraysTest(unittest.TestCase):
+    def assert_same(self, values, expected):
+        self.assertEqual(values.dtype, expected.dtype)
+        self.assertEqual(values.shape, expected.shape)
+        self.assertEqual(numpy.ma.getmaskarray(values).tolist(),
+                         numpy.ma.getmaskarray(expected).tolist())
+        self.assertEqual(numpy.ma.getdata(values).tolist(),
+                         numpy.ma.getdata(expected).tolist())
+        self.assertEqual(values.fill_value, expected.fill_value)
+
+    def test_round_trip(self):
+        expected = messages()
+        path, layout = shared_arrays.export_messages(messages())
+        result = shared_arrays.import_messages(path, layout)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(len(result), len(expected))
+        for (data, report_count), (expected_data, expected_count) in zip(result, expected):
+            self.assertEqual(report_count, expected_count)
+            self.assertEqual(sorted(data), sorted(expected_data))
+            for name in data:
+                self.assert_same(data[name], expected_data[name])
+
+    def test_arrays_can_be_changed(self):
+        path, layout = shared_arrays.export_messages(messages())
+        data = shared_arrays.import_messages(path, layout)[0][0]
+        data['airTemperature'][0] = 1.0
+        data['airTemperature'][1] = numpy.ma.masked
+        self.assertEqual(data['airTemperature'][0], 1.0)
+        self.assertTrue(data['airTemperature'][1] is numpy.ma.masked)
+
+    def test_no_messages(self):
+        path, layout = shared_arrays.export_messages([])
+        self.assertEqual(shared_arrays.import_messages(path, layout), [])
+        self.assertFalse(os.path.exists(path))
+
+    def test_discard(self):
+        path, _ = shared_arrays.export_messages(messages())
+        shared_arrays.discard(path)
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+'''tests of the vectorised station lookups of StationDetails'''
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from obs2aws import station_details
+
+NOAA_STATIONS = ('93;246;NZRO;Rotorua Aerodrome;;New Zealand;5;38-07S;176-19E;'
+                 '38-07S;176-19E;285;294;\n')
+
+
+class FakeCursor(object):
+    """a prism database which knows no stations"""
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, statement):
+        self.queries.append(statement)
+
+    def fetchone(self):
+        return None
+
+class DisabledStationsTest(unittest.TestCase):
+    def setUp(self):
+        self.stations = station_details.StationDetails()
+
+    def assert_not_found(self, result, length):
+        found, latitudes, longitudes, elevations = result
+        self.assertEqual(found.tolist(), [False] * length)
+        for column in (latitudes, longitudes, elevations):
+            self.assertTrue(numpy.isnan(column).all())
+            self.assertEqual(len(column), length)
+
+    def test_wmo_stations(self):
+        self.assert_not_found(self.stations.locate_wmo_stations([93, 94], [246, 1]), 2)
+
+    def test_other_stations(self):
+        self.assert_not_found(self.stations.locate_other_stations(['NZRO']), 1)
+
+    def test_no_stations(self):
+        self.assert_not_found(self.stations.locate_wmo_stations([], []), 0)
+
+    def test_station_details_for(self):
+        self.assertEqual(self.stations.station_details_for('93246'), None)
+
+    def test_disabled_again(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, 'nsd_bbsss.txt'), 'w') as noaa:
+                noaa.write(NOAA_STATIONS)
+            self.stations.set_filenames([directory])
+            self.assertTrue(self.stations.locate_wmo_stations([93], [246])[0].all())
+            self.stations.set_filenames(None)
+            self.assert_not_found(self.stations.locate_wmo_stations([93], [246]), 1)
+        finally:
+            shutil.rmtree(directory)
+
+class EnabledStationsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'nsd_bbsss.txt'), 'w') as noaa:
+            noaa.write(NOAA_STATIONS)
+        self.stations = station_details.StationDetails()
+        self.stations.cursor = FakeCursor()
+        self.stations.set_filenames([self.directory])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_wmo_stations(self):
+        found, latitudes, longitudes, elevations = \
+            self.stations.locate_wmo_stations([93, 94, 94], [246, 1, 1])
+        self.assertEqual(found.tolist(), [True, False, False])
+        self.assertAlmostEqual(latitudes[0], -(38 + 7 / 60.0))
+        self.assertAlmostEqual(longitudes[0], 176 + 19 / 60.0)
+        self.assertEqual(elevations[0], 285)
+        self.assertTrue(numpy.isnan(latitudes[1:]).all())
+        #an unknown station is only asked for once
+        self.assertEqual(len(self.stations.cursor.queries), 1)
+
+    def test_other_stations(self):
+        found, latitudes, _, _ = self.stations.locate_other_stations(['nzro', 'XXXX'])
+        self.assertEqual(found.tolist(), [True, False])
+        self.assertAlmostEqual(latitudes[0], -(38 + 7 / 60.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
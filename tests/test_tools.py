@@ -0,0 +1,65 @@
+'''tests that the array versions of the tools give what the value by value ones did'''
+import unittest
+
+import Geohash
+import numpy
+
+from obs2aws import tools
+
+UNITS = ['degC', 'C', 'fahrenheit', 'knot', 'kt', 'foot', 'm/s', 'mile/h', 'no such unit']
+
+
+class SIUnitsTest(unittest.TestCase):
+    def setUp(self):
+        tools._SI_CONVERSIONS.clear()
+
+    def tearDown(self):
+        tools._SI_CONVERSIONS.clear()
+
+    def test_arrays_as_per_value(self):
+        values = numpy.random.RandomState(0).uniform(-100, 400, 200)
+        for unit in UNITS:
+            expected = [tools.change_to_si_units(unit, value) for value in values.tolist()]
+            result = tools.change_array_to_si_units(unit, values)
+            self.assertEqual(len(result), len(expected))
+            for value, expected_value in zip(result, expected):
+                if expected_value is None:
+                    self.assertEqual(value, None)
+                else:
+                    self.assertAlmostEqual(value, expected_value,
+                                           delta=1e-12 * abs(expected_value))
+
+    def test_offset_and_scale(self):
+        kind, scale, offset = tools.si_conversion('fahrenheit')
+        self.assertEqual(kind, tools.SI_AFFINE)
+        self.assertAlmostEqual(scale, 5 / 9.0, places=12)
+        self.assertAlmostEqual(offset, tools.change_to_si_units('fahrenheit', 0.0))
+        self.assertEqual(tools.si_conversion('degC'), (tools.SI_AFFINE, 1.0, 273.15))
+
+    def test_not_a_straight_line(self):
+        change_to_si_units = tools.change_to_si_units
+        tools.change_to_si_units = lambda old_unit, value, key='': value * value + 1.0
+        try:
+            self.assertEqual(tools.si_conversion('square'), (tools.SI_PER_VALUE,))
+        finally:
+            tools.change_to_si_units = change_to_si_units
+        self.assertEqual(tools.si_conversion('square'), (tools.SI_PER_VALUE,))
+
+class GeohashTest(unittest.TestCase):
+    def test_as_geohash_encode(self):
+        random = numpy.random.RandomState(0)
+        lats = numpy.concatenate([random.uniform(-90, 90, 500),
+                                  [-90.0, 90.0, 0.0, 45.0, -45.0, 89.999999, 1e-12]])
+        lons = numpy.concatenate([random.uniform(-180, 180, 500),
+                                  [-180.0, 179.999999, 0.0, 90.0, -90.0, 180.0, -1e-12]])
+        for precision in range(1, 13):
+            self.assertEqual(tools.geohash_encode(lats, lons, precision).tolist(),
+                             [Geohash.encode(lat, lon, precision)
+                              for lat, lon in zip(lats.tolist(), lons.tolist())])
+
+    def test_no_locations(self):
+        self.assertEqual(tools.geohash_encode([], [], 2).tolist(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+'''tests of the retries and flushing of WriterEngine'''
+import os
+import Queue
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy
+
+from obs2aws import decode
+from obs2aws import dynamo_db
+from obs2aws import journal
+from obs2aws import obs2aws
+from obs2aws import writer_engine
+from tests.test_rows import masked, synop_message
+
+
+class FlakyWrite(object):
+    """a write which raises the first failures times for each row"""
+    def __init__(self, failures):
+        self.failures = failures
+        self.lock = threading.Lock()
+        self.attempts = {}
+        self.written = []
+
+    def __call__(self, filename, row):
+        with self.lock:
+            attempts = self.attempts[row['id']] = self.attempts.get(row['id'], 0) + 1
+            if attempts <= self.failures:
+                raise IOError('write %d of %s failed' % (attempts, row['id']))
+            self.written.append((filename, row['id']))
+
+class BatchingWriter(object):
+    """buffers rows like a DynDBWriter, failing those whose id is in bad when flushed"""
+    def __init__(self, bad=()):
+        self.bad = bad
+        self.lock = threading.Lock()
+        self.buffered = []
+        self.written = []
+        self.flushes = []
+
+    def write(self, row, source=None):
+        with self.lock:
+            self.buffered.append((row, source))
+
+    def flush(self, max_age=None):
+        with self.lock:
+            self.flushes.append(max_age)
+            failed = []
+            for row, source in self.buffered:
+                if row['id'] in self.bad:
+                    if source not in failed:
+                        failed.append(source)
+                else:
+                    self.written.append(row['id'])
+            self.buffered = []
+            return failed
+
+def item(filename, *ids):
+    '''a ddb queue item of a file with rows ids'''
+    return filename, [[{'id': each} for each in ids]]
+
+class WriterEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.poll_seconds = writer_engine.POLL_SECONDS
+        writer_engine.POLL_SECONDS = 0.01
+        self.directory = tempfile.mkdtemp()
+        self.journal = journal.ProgressJournal(os.path.join(self.directory, 'journal'),
+                                               sync=False)
+        self.failed = []
+        self.engine = writer_engine.WriterEngine(self.failed, self.journal)
+        self.queue = Queue.Queue()
+
+    def tearDown(self):
+        writer_engine.POLL_SECONDS = self.poll_seconds
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def run_engine(self, *items):
+        self.engine.start()
+        for each in items:
+            self.queue.put(each)
+        self.engine.shutdown()
+
+    def test_retries_failed_writes(self):
+        write = FlakyWrite(failures=2)
+        destination = self.engine.add_destination('ddb:recent', self.queue, write,
+                                                  retries=2, retry_delay=0.001)
+        self.run_engine(item('f1', 1, 2), item('f2', 3))
+        self.assertEqual(self.failed, [])
+        self.assertEqual(sorted(write.written), [('f1', 1), ('f1', 2), ('f2', 3)])
+        self.assertEqual(destination.retried, 6)
+        self.assertEqual(self.journal.remaining('f1', ['ddb:recent']), [])
+
+    def test_gives_up_after_retries(self):
+        released = []
+        self.journal.when_done('f1', ['ddb:recent'], lambda: None,
+                               lambda: released.append('f1'))
+        write = FlakyWrite(failures=3)
+        destination = self.engine.add_destination('ddb:recent', self.queue, write,
+                                                  retries=2, retry_delay=0.001)
+        self.run_engine(item('f1', 1, 2))
+        self.assertEqual(self.failed, ['f1'])
+        self.assertEqual(destination.failures, 2)
+        self.assertEqual(self.journal.remaining('f1', ['ddb:recent']), ['ddb:recent'])
+        self.assertEqual(released, ['f1'])
+
+    def test_flushes_batching_writers(self):
+        writer = BatchingWriter(bad=[3])
+        self.engine.add_writer('ddb:recent', self.queue, writer, in_flight=1)
+        self.run_engine(item('f1', 1, 2), item('f2', 3, 4))
+        self.assertEqual(writer.written, [1, 2, 4])
+        #with a journal each item is flushed completely as it finishes
+        self.assertTrue(writer.flushes.count(None) >= 2)
+        self.assertEqual(self.failed, ['f2'])
+        self.assertEqual(self.journal.remaining('f1', ['ddb:recent']), [])
+        self.assertEqual(self.journal.remaining('f2', ['ddb:recent']), ['ddb:recent'])
+
+    def test_flushes_idle_writers(self):
+        flushed = threading.Event()
+        class Writer(BatchingWriter):
+            def flush(self, max_age=None):
+                if max_age is not None:
+                    flushed.set()
+                return BatchingWriter.flush(self, max_age)
+        writer = Writer()
+        engine = writer_engine.WriterEngine(self.failed)
+        engine.add_writer('ddb:recent', self.queue, writer, in_flight=1)
+        engine.start()
+        self.queue.put(item('f1', 1))
+        self.assertTrue(flushed.wait(5.0))
+        engine.shutdown()
+        self.assertEqual(writer.written, [1])
+        self.assertIn(writer_engine.FLUSH_SECONDS, writer.flushes)
+
+class RecordingWriter(object):
+    """records the rows written, like a DynDBWriter without batching"""
+    def __init__(self):
+        self.written = []
+
+    def write(self, row):
+        self.written.append(row)
+
+def station_batch(report_count, seed):
+    '''a RowBatch of synop rows from a handful of stations, so that each station has
+    several rows'''
+    random = numpy.random.RandomState(seed)
+    data = synop_message(report_count, random)
+    data['blockNumber'] = masked(random.randint(1, 3, report_count), 10, seed)
+    data['stationNumber'] = masked(random.randint(1, 6, report_count))
+    batch = obs2aws.make_row_batch(decode.add_epoch_seconds(data, report_count),
+                                   report_count, 'synop')
+    return batch.with_overlay(s3key='s3key%d' % seed)
+
+def obs_id(row):
+    '''the obs_id of row, None if it hasn't one'''
+    return row.get(dynamo_db.IDENTIFIER, {}).get('S')
+
+class ShardedWriterPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.poll_seconds = writer_engine.POLL_SECONDS
+        writer_engine.POLL_SECONDS = 0.01
+        self.failed = []
+        self.queue = Queue.Queue()
+        self.writers = []
+
+    def tearDown(self):
+        writer_engine.POLL_SECONDS = self.poll_seconds
+
+    def make_writer(self):
+        self.writers.append(RecordingWriter())
+        return self.writers[-1]
+
+    def test_rows_as_one_writer(self):
+        items = [('synop_%d_A.bufr' % each,
+                  [station_batch(count, each * 10 + part) for part, count in
+                   enumerate([60, 0, 35])]) for each in range(6)]
+        #what the one writer thread of each destination wrote, in order
+        expected = [written for _, rows in items for batch in rows for written in batch]
+        for each, station in enumerate(['03772', None]):
+            row = dynamo_db.ObsDBRow()
+            row.set_attribute(dynamo_db.IDENTIFIER, station)
+            row.set_attribute('s3key', 'metar%d' % each)
+            items.append(('metar_%d_A.txt' % each, row))
+            expected.append(row)
+        pool = writer_engine.ShardedWriterPool(self.make_writer, self.queue, self.failed,
+                                               workers=3)
+        pool.start()
+        for each in items:
+            self.queue.put(each)
+        pool.shutdown()
+        self.assertEqual(self.failed, [])
+        written = [each for writer in self.writers for each in writer.written]
+        self.assertEqual(sorted(written), sorted(expected))
+        #each station is written by one worker, in order
+        for number, writer in enumerate(self.writers):
+            for each in writer.written:
+                station = obs_id(each)
+                self.assertEqual(number, 0 if station is None else
+                                 dynamo_db.shard_number(station, 3))
+        for station in set(obs_id(each) for each in expected):
+            self.assertEqual([each for each in written if obs_id(each) == station],
+                             [each for each in expected if obs_id(each) == station])
+        self.assertEqual(sum(stats['rows'] for stats in pool.stats()), len(expected))
+
+    def test_split_by_shard(self):
+        batches = [station_batch(50, seed) for seed in range(3)]
+        parts = writer_engine.split_by_shard(batches, 4)
+        for shard, part in parts.items():
+            for batch in part:
+                self.assertEqual(batch.shard_numbers(4).tolist(), [shard] * len(batch))
+        self.assertEqual(sorted(row for part in parts.values() for batch in part
+                                for row in batch),
+                         sorted(row for batch in batches for row in batch))
+
+
+if __name__ == '__main__':
+    unittest.main()